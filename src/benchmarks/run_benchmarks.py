@@ -0,0 +1,330 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import statistics
+
+import click
+import numpy as np
+from src.benchmarks.synthetic import synthetic_batch, write_synthetic_dataset
+from src.utils.time_utils import get_metrics, reset_metrics
+
+BASELINE_PATH = os.path.join('reports', 'benchmarks', 'baseline.json')
+# A benchmark regresses when its median time grows by more than this ratio
+REGRESSION_THRESHOLD = 0.2
+BATCH_SIZES = (1, 8, 32)
+
+
+def measure(function, repeats=5, setup=None, items=1):
+    """Time a function over several repeats.
+
+    Parameters
+    ----------
+    function : callable
+        Function to time, called without arguments.
+    repeats : int, optional
+        Number of timed calls, after one untimed warm-up call.
+    setup : callable, optional
+        Called before every call, outside of the timing.
+    items : int, optional
+        Number of items processed by one call.
+
+    Returns
+    -------
+    dict
+        Median and minimum seconds per call and items per second.
+    """
+    times = []
+    for repeat in range(repeats + 1):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        function()
+        if repeat:
+            times.append(time.perf_counter() - start_time)
+    median = statistics.median(times)
+    return {'median_seconds': median,
+            'min_seconds': min(times),
+            'items_per_second': items / median if median > 0 else 0.,
+            'repeats': repeats}
+
+
+def _clear(path):
+    def setup():
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+    return setup
+
+
+def bench_crop_brain_contour(workdir, n_images, repeats):
+    from src.utils.data_processing import (crop_brain_contour,
+                                           crop_brain_contour_batch)
+
+    images = synthetic_batch(n_images)
+    return {'crop_brain_contour': measure(
+                lambda: [crop_brain_contour(image) for image in images],
+                repeats, items=n_images),
+            'crop_brain_contour_batch': measure(
+                lambda: crop_brain_contour_batch(images), repeats,
+                items=n_images)}
+
+
+def bench_corp_dataset(workdir, n_images, repeats):
+    from src.utils.data_processing import SPLITS, corp_dataset
+
+    source = write_synthetic_dataset(os.path.join(workdir, 'crop_source'),
+                                     n_images // 6, splits=SPLITS)
+    target = os.path.join(workdir, 'crop_target')
+    sources = [os.path.join(source, split) for split in SPLITS]
+    results = {}
+    for n_jobs in (1, os.cpu_count()):
+        results[f'corp_dataset[n_jobs={n_jobs}]'] = measure(
+            lambda: corp_dataset(target, *sources, n_jobs=n_jobs), repeats,
+            items=n_images // 6 * 6)
+    return results
+
+
+def bench_load_data(workdir, n_images, repeats):
+    from src.utils.exploratory_data_analysis import load_data
+
+    source = write_synthetic_dataset(os.path.join(workdir, 'load_source'),
+                                     n_images // 2)
+    directories = [os.path.join(source, 'yes'), os.path.join(source, 'no')]
+    return {'load_data': measure(lambda: load_data(directories, (240, 240)),
+                                 repeats, items=n_images // 2 * 2)}
+
+
+def bench_make_data_augmented_dataset(workdir, n_images, repeats):
+    from src.utils.data_processing import make_data_augmented_dataset
+
+    source = write_synthetic_dataset(os.path.join(workdir, 'augment_source'),
+                                     n_images // 4)
+    file_dir = os.path.join(source, 'yes')
+    save_to_dir = os.path.join(workdir, 'augment_target')
+    n_generated_samples = 4
+    results = {'make_data_augmented_dataset[batched]': measure(
+        lambda: make_data_augmented_dataset(file_dir, n_generated_samples,
+                                            save_to_dir, 'yes',
+                                            batch_size=32, seed=0),
+        repeats, items=n_images // 4 * n_generated_samples)}
+    try:
+        import tensorflow  # noqa: F401
+    except ImportError:
+        return results
+    results['make_data_augmented_dataset[keras]'] = measure(
+        lambda: make_data_augmented_dataset(file_dir, n_generated_samples,
+                                            save_to_dir, 'yes'),
+        repeats, items=n_images // 4 * n_generated_samples)
+    return results
+
+
+def bench_make_dataset(workdir, n_images, repeats):
+    from src.data.make_dataset import main
+
+    source = write_synthetic_dataset(os.path.join(workdir, 'split_source'),
+                                     n_images // 2)
+    target = os.path.join(workdir, 'split_target')
+    results = {}
+    for mode in ('copy', 'hardlink', 'manifest'):
+        results[f'make_dataset.main[{mode}]'] = measure(
+            lambda: main(source, target, 0.7, 0.15, seed=0, mode=mode,
+                         index_path=os.path.join(workdir, 'index.csv')),
+            repeats, setup=_clear(target),
+            items=n_images // 2 * 2)
+    return results
+
+
+def bench_inference(workdir, n_images, repeats, model_dir=None):
+    from src.models.predict_model import MODEL_DIR, load_model
+
+    model_dir = model_dir or MODEL_DIR
+    if not os.path.isdir(model_dir):
+        logging.getLogger(__name__).warning(
+            'no SavedModel in %s, inference is skipped', model_dir)
+        return {}
+    model = load_model(model_dir)
+    results = {}
+    for batch_size in BATCH_SIZES:
+        batch = np.random.default_rng(0).random((batch_size, 240, 240, 3),
+                                                dtype=np.float32)
+        results[f'inference[batch_size={batch_size}]'] = measure(
+            lambda: model(batch, training=False).numpy(), repeats,
+            items=batch_size)
+    return results
+
+
+def bench_reduced_decoding(workdir, n_images, repeats):
+    from src.utils.image_io import measure_reduced_decoding
+
+    # Large scans are where reduced decoding pays off
+    source = write_synthetic_dataset(os.path.join(workdir, 'decode_source'),
+                                     max(1, n_images // 8),
+                                     image_size=(1024, 1024))
+    paths = [os.path.join(source, class_name, file_name)
+             for class_name in ('yes', 'no')
+             for file_name in sorted(os.listdir(os.path.join(source,
+                                                             class_name)))]
+    report = measure_reduced_decoding(paths, (240, 240), repeats)
+    results = {}
+    for name in ('full', 'reduced'):
+        median = report[name]['median_seconds']
+        results[f'read_image[{name}]'] = {
+            'median_seconds': median,
+            'min_seconds': report[name]['min_seconds'],
+            'items_per_second': len(paths) / median,
+            'peak_memory_mb': report[name]['peak_memory_mb'],
+            'repeats': repeats}
+    return results
+
+
+BENCHMARKS = {
+    'crop_brain_contour': bench_crop_brain_contour,
+    'corp_dataset': bench_corp_dataset,
+    'load_data': bench_load_data,
+    'reduced_decoding': bench_reduced_decoding,
+    'make_data_augmented_dataset': bench_make_data_augmented_dataset,
+    'make_dataset': bench_make_dataset,
+    'inference': bench_inference,
+}
+
+
+def machine_info():
+    """Describe the machine the benchmarks ran on."""
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count()}
+
+
+def run_benchmarks(names=None, n_images=120, repeats=5):
+    """Run the benchmarks on synthetic data in a temporary directory.
+
+    Parameters
+    ----------
+    names : list, optional
+        Benchmarks to run, all of BENCHMARKS by default.
+    n_images : int, optional
+        Size of the synthetic datasets.
+    repeats : int, optional
+        Timed calls per benchmark.
+
+    Returns
+    -------
+    dict
+        Machine description, results by benchmark and the stage metrics
+        recorded by src.utils.time_utils during the run.
+    """
+    logger = logging.getLogger(__name__)
+    reset_metrics()
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name in names or BENCHMARKS:
+            logger.info('running %s', name)
+            results.update(BENCHMARKS[name](workdir, n_images, repeats))
+    return {'machine': machine_info(), 'n_images': n_images,
+            'results': results, 'stages': get_metrics()}
+
+
+def compare_to_baseline(report, baseline, threshold=REGRESSION_THRESHOLD):
+    """Find the benchmarks slower than the baseline.
+
+    Parameters
+    ----------
+    report : dict
+        Output of run_benchmarks.
+    baseline : dict
+        Earlier output of run_benchmarks. Its optional 'thresholds' entry
+        overrides the threshold of single benchmarks.
+    threshold : float, optional
+        Largest accepted relative growth of the median time.
+
+    Returns
+    -------
+    list
+        One dict per regressed benchmark with both medians and the ratio.
+    """
+    regressions = []
+    thresholds = baseline.get('thresholds', {})
+    for name, result in report['results'].items():
+        reference = baseline['results'].get(name)
+        if reference is None or reference['median_seconds'] <= 0:
+            continue
+        ratio = result['median_seconds'] / reference['median_seconds']
+        if ratio > 1. + thresholds.get(name, threshold):
+            regressions.append({
+                'benchmark': name,
+                'baseline_seconds': reference['median_seconds'],
+                'median_seconds': result['median_seconds'],
+                'ratio': ratio})
+    return regressions
+
+
+@click.command()
+@click.option('--benchmark', '-b', multiple=True,
+              type=click.Choice(list(BENCHMARKS)),
+              help='Benchmark to run, repeat the option to run several. '
+                   'All by default.')
+@click.option('--n-images', default=120, show_default=True,
+              help='Size of the synthetic datasets.')
+@click.option('--repeats', default=5, show_default=True)
+@click.option('--baseline', default=BASELINE_PATH, show_default=True,
+              type=click.Path())
+@click.option('--threshold', default=REGRESSION_THRESHOLD, show_default=True,
+              help='Accepted relative growth of the median time.')
+@click.option('--update-baseline', is_flag=True,
+              help='Store the results as the new baseline.')
+@click.option('--output', type=click.Path(),
+              help='Write the results to a JSON file.')
+def main(benchmark, n_images, repeats, baseline, threshold, update_baseline,
+         output):
+    """ Benchmarks the preprocessing and inference hot paths on synthetic
+        images and fails when they regressed from the baseline.
+    """
+    logger = logging.getLogger(__name__)
+    report = run_benchmarks(list(benchmark) or None, n_images, repeats)
+    for name, result in report['results'].items():
+        logger.info('%s: %.4f s median, %.1f items/s', name,
+                    result['median_seconds'], result['items_per_second'])
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if update_baseline or not os.path.isfile(baseline):
+        if os.path.isfile(baseline):
+            # Keep the per benchmark thresholds tuned by hand
+            with open(baseline) as baseline_file:
+                thresholds = json.load(baseline_file).get('thresholds', {})
+            report['thresholds'] = thresholds
+        os.makedirs(os.path.dirname(os.path.abspath(baseline)), exist_ok=True)
+        with open(baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        logger.info('baseline written to %s', baseline)
+        return
+
+    with open(baseline) as baseline_file:
+        reference = json.load(baseline_file)
+    if reference.get('machine') != report['machine']:
+        logger.warning('the baseline was recorded on another machine: %s',
+                       reference.get('machine'))
+    if reference.get('n_images') != n_images:
+        logger.warning('the baseline was recorded with %s images',
+                       reference.get('n_images'))
+    regressions = compare_to_baseline(report, reference, threshold)
+    for regression in regressions:
+        logger.error('%(benchmark)s regressed: %(median_seconds).4f s '
+                     'against %(baseline_seconds).4f s (x%(ratio).2f)',
+                     regression)
+    if regressions:
+        sys.exit(1)
+    logger.info('no regression above %.0f%%', threshold * 100)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,106 @@
+import os
+
+import numpy as np
+from src.utils.lazy_import import lazy_import
+
+cv2 = lazy_import('cv2')
+
+CLASS_PREFIXES = {'yes': 'Y', 'no': 'N'}
+
+
+def synthetic_mri(index, seed=0, tumor=False, image_size=(256, 256)):
+    """Draw a deterministic MRI-like axial slice.
+
+    A dark background holds a bright skull ring around a textured brain,
+    off-centre and of random size so that the contour crop has work to do.
+    Tumorous slices get a bright blob inside the brain.
+
+    Parameters
+    ----------
+    index : int
+        Index of the image, the same (index, seed, tumor) gives the same image.
+    seed : int, optional
+        Seed of the dataset.
+    tumor : bool, optional
+        Whether to draw a tumor.
+    image_size : tuple, optional
+        (width, height) of the image.
+
+    Returns
+    -------
+    numpy.ndarray
+        (H, W, 3) BGR uint8 image.
+    """
+    rng = np.random.default_rng([seed, index, int(tumor)])
+    width, height = image_size
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    centre_x = width * rng.uniform(0.4, 0.6)
+    centre_y = height * rng.uniform(0.4, 0.6)
+    radius_x = width * rng.uniform(0.25, 0.4)
+    radius_y = height * rng.uniform(0.3, 0.45)
+    distance = np.sqrt(((x - centre_x) / radius_x) ** 2
+                       + ((y - centre_y) / radius_y) ** 2)
+
+    image = rng.normal(8., 4., (height, width)).astype(np.float32)
+    brain = distance < 0.9
+    image[brain] = (90. + 40. * np.sin(x[brain] / rng.uniform(3., 8.))
+                    * np.cos(y[brain] / rng.uniform(3., 8.)))
+    image[(distance >= 0.9) & (distance < 1.)] = 220.
+    if tumor:
+        tumor_x = centre_x + radius_x * rng.uniform(-0.4, 0.4)
+        tumor_y = centre_y + radius_y * rng.uniform(-0.4, 0.4)
+        tumor_radius = min(radius_x, radius_y) * rng.uniform(0.1, 0.25)
+        tumor_distance = (x - tumor_x) ** 2 + (y - tumor_y) ** 2
+        image[tumor_distance < tumor_radius ** 2] = 250.
+    image = np.clip(image, 0, 255).astype(np.uint8)
+    image = cv2.GaussianBlur(image, (5, 5), 0)
+    return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+
+def synthetic_batch(n_images, seed=0, image_size=(256, 256)):
+    """Draw a stack of synthetic slices, half of them tumorous.
+
+    Returns
+    -------
+    numpy.ndarray
+        (N, H, W, 3) BGR uint8 images.
+    """
+    return np.stack([synthetic_mri(index, seed, index % 2 == 1, image_size)
+                     for index in range(n_images)])
+
+
+def write_synthetic_dataset(root, n_per_class, seed=0, splits=None,
+                            image_size=(256, 256)):
+    """Write a synthetic dataset of JPEG files.
+
+    Parameters
+    ----------
+    root : str
+        Directory of the dataset.
+    n_per_class : int
+        Number of images per class, and per split when splits are given.
+    seed : int, optional
+        Seed of the dataset.
+    splits : list, optional
+        Split directories to create, e.g. ['train', 'validation', 'test'].
+        Without splits, root holds the 'yes' and 'no' classes like data/raw.
+    image_size : tuple, optional
+        (width, height) of the images.
+
+    Returns
+    -------
+    str
+        root.
+    """
+    index = 0
+    for split in splits or ['']:
+        for class_name, prefix in CLASS_PREFIXES.items():
+            class_dir = os.path.join(root, split, class_name)
+            os.makedirs(class_dir, exist_ok=True)
+            for _ in range(n_per_class):
+                image = synthetic_mri(index, seed, class_name == 'yes',
+                                      image_size)
+                cv2.imwrite(os.path.join(class_dir, f'{prefix}{index}.jpg'),
+                            image)
+                index += 1
+    return root
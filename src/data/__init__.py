@@ -1 +1 @@
-from .make_dataset import *
+from .make_dataset import *  # noqa: F401,F403
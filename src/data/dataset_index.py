@@ -0,0 +1,162 @@
+import os
+from random import Random
+from concurrent.futures import ThreadPoolExecutor
+from src.utils.image_io import read_image_header
+from src.utils.dataset_scan import file_sha256
+
+INDEX_FIELDS = ['split', 'class_name', 'path', 'size', 'mtime_ns', 'width',
+                'height', 'channels', 'sha256']
+DATASET_INDEX_PATH = os.path.join('data', 'interim', 'dataset_index.csv')
+CLASS_NAMES = ['yes', 'no']
+SPLITS = ['train', 'validation', 'test']
+
+
+def _index_row(path, class_name):
+    """Describe a single image of the dataset.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image.
+    class_name : str
+        Class of the image.
+
+    Returns
+    -------
+    dict
+        Path, class, size in bytes, mtime, dimensions read from the header
+        and sha256 of the content. The dimensions are empty when the header
+        could not be read.
+    """
+    stat = os.stat(path)
+    try:
+        header = read_image_header(path)
+    except OSError:
+        header = None
+    width, height, channels = header if header else ('', '', '')
+    return {'split': '',
+            'class_name': class_name,
+            'path': path,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'width': width,
+            'height': height,
+            'channels': channels,
+            'sha256': file_sha256(path)}
+
+
+def build_dataset_index(input_filepath, class_names=CLASS_NAMES, n_jobs=8,
+                        previous=None):
+    """Scan a dataset once into an index of its images.
+
+    Parameters
+    ----------
+    input_filepath : str
+        Path to the dataset containing one directory per class.
+    class_names : list, optional
+        Classes to index.
+    n_jobs : int, optional
+        Number of scanning threads.
+    previous : list, optional
+        Rows of an earlier index, e.g. read with read_manifest. A row is
+        reused without reading the image when the path, size and mtime of
+        the file are unchanged.
+
+    Returns
+    -------
+    list
+        One dict per image with the INDEX_FIELDS, sorted by class then name.
+        The split is left empty.
+    """
+    known = {os.path.abspath(row['path']): row for row in previous or []}
+
+    def index_row(task):
+        path, class_name = task
+        row = known.get(os.path.abspath(path))
+        if row is not None:
+            stat = os.stat(path)
+            # Rows read back from a CSV file hold strings
+            if (str(row['size']), str(row.get('mtime_ns'))) == (
+                    str(stat.st_size), str(stat.st_mtime_ns)):
+                return dict(row, split='', class_name=class_name, path=path)
+        return _index_row(path, class_name)
+
+    tasks = []
+    for class_name in class_names:
+        class_dir = os.path.join(input_filepath, class_name)
+        for file_name in sorted(os.listdir(class_dir)):
+            tasks.append((os.path.join(class_dir, file_name), class_name))
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(index_row, tasks))
+
+
+def stratified_split(rows, train_ratio, validation_ratio, seed=None,
+                     class_names=CLASS_NAMES):
+    """Assign a split to every image of an index, class by class.
+
+    No file is touched. Each class is shuffled on its own and cut with the
+    same ratios, so every split keeps the class balance of the dataset.
+    Test ratio = 1 - train_ratio - validation_ratio
+
+    Parameters
+    ----------
+    rows : list
+        Index rows, e.g. from build_dataset_index.
+    train_ratio : float
+        Ratio of the training set.
+    validation_ratio : float
+        Ratio of the validation set.
+    seed : int, optional
+        Seed of the shuffle, the same seed always gives the same split.
+    class_names : list, optional
+        Classes in the order they are shuffled.
+
+    Returns
+    -------
+    list
+        Copies of the rows with their split set.
+    """
+    rng = Random(seed)
+    split_rows = []
+    for class_name in class_names:
+        class_rows = sorted((row for row in rows
+                             if row['class_name'] == class_name),
+                            key=lambda row: os.path.basename(row['path']))
+        rng.shuffle(class_rows)
+
+        # Calculate the index to split the data
+        total_index = len(class_rows)
+        train_index = int(total_index * train_ratio)
+        validation_index = train_index + int(total_index * validation_ratio)
+        for position, row in enumerate(class_rows):
+            if position < train_index:
+                split = 'train'
+            elif position < validation_index:
+                split = 'validation'
+            else:
+                split = 'test'
+            split_rows.append(dict(row, split=split))
+    return split_rows
+
+
+def select_rows(rows, split=None, class_name=None):
+    """Select the rows of an index by split and class.
+
+    Parameters
+    ----------
+    rows : list
+        Index rows.
+    split : str, optional
+        Split to keep, all of them if None.
+    class_name : str, optional
+        Class to keep, all of them if None.
+
+    Returns
+    -------
+    list
+        Matching rows.
+    """
+    return [row for row in rows
+            if (split is None or row['split'] == split)
+            and (class_name is None or row['class_name'] == class_name)]
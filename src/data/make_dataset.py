@@ -5,22 +5,43 @@ import click
 import logging
 from pathlib import Path
 from dotenv import find_dotenv, load_dotenv
-from src.utils.data_processing import validate_directory, copy_instances, rename_instances
-import tensorflow as tf
-from random import shuffle
-import shutil
-
-''' To split with comando line
-@click.command()
-@click.argument('input_filepath', type=click.Path(exists=True))
-@click.argument('output_filepath', type=click.Path())
-@click.argument('train_ratio', type=float)
-@click.argument('validation_ratio', type=float)'''
-def main(input_filepath, output_filepath, train_ratio, validation_ratio):
+from src.utils.data_processing import (LINK_MODES, validate_directory,
+                                       copy_instances, materialize_instance)
+from src.utils.manifest import MANIFEST_FILE, read_manifest, write_manifest
+from src.data.dataset_index import (CLASS_NAMES, DATASET_INDEX_PATH,
+                                    INDEX_FIELDS, SPLITS,
+                                    build_dataset_index, stratified_split)
+
+
+def _index_dataset(input_filepath, index_path, n_jobs):
+    """Index a dataset, reusing and updating the index cached in
+    index_path."""
+    previous = []
+    if index_path is not None and os.path.isfile(index_path):
+        previous = read_manifest(index_path)
+    rows = build_dataset_index(input_filepath, n_jobs=n_jobs,
+                               previous=previous)
+    if index_path is not None:
+        # Keep the rows of the other datasets sharing the cache
+        root = os.path.join(os.path.abspath(input_filepath), '')
+        os.makedirs(os.path.dirname(os.path.abspath(index_path)),
+                    exist_ok=True)
+        write_manifest(index_path,
+                       [row for row in previous
+                        if not os.path.abspath(row['path']).startswith(root)]
+                       + rows, INDEX_FIELDS)
+    return rows
+
+
+def main(input_filepath, output_filepath, train_ratio, validation_ratio,
+         seed=None, mode='copy', index_path=DATASET_INDEX_PATH, n_jobs=8):
     """ Runs data processing scripts to turn raw data from (../interim) into
         cleaned data ready to be analyzed (saved in ../interim/split).
         Test ratio = 1 - train_ratio - validation_ratio
 
+        The split is recorded in output_filepath/manifest.csv, one row per
+        image with its split, class, size, dimensions and content hash.
+
         Parameters
         ----------
         input_filepath : str
@@ -31,57 +52,56 @@ def main(input_filepath, output_filepath, train_ratio, validation_ratio):
             Ratio of the training set.
         validation_ratio : float
             Ratio of the validation set.
+        seed : int, optional
+            Seed of the shuffle, the same seed always gives the same split.
+        mode : str, optional
+            How the split is materialized: 'copy', 'hardlink', 'symlink' or
+            'reflink' (links fall back to copies), or 'manifest' to only
+            write the manifest, which the loaders resolve.
+        index_path : str, optional
+            Path to the cached dataset index. Only the images whose path,
+            size or mtime changed since it was written are read and hashed
+            again, and it is updated after the scan. None scans every image
+            without a cache.
+        n_jobs : int, optional
+            Number of threads scanning the dataset.
     """
-    for class_name in ["yes", "no"]:
-        # Create output directory if not exist
-        if not validate_directory(output_filepath):
-            os.mkdir(output_filepath)
-        elif (validate_directory(os.path.join(output_filepath, "train", class_name)) > 0) or \
-                (validate_directory(os.path.join(output_filepath, "validate", class_name)) > 0) or \
-                (validate_directory(os.path.join(output_filepath, "test", class_name)) > 0) and (
-                (len(os.listdir(os.path.join(output_filepath, "train", class_name))) > 0) or (
-                len(os.listdir(os.path.join(output_filepath, "validate", class_name))) > 0) or len(
-                os.listdir(os.path.join(output_filepath, "test", class_name))) > 0):
-            return "The output directory already exists and is not empty. Please delete the directory and try again."
-
-        # Validate if train, validation and test directories exist if not create them
-        os.makedirs(os.path.join(output_filepath, "train", class_name), exist_ok=True)
-        os.makedirs(os.path.join(output_filepath, "validation", class_name), exist_ok=True)
-        os.makedirs(os.path.join(output_filepath, "test", class_name), exist_ok=True)
-
-        #
-
-        # List and shuffle images
-        img_files = os.listdir(os.path.join(input_filepath, class_name))
-        shuffle(img_files)
-
-        # Calculate the index to split the data
-        total_index = len(img_files)
-        train_index = int(total_index * train_ratio)
-        validation_index = train_index + int(total_index * validation_ratio)
-
-        # Split the data
-        train_files = img_files[:train_index]
-        validation_files = img_files[train_index:validation_index]
-        test_files = img_files[validation_index:]
-
-        # Copy the images to the corresponding directories
-        for file in train_files:
-            shutil.copy(os.path.join(input_filepath, class_name, file),
-                        os.path.join(output_filepath, 'train', class_name, file))
-        for file in validation_files:
-            shutil.copy(os.path.join(input_filepath, class_name, file),
-                        os.path.join(output_filepath, 'validation', class_name, file))
-        for file in test_files:
-            shutil.copy(os.path.join(input_filepath, class_name, file),
-                        os.path.join(output_filepath, 'test', class_name, file))
+    class_dirs = [os.path.join(output_filepath, split, class_name)
+                  for split in SPLITS for class_name in CLASS_NAMES]
+    # Create output directory if not exist
+    if not validate_directory(output_filepath):
+        os.mkdir(output_filepath)
+    elif os.path.isfile(os.path.join(output_filepath, MANIFEST_FILE)) or any(
+            validate_directory(class_dir) and len(os.listdir(class_dir)) > 0
+            for class_dir in class_dirs):
+        return ("The output directory already exists and is not empty. "
+                "Please delete the directory and try again.")
+
+    rows = _index_dataset(input_filepath, index_path, n_jobs)
+
+    # Split the data
+    rows = stratified_split(rows, train_ratio, validation_ratio, seed)
+
+    # Materialize the images in the corresponding directories
+    if mode != 'manifest':
+        for class_dir in class_dirs:
+            os.makedirs(class_dir, exist_ok=True)
+        for row in rows:
+            target_path = os.path.join(output_filepath, row['split'],
+                                       row['class_name'],
+                                       os.path.basename(row['path']))
+            materialize_instance(row['path'], target_path, mode)
+            row['path'] = target_path
+    write_manifest(os.path.join(output_filepath, MANIFEST_FILE), rows,
+                   INDEX_FIELDS)
 
     logger = logging.getLogger(__name__)
     logger.info('making final data set from raw data')
     return 'Success in making the dataset.'
 
 
-def make_renamed_dataset(input_filepath, target_filepath, appended_string):
+def make_renamed_dataset(input_filepath, target_filepath, appended_string,
+                         mode='copy'):
     """Copy the instances from a source directory to a target directory.
 
     Parameters
@@ -92,17 +112,41 @@ def make_renamed_dataset(input_filepath, target_filepath, appended_string):
         Path to the target directory.
     appended_string : str
         String to append to the instance name.
+    mode : str, optional
+        'copy', 'hardlink', 'symlink' or 'reflink', see materialize_instance.
 
     """
     if not validate_directory(target_filepath):
         os.mkdir(target_filepath)
-        copy_instances(input_filepath, target_filepath)
-        rename_instances(target_filepath, appended_string)
+        copy_instances(input_filepath, target_filepath, mode,
+                       prefix=appended_string)
         return f"Success in making the {appended_string} renamed dataset."
     else:
         raise ValueError('The input target directory is already done.')
 
 
+@click.command()
+@click.argument('input_filepath', type=click.Path(exists=True))
+@click.argument('output_filepath', type=click.Path())
+@click.argument('train_ratio', type=float)
+@click.argument('validation_ratio', type=float)
+@click.option('--seed', type=int, help='Seed of the shuffle.')
+@click.option('--mode', type=click.Choice(LINK_MODES + ('manifest',)),
+              default='copy', show_default=True)
+@click.option('--index-path', default=DATASET_INDEX_PATH, show_default=True,
+              type=click.Path(),
+              help='Dataset index reused across runs.')
+@click.option('--n-jobs', default=8, show_default=True)
+def split_command(input_filepath, output_filepath, train_ratio,
+                  validation_ratio, seed, mode, index_path, n_jobs):
+    """ Splits the dataset in INPUT_FILEPATH into train, validation and test
+        sets in OUTPUT_FILEPATH.
+        Test ratio = 1 - train_ratio - validation_ratio
+    """
+    click.echo(main(input_filepath, output_filepath, train_ratio,
+                    validation_ratio, seed, mode, index_path, n_jobs))
+
+
 if __name__ == '__main__':
     log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     logging.basicConfig(level=logging.INFO, format=log_fmt)
@@ -114,4 +158,4 @@ if __name__ == '__main__':
     # load up the .env entries as environment variables
     load_dotenv(find_dotenv())
 
-    main()
+    split_command()
@@ -0,0 +1,334 @@
+import os
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import numpy as np
+from src.utils.lazy_import import lazy_import
+from src.utils.manifest import MANIFEST_FILE, read_manifest, write_manifest
+
+cv2 = lazy_import('cv2')
+
+HASH_METHODS = ['dhash', 'phash']
+HASH_INDEX_FIELDS = ['split', 'class_name', 'path', 'sha256', 'hash']
+
+
+def _bits_to_int(bits):
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def dhash(gray, hash_size=8):
+    """Difference hash of a grayscale image.
+
+    Parameters
+    ----------
+    gray : numpy.ndarray
+        (H, W) grayscale image.
+    hash_size : int, optional
+        Side of the hash, the hash has hash_size ** 2 bits.
+
+    Returns
+    -------
+    int
+        Hash whose bits tell whether each pixel is brighter than its right
+        neighbour in the downscaled image.
+    """
+    resized = cv2.resize(gray, (hash_size + 1, hash_size),
+                         interpolation=cv2.INTER_AREA)
+    return _bits_to_int(resized[:, 1:] > resized[:, :-1])
+
+
+def phash(gray, hash_size=8, highfreq_factor=4):
+    """DCT perceptual hash of a grayscale image.
+
+    Parameters
+    ----------
+    gray : numpy.ndarray
+        (H, W) grayscale image.
+    hash_size : int, optional
+        Side of the hash, the hash has hash_size ** 2 bits.
+    highfreq_factor : int, optional
+        Ratio between the side of the downscaled image and hash_size.
+
+    Returns
+    -------
+    int
+        Hash whose bits tell whether each low frequency DCT coefficient is
+        above their median.
+    """
+    side = hash_size * highfreq_factor
+    resized = cv2.resize(gray, (side, side),
+                         interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_frequencies = cv2.dct(resized)[:hash_size, :hash_size]
+    return _bits_to_int(low_frequencies > np.median(low_frequencies))
+
+
+def image_hash(path, method='dhash'):
+    """Perceptual hash of an image file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image.
+    method : str, optional
+        'dhash' or 'phash'.
+
+    Returns
+    -------
+    int or None
+        64 bit hash, None if the image can not be read.
+    """
+    gray = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        return None
+    if method == 'dhash':
+        return dhash(gray)
+    if method == 'phash':
+        return phash(gray)
+    raise ValueError(f'Unknown hash method {method!r}, expected one of '
+                     f'{HASH_METHODS}')
+
+
+def hamming_distance(first, second):
+    """Number of differing bits of two hashes."""
+    return bin(first ^ second).count('1')
+
+
+class BKTree:
+    """Burkhard-Keller tree of hashes under the Hamming distance.
+
+    A query for the hashes within a distance d of h only visits the children
+    whose edge distance lies in [dist(h, node) - d, dist(h, node) + d], so a
+    small radius explores a small part of the tree instead of every hash.
+    """
+
+    def __init__(self):
+        self._root = None
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, value, item):
+        """Insert a hash.
+
+        Parameters
+        ----------
+        value : int
+            Hash.
+        item : object
+            Payload returned by the queries, e.g. a row index.
+        """
+        self._size += 1
+        node = [value, [item], {}]
+        if self._root is None:
+            self._root = node
+            return
+        current = self._root
+        while True:
+            distance = hamming_distance(value, current[0])
+            if distance == 0:
+                current[1].append(item)
+                return
+            child = current[2].get(distance)
+            if child is None:
+                current[2][distance] = node
+                return
+            current = child
+
+    def query(self, value, max_distance):
+        """Find the hashes within a Hamming distance.
+
+        Parameters
+        ----------
+        value : int
+            Queried hash.
+        max_distance : int
+            Largest Hamming distance of the matches.
+
+        Returns
+        -------
+        list
+            (distance, item) tuples, nearest first.
+        """
+        matches = []
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node_value, items, children = stack.pop()
+            distance = hamming_distance(value, node_value)
+            if distance <= max_distance:
+                matches.extend((distance, item) for item in items)
+            for edge in range(max(distance - max_distance, 0),
+                              distance + max_distance + 1):
+                child = children.get(edge)
+                if child is not None:
+                    stack.append(child)
+        return sorted(matches, key=lambda match: match[0])
+
+
+def build_hash_index(rows, method='dhash', n_jobs=8, previous=None):
+    """Hash every image of a dataset index or manifest.
+
+    Parameters
+    ----------
+    rows : list
+        Rows with at least a path, e.g. from read_manifest.
+    method : str, optional
+        'dhash' or 'phash'.
+    n_jobs : int, optional
+        Number of hashing threads.
+    previous : list, optional
+        Rows of an earlier hash index with the same method. Their hashes are
+        reused for the images with the same sha256.
+
+    Returns
+    -------
+    list
+        Copies of the rows with a 'hash' hexadecimal string, empty for
+        unreadable images.
+    """
+    known = {row['sha256']: row['hash'] for row in previous or []
+             if row.get('sha256') and row['hash']}
+
+    def hash_row(row):
+        if row.get('sha256') in known:
+            return dict(row, hash=known[row['sha256']])
+        value = image_hash(row['path'], method)
+        return dict(row, hash='' if value is None else f'{value:016x}')
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(hash_row, rows))
+
+
+def save_hash_index(index_path, rows, method):
+    """Write a hash index next to a sidecar recording its method."""
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    write_manifest(index_path, rows, HASH_INDEX_FIELDS)
+    with open(index_path + '.json', 'w') as meta_file:
+        json.dump({'method': method}, meta_file)
+
+
+def load_hash_index(index_path, method):
+    """Read a hash index, empty if it was built with another method."""
+    if (not os.path.isfile(index_path)
+            or not os.path.isfile(index_path + '.json')):
+        return []
+    with open(index_path + '.json') as meta_file:
+        if json.load(meta_file).get('method') != method:
+            return []
+    return read_manifest(index_path)
+
+
+def find_near_duplicates(rows, max_distance=6):
+    """Find the pairs of images whose hashes are close.
+
+    Parameters
+    ----------
+    rows : list
+        Rows of a hash index.
+    max_distance : int, optional
+        Largest Hamming distance of a pair, out of 64 bits.
+
+    Returns
+    -------
+    list
+        (distance, first row index, second row index) tuples, each pair once.
+    """
+    hashes = [int(row['hash'], 16) if row['hash'] else None for row in rows]
+    tree = BKTree()
+    pairs = []
+    for index, value in enumerate(hashes):
+        if value is None:
+            continue
+        # Querying before inserting reports every pair once
+        pairs.extend((distance, other, index)
+                     for distance, other in tree.query(value, max_distance))
+        tree.add(value, index)
+    return sorted(pairs)
+
+
+def leakage_report(rows, max_distance=6):
+    """Report the near-duplicate images shared by different splits.
+
+    Parameters
+    ----------
+    rows : list
+        Rows of a hash index with their split, e.g. built from the manifest
+        written by make_dataset.main.
+    max_distance : int, optional
+        Largest Hamming distance of a pair, out of 64 bits.
+
+    Returns
+    -------
+    dict
+        Number of leaked pairs per split pair, images of the validation and
+        test splits with a near-duplicate in training, and every pair.
+    """
+    pairs = []
+    counts = {}
+    leaked = {}
+    for distance, first, second in find_near_duplicates(rows, max_distance):
+        first_row, second_row = rows[first], rows[second]
+        if first_row['split'] == second_row['split']:
+            continue
+        split_pair = '/'.join(sorted([first_row['split'],
+                                      second_row['split']]))
+        counts[split_pair] = counts.get(split_pair, 0) + 1
+        for row, other in [(first_row, second_row), (second_row, first_row)]:
+            if other['split'] == 'train' and row['split'] != 'train':
+                leaked.setdefault(row['split'], set()).add(row['path'])
+        pairs.append({'distance': distance,
+                      'first': first_row['path'],
+                      'first_split': first_row['split'],
+                      'first_class': first_row['class_name'],
+                      'second': second_row['path'],
+                      'second_split': second_row['split'],
+                      'second_class': second_row['class_name']})
+    return {'max_distance': max_distance,
+            'pairs_by_split': counts,
+            'leaked_images': {split: len(paths)
+                              for split, paths in leaked.items()},
+            'unreadable': [row['path'] for row in rows if not row['hash']],
+            'pairs': pairs}
+
+
+@click.command()
+@click.argument('data_dir', type=click.Path(exists=True))
+@click.option('--method', type=click.Choice(HASH_METHODS), default='dhash',
+              show_default=True)
+@click.option('--max-distance', default=6, show_default=True,
+              help='Hamming distance out of 64 bits.')
+@click.option('--index-path', default='data/interim/perceptual_index.csv',
+              show_default=True, type=click.Path(),
+              help='Hash index reused across runs.')
+@click.option('--n-jobs', default=8, show_default=True)
+@click.option('--output', type=click.Path(),
+              help='Write the full report to a JSON file.')
+def main(data_dir, method, max_distance, index_path, n_jobs, output):
+    """ Reports the near-duplicate images leaking across the splits of the
+        dataset written by make_dataset in DATA_DIR.
+    """
+    logger = logging.getLogger(__name__)
+    manifest = read_manifest(os.path.join(data_dir, MANIFEST_FILE))
+    rows = build_hash_index(manifest, method, n_jobs,
+                            load_hash_index(index_path, method))
+    save_hash_index(index_path, rows, method)
+    report = leakage_report(rows, max_distance)
+    for split_pair, count in sorted(report['pairs_by_split'].items()):
+        logger.info('%s: %d near-duplicate pairs', split_pair, count)
+    for split, count in sorted(report['leaked_images'].items()):
+        logger.info('%s: %d images with a near-duplicate in train', split,
+                    count)
+    if report['unreadable']:
+        logger.warning('%d unreadable images', len(report['unreadable']))
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,417 @@
+import os
+import json
+import hashlib
+import logging
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import click
+import numpy as np
+from dotenv import find_dotenv, load_dotenv
+from src.utils.lazy_import import lazy_import
+from src.utils.image_io import read_image, reduced_decode_enabled
+from src.utils.augmentation import (AUGMENTATION_POLICY, apply_transforms,
+                                    sample_transforms)
+from src.utils.data_processing import (CROP_THRESHOLD, IMAGE_SIZE,
+                                       INTERPOLATION, LINK_MODES,
+                                       crop_brain_contour,
+                                       materialize_instance)
+from src.utils.manifest import (MANIFEST_FILE, MANIFEST_FIELDS,
+                                write_manifest)
+from src.data.dataset_index import CLASS_NAMES, SPLITS, stratified_split
+
+cv2 = lazy_import('cv2')
+
+CHECKPOINT_FILE = '.pipeline_checkpoint.jsonl'
+# Prefixes of make_renamed_dataset and samples per image of notebook 1
+CLASS_PREFIXES = {'yes': 'Y_', 'no': 'N_'}
+GENERATED_SAMPLES = {'yes': 6, 'no': 9}
+
+
+def pipeline_config(train_ratio, validation_ratio, seed,
+                    generated_samples=GENERATED_SAMPLES,
+                    image_size=IMAGE_SIZE, reduced_decode=False):
+    """Parameters that change the output of the pipeline.
+
+    Returns
+    -------
+    dict
+        The parameters and their 'digest', which tags the checkpoints.
+    """
+    config = {'train_ratio': train_ratio,
+              'validation_ratio': validation_ratio,
+              'seed': seed,
+              'generated_samples': dict(generated_samples),
+              'policy': AUGMENTATION_POLICY,
+              'image_size': list(image_size),
+              'crop_threshold': CROP_THRESHOLD,
+              'interpolation': INTERPOLATION}
+    # Only added when set, the checkpoints of full decoding runs stay valid
+    if reduced_decode:
+        config['reduced_decode'] = True
+    encoded = json.dumps(config, sort_keys=True).encode()
+    config['digest'] = hashlib.sha256(encoded).hexdigest()[:16]
+    return config
+
+
+def plan_items(input_filepath, config):
+    """List the raw images with the split each one goes to.
+
+    The split only depends on the file names and the config, so it is the
+    same on every run and the items can be processed independently.
+
+    Parameters
+    ----------
+    input_filepath : str
+        Raw dataset with one directory per class.
+    config : dict
+        Output of pipeline_config.
+
+    Returns
+    -------
+    list
+        One dict per image with its source path, class, renamed file name
+        and split.
+    """
+    rows = []
+    for class_name in CLASS_NAMES:
+        class_dir = os.path.join(input_filepath, class_name)
+        for file_name in sorted(os.listdir(class_dir)):
+            renamed = CLASS_PREFIXES[class_name] + file_name
+            rows.append({'path': os.path.join(class_dir, renamed),
+                         'source': os.path.join(class_dir, file_name),
+                         'class_name': class_name})
+    items = stratified_split(rows, config['train_ratio'],
+                             config['validation_ratio'], config['seed'])
+    for item in items:
+        item['name'] = os.path.basename(item.pop('path'))
+    return items
+
+
+def process_item(item, output_filepath, interim_filepath=None,
+                 mode='hardlink', seed=None,
+                 generated_samples=GENERATED_SAMPLES, image_size=IMAGE_SIZE,
+                 reduced_decode=False):
+    """Run every stage of the pipeline on a single raw image.
+
+    The image is renamed and split by linking it into interim_filepath,
+    augmented in memory with the deterministic engine of
+    src.utils.augmentation, then each sample is cropped and resized into
+    output_filepath/<split>/<class>.
+
+    Parameters
+    ----------
+    item : dict
+        Item from plan_items.
+    output_filepath : str
+        Processed dataset directory.
+    interim_filepath : str, optional
+        Directory of the renamed and split copies, and of the augmented
+        samples before cropping. Nothing intermediate is written if None.
+    mode : str, optional
+        How the intermediate copies are made, see materialize_instance.
+    seed : int, optional
+        Seed of the augmentations.
+    generated_samples : dict, optional
+        Number of augmented samples per image, by class.
+    image_size : tuple, optional
+        (width, height) of the processed images.
+    reduced_decode : bool, optional
+        Whether to decode a JPEG source at the smallest scale covering
+        image_size, see src.utils.image_io.read_image. The augmented samples
+        kept in interim_filepath then have that reduced size.
+
+    Returns
+    -------
+    list
+        Paths of the processed images, empty if the image can not be read.
+        Samples without a brain contour are skipped.
+    """
+    split, class_name, name = item['split'], item['class_name'], item['name']
+    image = read_image(item['source'], image_size if reduced_decode else None)
+    if image is None:
+        return []
+
+    stem = os.path.splitext(name)[0]
+    if interim_filepath is not None:
+        renamed = os.path.join(interim_filepath, class_name, name)
+        split_copy = os.path.join(interim_filepath, 'split', split, class_name,
+                                  name)
+        for source, target in [(item['source'], renamed),
+                               (renamed, split_copy)]:
+            # Left over by an interrupted run, a link can not be made over it
+            if os.path.lexists(target):
+                os.remove(target)
+            materialize_instance(source, target, mode)
+        augmented_dir = os.path.join(interim_filepath, 'split', split,
+                                     'augmented', class_name)
+
+    n_samples = generated_samples[class_name]
+    draws = [sample_transforms(name, sample, seed or 0)
+             for sample in range(n_samples)]
+    samples = apply_transforms(
+        np.repeat(image[np.newaxis], n_samples, axis=0),
+        {key: np.concatenate([draw[key] for draw in draws])
+         for key in draws[0]})
+
+    outputs = []
+    for sample, augmented in enumerate(samples):
+        file_name = f'aug_{stem}_{sample}.jpeg'
+        if interim_filepath is not None:
+            cv2.imwrite(os.path.join(augmented_dir, file_name), augmented)
+        try:
+            cropped = cv2.resize(crop_brain_contour(augmented),
+                                 dsize=image_size,
+                                 interpolation=INTERPOLATION)
+        except (ValueError, cv2.error):
+            # No contour, or an empty crop, in this sample only
+            logging.getLogger(__name__).warning(
+                'no brain contour in %s, skipped', file_name)
+            continue
+        target = os.path.join(output_filepath, split, class_name, file_name)
+        cv2.imwrite(target, cropped)
+        outputs.append(target)
+    return outputs
+
+
+def _interim_paths(item, interim_filepath, generated_samples):
+    """Intermediate copies of process_item that depend on the config."""
+    if interim_filepath is None:
+        return []
+    split_dir = os.path.join(interim_filepath, 'split', item['split'])
+    stem = os.path.splitext(item['name'])[0]
+    return ([os.path.join(split_dir, item['class_name'], item['name'])]
+            + [os.path.join(split_dir, 'augmented', item['class_name'],
+                            f'aug_{stem}_{sample}.jpeg')
+               for sample in range(generated_samples[item['class_name']])])
+
+
+def _read_checkpoint(checkpoint_path, digest):
+    """Entries of earlier runs, with the same config and with other ones."""
+    current, stale = [], []
+    if not os.path.isfile(checkpoint_path):
+        return current, stale
+    with open(checkpoint_path) as checkpoint_file:
+        for line in checkpoint_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Last line of an interrupted write
+                continue
+            if entry.get('config') == digest:
+                current.append(entry)
+            else:
+                stale.append(entry)
+    return current, stale
+
+
+def _clear_stale(checkpoint_path, current, stale):
+    """Remove the files written under other configs, e.g. images since
+    moved to another split or surplus augmented samples, and drop their
+    entries from the checkpoint log."""
+    if not stale:
+        return
+    kept = {path for entry in current
+            for path in entry['outputs'] + entry.get('interim', [])}
+    for entry in stale:
+        for path in entry['outputs'] + entry.get('interim', []):
+            if path not in kept and os.path.lexists(path):
+                os.remove(path)
+    temporary_path = checkpoint_path + '.tmp'
+    with open(temporary_path, 'w') as checkpoint_file:
+        for entry in current:
+            checkpoint_file.write(json.dumps(entry) + '\n')
+    os.replace(temporary_path, checkpoint_path)
+
+
+def _init_worker():
+    cv2.setNumThreads(1)
+
+
+def _make_directories(output_filepath, interim_filepath):
+    directories = [os.path.join(output_filepath, split, class_name)
+                   for split in SPLITS for class_name in CLASS_NAMES]
+    if interim_filepath is not None:
+        directories += [os.path.join(interim_filepath, class_name)
+                        for class_name in CLASS_NAMES]
+        directories += [os.path.join(interim_filepath, 'split', split, subdir,
+                                     class_name)
+                        for split in SPLITS for subdir in ['', 'augmented']
+                        for class_name in CLASS_NAMES]
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+
+def _write_manifests(items, done, output_filepath, interim_filepath):
+    """Write the manifests of the finished images, e.g. for the leakage
+    report."""
+    by_name = {item['name']: item for item in items}
+    write_manifest(os.path.join(output_filepath, MANIFEST_FILE),
+                   [{'split': by_name[name]['split'],
+                     'class_name': by_name[name]['class_name'], 'path': path}
+                    for name, outputs in done.items() if name in by_name
+                    for path in outputs],
+                   MANIFEST_FIELDS)
+    if interim_filepath is not None:
+        write_manifest(os.path.join(interim_filepath, 'split', MANIFEST_FILE),
+                       [{'split': item['split'],
+                         'class_name': item['class_name'],
+                         'path': os.path.join(interim_filepath, 'split',
+                                              item['split'],
+                                              item['class_name'],
+                                              item['name'])}
+                        for item in items if done.get(item['name'])],
+                       MANIFEST_FIELDS)
+
+
+def run_pipeline(input_filepath, output_filepath, interim_filepath=None,
+                 train_ratio=0.8, validation_ratio=0.1, seed=42,
+                 mode='hardlink', n_jobs=None,
+                 generated_samples=GENERATED_SAMPLES, image_size=IMAGE_SIZE,
+                 reduced_decode=None):
+    """Turn the raw dataset into the processed one, resuming earlier runs.
+
+    Each raw image flows through renaming, splitting, augmentation and
+    cropping on its own, on a process pool, with a bounded number of images
+    in flight. An image is appended to the checkpoint log of
+    output_filepath once all its outputs are written, so an interrupted run
+    only redoes the unfinished images. Changing the config removes the
+    files written under the previous one and reprocesses every image.
+
+    Parameters
+    ----------
+    input_filepath : str
+        Raw dataset with one directory per class.
+    output_filepath : str
+        Processed dataset directory, with one directory per split and class.
+    interim_filepath : str, optional
+        Directory of the intermediate copies, see process_item.
+    train_ratio : float, optional
+        Ratio of the training set.
+    validation_ratio : float, optional
+        Ratio of the validation set.
+    seed : int, optional
+        Seed of the split and of the augmentations.
+    mode : str, optional
+        How the intermediate copies are made, see materialize_instance.
+    n_jobs : int, optional
+        Number of worker processes, None uses every available core.
+    generated_samples : dict, optional
+        Number of augmented samples per image, by class.
+    image_size : tuple, optional
+        (width, height) of the processed images.
+    reduced_decode : bool, optional
+        Whether to decode the JPEG sources at a reduced scale, see
+        process_item. None follows the BRAIN_TUMOR_REDUCED_DECODE
+        environment variable, off by default.
+
+    Returns
+    -------
+    dict
+        Number of processed, resumed, unreadable and failed images.
+    """
+    logger = logging.getLogger(__name__)
+    reduced_decode = reduced_decode_enabled(reduced_decode)
+    config = pipeline_config(train_ratio, validation_ratio, seed,
+                             generated_samples, image_size, reduced_decode)
+    items = plan_items(input_filepath, config)
+    _make_directories(output_filepath, interim_filepath)
+
+    checkpoint_path = os.path.join(output_filepath, CHECKPOINT_FILE)
+    current, stale = _read_checkpoint(checkpoint_path, config['digest'])
+    if stale:
+        logger.info('config changed, removing the outputs of %d images',
+                    len(stale))
+    _clear_stale(checkpoint_path, current, stale)
+    done = {entry['item']: entry['outputs'] for entry in current}
+    todo = [item for item in items if item['name'] not in done]
+    logger.info('%d images, %d already processed', len(items),
+                len(items) - len(todo))
+    stats = {'processed': 0, 'resumed': len(items) - len(todo),
+             'unreadable': 0, 'failed': 0}
+
+    n_jobs = n_jobs or os.cpu_count()
+    # Enough work queued to keep every worker busy, not the whole dataset
+    max_pending = 4 * n_jobs
+    remaining = iter(todo)
+    with ProcessPoolExecutor(max_workers=n_jobs,
+                             initializer=_init_worker) as executor, \
+            open(checkpoint_path, 'a') as checkpoint_file:
+        pending = {}
+        while True:
+            for item in remaining:
+                future = executor.submit(process_item, item, output_filepath,
+                                         interim_filepath, mode,
+                                         seed, generated_samples, image_size,
+                                         reduced_decode)
+                pending[future] = item
+                if len(pending) >= max_pending:
+                    break
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                item = pending.pop(future)
+                try:
+                    outputs = future.result()
+                except Exception:
+                    logger.exception('failed to process %s', item['source'])
+                    stats['failed'] += 1
+                    continue
+                stats['processed' if outputs else 'unreadable'] += 1
+                done[item['name']] = outputs
+                entry = {'item': item['name'], 'config': config['digest'],
+                         'outputs': outputs,
+                         'interim': _interim_paths(item, interim_filepath,
+                                                   generated_samples)}
+                checkpoint_file.write(json.dumps(entry) + '\n')
+                checkpoint_file.flush()
+
+    _write_manifests(items, done, output_filepath, interim_filepath)
+    logger.info('%(processed)d processed, %(resumed)d resumed, '
+                '%(unreadable)d unreadable, %(failed)d failed', stats)
+    return stats
+
+
+@click.command()
+@click.argument('input_filepath', type=click.Path(exists=True))
+@click.argument('output_filepath', type=click.Path())
+@click.option('--interim', 'interim_filepath', default='data/interim',
+              show_default=True, type=click.Path(),
+              help="Directory of the intermediate copies, '' to skip them.")
+# Ratios of notebook 1
+@click.option('--train-ratio', default=0.8, show_default=True)
+@click.option('--validation-ratio', default=0.1, show_default=True)
+@click.option('--seed', default=42, show_default=True)
+@click.option('--mode', type=click.Choice(LINK_MODES), default='hardlink',
+              show_default=True)
+@click.option('--n-jobs', type=int,
+              help='Worker processes, every core by default.')
+@click.option('--yes-samples', default=GENERATED_SAMPLES['yes'],
+              show_default=True)
+@click.option('--no-samples', default=GENERATED_SAMPLES['no'],
+              show_default=True)
+@click.option('--reduced-decode/--full-decode', default=None,
+              help='Decode JPEG sources at a reduced scale, '
+                   '$BRAIN_TUMOR_REDUCED_DECODE by default.')
+def main(input_filepath, output_filepath, interim_filepath, train_ratio,
+         validation_ratio, seed, mode, n_jobs, yes_samples, no_samples,
+         reduced_decode):
+    """ Runs the rename, split, augment and crop stages from the raw data in
+        INPUT_FILEPATH to the processed data in OUTPUT_FILEPATH, resuming an
+        interrupted run.
+    """
+    run_pipeline(input_filepath, output_filepath, interim_filepath or None,
+                 train_ratio, validation_ratio, seed, mode, n_jobs,
+                 {'yes': yes_samples, 'no': no_samples},
+                 reduced_decode=reduced_decode)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    # find .env automagically by walking up directories until it's found, then
+    # load up the .env entries as environment variables
+    load_dotenv(find_dotenv())
+
+    main()
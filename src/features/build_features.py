@@ -0,0 +1,419 @@
+import os
+import math
+import time
+import logging
+
+import click
+import numpy as np
+import tensorflow as tf
+
+# Same class order as ImageDataGenerator.flow_from_directory
+CLASS_NAMES = ['no', 'yes']
+IMAGE_SIZE = (240, 240)
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff')
+
+# Augmentation policy of the training generator in notebook 4, with the
+# ImageDataGenerator argument names
+TRAIN_AUGMENTATION = dict(rotation_range=40,
+                          width_shift_range=0.4,
+                          height_shift_range=0.4,
+                          shear_range=0.2,
+                          horizontal_flip=True,
+                          vertical_flip=True)
+# Range of the per-iteration draw folded into the augmentation seeds
+EPOCH_DRAWS = 2 ** 16
+# Parameters drawn by sample_augmentation, in the order of their seeds
+AUGMENTATION_DRAWS = ['theta', 'shear', 'zoom_x', 'zoom_y', 'shift_x',
+                      'shift_y', 'brightness', 'horizontal_flip',
+                      'vertical_flip']
+
+
+def list_image_files(directory):
+    """List the images of a split directory and their class indices.
+
+    Parameters
+    ----------
+    directory : str
+        Path to a split directory containing one subdirectory per class.
+
+    Returns
+    -------
+    tuple
+        List of image paths and list of class indices.
+    """
+    paths = []
+    labels = []
+    for label, class_name in enumerate(CLASS_NAMES):
+        class_dir = os.path.join(directory, class_name)
+        for file_name in sorted(os.listdir(class_dir)):
+            if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(class_dir, file_name))
+                labels.append(label)
+    return paths, labels
+
+
+def _decode_image(path, label, image_size):
+    image = tf.io.decode_image(tf.io.read_file(path), channels=3,
+                               expand_animations=False)
+    image = tf.image.resize(image, image_size, method='nearest')
+    image = tf.cast(image, tf.float32) / 255.
+    return image, tf.one_hot(label, len(CLASS_NAMES))
+
+
+def sample_augmentation(n, rotation_range=0., width_shift_range=0.,
+                        height_shift_range=0., shear_range=0., zoom_range=0.,
+                        brightness_range=None, seed=None):
+    """Draw the random parameters of augment_batch.
+
+    Every parameter comes from its own random stream, so that e.g. the two
+    flips or the rotation and the shift are drawn independently.
+
+    Parameters
+    ----------
+    n : int or tf.Tensor
+        Number of images.
+    seed : int or tf.Tensor, optional
+        Seed of the draws, an int or a (2,) stateless seed. Unseeded draws
+        if None.
+
+    Returns
+    -------
+    dict
+        (n,) float tensors by parameter: theta and shear in radians, zoom_x,
+        zoom_y, shift_x and shift_y as ImageDataGenerator ranges,
+        brightness, and the horizontal_flip and vertical_flip coin draws in
+        [0, 1).
+    """
+    if seed is None:
+        def uniform(index, low, high):
+            return tf.random.uniform([n], low, high)
+    else:
+        if isinstance(seed, int):
+            seed = [seed, 0]
+        seeds = tf.random.experimental.stateless_split(
+            tf.cast(seed, tf.int64), num=len(AUGMENTATION_DRAWS))
+
+        def uniform(index, low, high):
+            return tf.random.stateless_uniform([n], seeds[index], low, high)
+
+    ranges = {'theta': (-rotation_range, rotation_range),
+              'shear': (-shear_range, shear_range),
+              'zoom_x': (1. - zoom_range, 1. + zoom_range),
+              'zoom_y': (1. - zoom_range, 1. + zoom_range),
+              'shift_x': (-width_shift_range, width_shift_range),
+              'shift_y': (-height_shift_range, height_shift_range),
+              'brightness': brightness_range or (1., 1.),
+              'horizontal_flip': (0., 1.),
+              'vertical_flip': (0., 1.)}
+    draws = {name: uniform(index, *ranges[name])
+             for index, name in enumerate(AUGMENTATION_DRAWS)}
+    draws['theta'] *= math.pi / 180.
+    draws['shear'] *= math.pi / 180.
+    return draws
+
+
+def check_draw_independence(n=4096, seed=42, tolerance=0.1):
+    """Check that the augmentation parameters are drawn independently.
+
+    Parameters
+    ----------
+    n : int, optional
+        Number of draws of every parameter.
+    seed : int, optional
+        Seed of the draws.
+    tolerance : float, optional
+        Largest accepted absolute correlation between two parameters.
+
+    Returns
+    -------
+    float
+        Largest absolute correlation between two parameters.
+
+    Raises
+    ------
+    ValueError
+        If two parameters are correlated above tolerance.
+    """
+    # Non-zero ranges so that every parameter is actually random
+    draws = sample_augmentation(n, rotation_range=1., width_shift_range=1.,
+                                height_shift_range=1., shear_range=1.,
+                                zoom_range=1., brightness_range=(0., 1.),
+                                seed=[seed, 0])
+    correlations = np.abs(np.corrcoef(
+        np.stack([draws[name].numpy() for name in AUGMENTATION_DRAWS])))
+    np.fill_diagonal(correlations, 0.)
+    first, second = np.unravel_index(correlations.argmax(),
+                                     correlations.shape)
+    if correlations[first, second] > tolerance:
+        raise ValueError(f'{AUGMENTATION_DRAWS[first]} and '
+                         f'{AUGMENTATION_DRAWS[second]} draws are correlated: '
+                         f'{correlations[first, second]:.3f}')
+    return float(correlations[first, second])
+
+
+def augment_batch(images, rotation_range=0., width_shift_range=0.,
+                  height_shift_range=0., shear_range=0., zoom_range=0.,
+                  brightness_range=None, horizontal_flip=False,
+                  vertical_flip=False, seed=None):
+    """Randomly transform a batch of images with tensor ops.
+
+    The arguments follow ImageDataGenerator: angles are in degrees, shifts are
+    fractions of the image size and out of bounds pixels repeat the nearest
+    edge. Every image of the batch draws its own transform.
+
+    Parameters
+    ----------
+    images : tf.Tensor
+        (N, H, W, C) float images.
+    seed : int or tf.Tensor, optional
+        Seed of the random draws, see sample_augmentation. Give every batch
+        its own (2,) seed, a constant seed repeats the same transforms.
+
+    Returns
+    -------
+    tf.Tensor
+        Augmented images.
+    """
+    n = tf.shape(images)[0]
+    height = tf.cast(tf.shape(images)[1], tf.float32)
+    width = tf.cast(tf.shape(images)[2], tf.float32)
+    draws = sample_augmentation(n, rotation_range, width_shift_range,
+                                height_shift_range, shear_range, zoom_range,
+                                brightness_range, seed)
+    theta, shear = draws['theta'], draws['shear']
+    zoom_x, zoom_y = draws['zoom_x'], draws['zoom_y']
+    shift_x = draws['shift_x'] * width
+    shift_y = draws['shift_y'] * height
+
+    # Output to input mapping: rotation @ shear @ zoom around the image
+    # centre, then shift
+    a00 = tf.cos(theta) * zoom_x
+    a01 = -tf.sin(theta + shear) * zoom_y
+    a10 = tf.sin(theta) * zoom_x
+    a11 = tf.cos(theta + shear) * zoom_y
+    centre_x = (width - 1.) / 2.
+    centre_y = (height - 1.) / 2.
+    a02 = centre_x - a00 * centre_x - a01 * centre_y + shift_x
+    a12 = centre_y - a10 * centre_x - a11 * centre_y + shift_y
+    zeros = tf.zeros([n])
+    transforms = tf.stack([a00, a01, a02, a10, a11, a12, zeros, zeros], axis=1)
+    images = tf.raw_ops.ImageProjectiveTransformV3(
+        images=images, transforms=transforms,
+        output_shape=tf.shape(images)[1:3], fill_value=0.,
+        interpolation='BILINEAR', fill_mode='NEAREST')
+
+    if brightness_range is not None:
+        images = images * draws['brightness'][:, None, None, None]
+    if horizontal_flip:
+        flip = draws['horizontal_flip'] < 0.5
+        images = tf.where(flip[:, None, None, None], tf.reverse(images, [2]),
+                          images)
+    if vertical_flip:
+        flip = draws['vertical_flip'] < 0.5
+        images = tf.where(flip[:, None, None, None], tf.reverse(images, [1]),
+                          images)
+    return images
+
+
+def make_dataset(directory, image_size=IMAGE_SIZE, batch_size=32,
+                 shuffle=False, augmentation=None, cache=None,
+                 shuffle_buffer=1000, prefetch=True, seed=None,
+                 n_images=None):
+    """Build a tf.data input pipeline over a processed split directory.
+
+    Images are decoded in parallel, rescaled by 1/255 and, when requested,
+    augmented a whole batch at a time. Labels are one-hot encoded like the
+    'categorical' class mode of flow_from_directory.
+
+    Parameters
+    ----------
+    directory : str
+        Path to a split directory containing the 'no' and 'yes' classes.
+    image_size : tuple, optional
+        (height, width) of the images.
+    batch_size : int, optional
+        Number of images per batch.
+    shuffle : bool, optional
+        Whether to reshuffle the images on every epoch.
+    augmentation : dict, optional
+        Keyword arguments of augment_batch, e.g. TRAIN_AUGMENTATION.
+    cache : str, optional
+        '' caches the decoded images in memory, a path caches them in a file.
+        The cache is filled on the first epoch.
+    shuffle_buffer : int, optional
+        Number of decoded images held by the shuffle buffer.
+    prefetch : bool, optional
+        Whether to prepare the next batches while the current one is used.
+    seed : int, optional
+        Seed of the shuffle and of the augmentation. Each iteration over the
+        dataset, e.g. each epoch, gets other augmentation parameters, in the
+        same sequence from one run to the next.
+    n_images : int, optional
+        Number of files drawn at random from both classes with seed, before
+        anything is decoded. Every file, in class order, if None.
+
+    Returns
+    -------
+    tf.data.Dataset
+        Dataset of (images, labels) batches.
+    """
+    paths, labels = list_image_files(directory)
+    if n_images is not None:
+        # The files are listed one class after the other, take a random subset
+        order = np.random.default_rng(seed).permutation(len(paths))[:n_images]
+        paths = [paths[index] for index in order]
+        labels = [labels[index] for index in order]
+    dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+    dataset = dataset.map(
+        lambda path, label: _decode_image(path, label, image_size),
+        num_parallel_calls=tf.data.AUTOTUNE)
+    if cache is not None:
+        dataset = dataset.cache(cache)
+    if shuffle:
+        dataset = dataset.shuffle(min(shuffle_buffer, max(len(paths), 1)),
+                                  seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.batch(batch_size)
+    if augmentation and seed is None:
+        dataset = dataset.map(
+            lambda images, labels: (augment_batch(images, **augmentation),
+                                    labels),
+            num_parallel_calls=tf.data.AUTOTUNE)
+    elif augmentation:
+        # Stateless draws seeded by (seed, epoch draw, batch index),
+        # reproducible whatever the parallelism. enumerate restarts on every
+        # iteration, the epoch draw is reshuffled on every iteration like
+        # the images, so epochs do not repeat the same transforms.
+        epoch_draw = tf.data.Dataset.range(EPOCH_DRAWS).shuffle(
+            EPOCH_DRAWS, seed=seed, reshuffle_each_iteration=True).take(1)
+        batches = dataset
+
+        def augment(draw, batch, data):
+            batch_seed = tf.stack(
+                [tf.constant(seed, tf.int64) * EPOCH_DRAWS + draw, batch])
+            return (augment_batch(data[0], seed=batch_seed, **augmentation),
+                    data[1])
+
+        dataset = epoch_draw.flat_map(
+            lambda draw: batches.enumerate().map(
+                lambda batch, data: (draw, batch, data)))
+        # flat_map hides the number of batches from Keras
+        dataset = dataset.apply(
+            tf.data.experimental.assert_cardinality(batches.cardinality()))
+        dataset = dataset.map(augment, num_parallel_calls=tf.data.AUTOTUNE)
+    if prefetch:
+        dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    return dataset
+
+
+def make_datasets(base_dir, image_size=IMAGE_SIZE, batch_size=32, cache=None,
+                  seed=42):
+    """Build the train, validation and test pipelines of a processed dataset.
+
+    Parameters
+    ----------
+    base_dir : str
+        Path to the processed dataset, e.g. 'data/processed'.
+    image_size : tuple, optional
+        (height, width) of the images.
+    batch_size : int, optional
+        Number of images per batch.
+    cache : str, optional
+        '' to cache in memory, or a path prefix for one cache file per split.
+    seed : int, optional
+        Seed of the training shuffle and augmentation.
+
+    Returns
+    -------
+    dict
+        Datasets by split name. Only the training split is shuffled and
+        augmented.
+    """
+    datasets = {}
+    for split in ['train', 'validation', 'test']:
+        split_cache = cache
+        if cache:
+            split_cache = f'{cache}_{split}'
+        train = split == 'train'
+        datasets[split] = make_dataset(
+            os.path.join(base_dir, split), image_size=image_size,
+            batch_size=batch_size, shuffle=train,
+            augmentation=TRAIN_AUGMENTATION if train else None,
+            cache=split_cache, seed=seed)
+    return datasets
+
+
+def _images_per_second(batches, n_batches):
+    n_images = 0
+    start_time = time.perf_counter()
+    for _, (images, _) in zip(range(n_batches), batches):
+        n_images += len(images)
+    return n_images / (time.perf_counter() - start_time)
+
+
+def benchmark_input_pipelines(directory, batch_size=32, n_batches=50,
+                              augment=True):
+    """Compare the images/sec of the tf.data pipeline and ImageDataGenerator.
+
+    Both pipelines read the same directory with the same batch size and,
+    when augment is True, the same augmentation policy.
+
+    Parameters
+    ----------
+    directory : str
+        Path to a split directory containing the 'no' and 'yes' classes.
+    batch_size : int, optional
+        Number of images per batch.
+    n_batches : int, optional
+        Number of batches timed per pipeline.
+    augment : bool, optional
+        Whether to apply TRAIN_AUGMENTATION.
+
+    Returns
+    -------
+    dict
+        Images per second of each pipeline.
+    """
+    augmentation = TRAIN_AUGMENTATION if augment else {}
+    data_gen = tf.keras.preprocessing.image.ImageDataGenerator(
+        rescale=1. / 255., **augmentation)
+    generator = data_gen.flow_from_directory(directory,
+                                             target_size=IMAGE_SIZE,
+                                             batch_size=batch_size,
+                                             class_mode='categorical',
+                                             classes=CLASS_NAMES,
+                                             shuffle=True, seed=42)
+    dataset = make_dataset(directory, batch_size=batch_size, shuffle=True,
+                           augmentation=augmentation, cache='',
+                           seed=42).repeat()
+    # Fill the in-memory cache before timing, as after the first epoch
+    for _ in dataset.take(math.ceil(generator.samples / batch_size)):
+        pass
+
+    return {'ImageDataGenerator': _images_per_second(generator, n_batches),
+            'tf.data': _images_per_second(dataset, n_batches)}
+
+
+@click.command()
+@click.argument('directory', type=click.Path(exists=True))
+@click.option('--batch-size', default=32, show_default=True)
+@click.option('--n-batches', default=50, show_default=True)
+@click.option('--no-augment', is_flag=True,
+              help='Time the pipelines without augmentation.')
+def main(directory, batch_size, n_batches, no_augment):
+    """ Benchmarks the tf.data input pipeline against ImageDataGenerator on
+        a processed split directory (e.g. data/processed/train).
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('largest correlation between augmentation draws: %.3f',
+                check_draw_independence())
+    results = benchmark_input_pipelines(directory, batch_size, n_batches,
+                                        not no_augment)
+    for name, images_per_second in results.items():
+        logger.info('%s: %.1f images/s', name, images_per_second)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import logging
+
+import click
+import numpy as np
+import tensorflow as tf
+from src.features.build_features import make_dataset
+from src.models.predict_model import MODEL_DIR, load_model
+
+QUANTIZATIONS = ['dynamic', 'float16', 'int8']
+# Seed of the calibration and evaluation subsets, the same for every variant
+SAMPLE_SEED = 42
+
+
+def _representative_dataset(calibration_dir, n_samples):
+    """Yield calibration inputs from a processed split, one image at a time."""
+    # Random files of both classes, the first ones would all be 'no' scans
+    dataset = make_dataset(calibration_dir, batch_size=1, prefetch=False,
+                           seed=SAMPLE_SEED, n_images=n_samples)
+    for images, _ in dataset:
+        yield [images]
+
+
+def export_tflite(model_dir, output_path, quantization='dynamic',
+                  calibration_dir=None, n_calibration=100):
+    """Export the classifier to TFLite with post-training quantization.
+
+    Parameters
+    ----------
+    model_dir : str
+        Path to the float SavedModel version directory.
+    output_path : str
+        Path of the .tflite file.
+    quantization : str, optional
+        'dynamic' for int8 weights with float activations, 'float16' for
+        half precision weights, 'int8' for full integer kernels calibrated on
+        calibration_dir, or None for an unquantized float model.
+    calibration_dir : str, optional
+        Processed split used to calibrate the activations, e.g.
+        'data/processed/validation'. Required for 'int8'.
+    n_calibration : int, optional
+        Number of calibration images.
+
+    Returns
+    -------
+    str
+        Path of the .tflite file.
+    """
+    converter = tf.lite.TFLiteConverter.from_saved_model(model_dir)
+    if quantization is not None:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        if calibration_dir is None:
+            raise ValueError('int8 quantization needs a calibration directory')
+        converter.representative_dataset = (
+            lambda: _representative_dataset(calibration_dir, n_calibration))
+        # Integer kernels, with float inputs and outputs, clients are unchanged
+        converter.target_spec.supported_ops = [
+            tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization not in (None, 'dynamic'):
+        raise ValueError(f'Unknown quantization {quantization!r}, expected '
+                         f'one of {QUANTIZATIONS}')
+
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'wb') as output_file:
+        output_file.write(converter.convert())
+    return output_path
+
+
+def _directory_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, file_name))
+               for root, _, file_names in os.walk(path)
+               for file_name in file_names)
+
+
+def _evaluate(predict_one, evaluation_dir, n_images=None):
+    """Measure the accuracy and single image latency of a predict function."""
+    dataset = make_dataset(evaluation_dir, batch_size=1, seed=SAMPLE_SEED,
+                           n_images=n_images)
+    correct = 0
+    latencies = []
+    for image, label in dataset:
+        image = image.numpy()
+        start_time = time.perf_counter()
+        probabilities = predict_one(image)
+        latencies.append(time.perf_counter() - start_time)
+        correct += int(np.argmax(probabilities) == np.argmax(label.numpy()))
+    if not latencies:
+        return {'accuracy': float('nan'), 'latency_ms': float('nan')}
+    return {'accuracy': correct / len(latencies),
+            'latency_ms': float(np.median(latencies)) * 1000.}
+
+
+def evaluate_tflite(tflite_path, evaluation_dir, n_images=None):
+    """Measure the accuracy and latency of a TFLite model.
+
+    Parameters
+    ----------
+    tflite_path : str
+        Path of the .tflite file.
+    evaluation_dir : str
+        Processed split to evaluate on.
+    n_images : int, optional
+        Number of evaluated images, the whole split by default.
+
+    Returns
+    -------
+    dict
+        Accuracy and median single image latency in ms.
+    """
+    interpreter = tf.lite.Interpreter(model_path=tflite_path,
+                                      num_threads=os.cpu_count())
+    interpreter.allocate_tensors()
+    input_index = interpreter.get_input_details()[0]['index']
+    output_index = interpreter.get_output_details()[0]['index']
+
+    def predict_one(image):
+        interpreter.set_tensor(input_index, image)
+        interpreter.invoke()
+        return interpreter.get_tensor(output_index)
+
+    return _evaluate(predict_one, evaluation_dir, n_images)
+
+
+def compare_exports(model_dir, data_dir, output_dir,
+                    quantizations=QUANTIZATIONS, n_calibration=100,
+                    n_images=None):
+    """Export quantized variants and compare them with the float model.
+
+    The variants are calibrated on the validation split and evaluated on the
+    test split. A report.json and a report.md table are written next to them.
+
+    Parameters
+    ----------
+    model_dir : str
+        Path to the float SavedModel version directory.
+    data_dir : str
+        Processed dataset with 'validation' and 'test' splits.
+    output_dir : str
+        Directory of the exported variants and of the report.
+    quantizations : list, optional
+        Quantizations to export.
+    n_calibration : int, optional
+        Number of calibration images.
+    n_images : int, optional
+        Number of evaluated images, the whole test split by default.
+
+    Returns
+    -------
+    list
+        One dict per model with its size in MB, accuracy and latency.
+    """
+    calibration_dir = os.path.join(data_dir, 'validation')
+    evaluation_dir = os.path.join(data_dir, 'test')
+    os.makedirs(output_dir, exist_ok=True)
+    model = load_model(model_dir)
+    report = [dict(model='float32 SavedModel', path=model_dir,
+                   size_mb=_directory_size(model_dir) / 2 ** 20,
+                   **_evaluate(lambda image: model(image,
+                                                   training=False).numpy(),
+                               evaluation_dir, n_images))]
+
+    for quantization in quantizations:
+        tflite_path = os.path.join(output_dir, f'model_{quantization}.tflite')
+        export_tflite(model_dir, tflite_path, quantization, calibration_dir,
+                      n_calibration)
+        report.append(dict(model=f'{quantization} TFLite', path=tflite_path,
+                           size_mb=_directory_size(tflite_path) / 2 ** 20,
+                           **evaluate_tflite(tflite_path, evaluation_dir,
+                                             n_images)))
+
+    with open(os.path.join(output_dir, 'report.json'), 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    with open(os.path.join(output_dir, 'report.md'), 'w') as report_file:
+        report_file.write('| Model | Size (MB) | Accuracy | Latency (ms) |\n'
+                          '|---|---|---|---|\n')
+        for row in report:
+            report_file.write('| {model} | {size_mb:.1f} | {accuracy:.4f} | '
+                              '{latency_ms:.1f} |\n'.format(**row))
+    return report
+
+
+@click.command()
+@click.option('--model-dir', default=MODEL_DIR, show_default=True,
+              type=click.Path(exists=True))
+@click.option('--data-dir', default='data/processed', show_default=True,
+              type=click.Path(exists=True))
+@click.option('--output-dir', default='models/MRI_validator_quantized',
+              show_default=True, type=click.Path())
+@click.option('--quantization', '-q', multiple=True,
+              type=click.Choice(QUANTIZATIONS), default=QUANTIZATIONS,
+              show_default=True)
+@click.option('--n-calibration', default=100, show_default=True)
+@click.option('--n-images', type=int,
+              help='Evaluated test images, all by default.')
+def main(model_dir, data_dir, output_dir, quantization, n_calibration,
+         n_images):
+    """ Exports post-training quantized variants of the classifier and
+        compares their size, accuracy and latency with the float model.
+    """
+    logger = logging.getLogger(__name__)
+    for row in compare_exports(model_dir, data_dir, output_dir, quantization,
+                               n_calibration, n_images):
+        logger.info('%(model)s: %(size_mb).1f MB, accuracy %(accuracy).4f, '
+                    '%(latency_ms).1f ms', row)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,252 @@
+import json
+import time
+import base64
+import asyncio
+import logging
+import itertools
+from urllib.parse import urlsplit
+
+import click
+import numpy as np
+
+DEFAULT_URL = 'http://127.0.0.1:8501/v1/models/brain_tumor_validator:predict'
+# Placeholder of the per-request value, out of the range of the pixels
+NONCE_VALUE = 1e9
+
+
+class _Connection:
+    """Keep-alive HTTP/1.1 connection sending JSON POST requests."""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def post(self, path, body):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+        header = (f'POST {path} HTTP/1.1\r\n'
+                  f'Host: {self.host}:{self.port}\r\n'
+                  'Content-Type: application/json\r\n'
+                  f'Content-Length: {len(body)}\r\n\r\n')
+        self.writer.write(header.encode() + body)
+        await self.writer.drain()
+
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode().partition(':')
+            headers[name.strip().lower()] = value.strip()
+        await self.reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection', '').lower() == 'close':
+            await self.close()
+        return status
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+        self.reader = self.writer = None
+
+
+def percentile_summary(latencies, errors, elapsed):
+    """Summarize the latencies of a load test run.
+
+    Parameters
+    ----------
+    latencies : list
+        Latencies in seconds of the successful requests.
+    errors : int
+        Number of failed requests.
+    elapsed : float
+        Duration of the run in seconds.
+
+    Returns
+    -------
+    dict
+        Request count, errors, requests/sec and p50/p95/p99 latency in ms.
+    """
+    summary = {'requests': len(latencies), 'errors': errors,
+               'requests_per_second': (len(latencies) / elapsed
+                                       if elapsed > 0 else 0.)}
+    for percentile in (50, 95, 99):
+        summary[f'p{percentile}_ms'] = (
+            float(np.percentile(latencies, percentile)) * 1000.
+            if latencies else float('nan'))
+    return summary
+
+
+async def run_load(url, bodies, concurrency, duration=10., warmup=1.):
+    """Send requests from concurrent clients for a fixed duration.
+
+    Parameters
+    ----------
+    url : str
+        URL of the predict endpoint.
+    bodies : iterator
+        JSON bodies of the requests, one is drawn per request, see
+        make_bodies.
+    concurrency : int
+        Number of clients, each with one request in flight.
+    duration : float, optional
+        Measured duration in seconds.
+    warmup : float, optional
+        Unmeasured duration in seconds before the measurement.
+
+    Returns
+    -------
+    dict
+        Summary of the run, see percentile_summary.
+    """
+    parts = urlsplit(url)
+    path = parts.path + (f'?{parts.query}' if parts.query else '')
+    latencies = []
+    errors = 0
+    start_time = time.perf_counter() + warmup
+    end_time = start_time + duration
+
+    async def client():
+        nonlocal errors
+        connection = _Connection(parts.hostname, parts.port or 80)
+        try:
+            while True:
+                sent = time.perf_counter()
+                if sent >= end_time:
+                    return
+                try:
+                    status = await connection.post(path, next(bodies))
+                except (OSError, ValueError, IndexError,
+                        asyncio.IncompleteReadError):
+                    status = None
+                    await connection.close()
+                if sent < start_time:
+                    continue
+                if status == 200:
+                    latencies.append(time.perf_counter() - sent)
+                else:
+                    errors += 1
+        finally:
+            await connection.close()
+
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return dict(percentile_summary(latencies, errors, duration),
+                concurrency=concurrency)
+
+
+def make_bodies(image=None, batch_size=1, image_size=(240, 240),
+                encoded=False, distinct=True):
+    """Generate the JSON bodies of predict requests.
+
+    Parameters
+    ----------
+    image : str, optional
+        Path to an image, a synthetic image is used by default.
+    batch_size : int, optional
+        Number of instances per request.
+    image_size : tuple, optional
+        (width, height) of the model input.
+    encoded : bool, optional
+        Whether to send the compressed file as a {'b64': ...} instance and let
+        the server preprocess it, instead of a preprocessed float tensor.
+    distinct : bool, optional
+        Whether every instance differs, so that the prediction cache of the
+        server can not answer it. A counter is written in the first pixel of
+        the float tensors, or appended after the end of the encoded file,
+        where decoders ignore it.
+
+    Yields
+    ------
+    bytes
+        Encoded {'instances': [...]} body.
+    """
+    counter = itertools.count()
+    if encoded:
+        if image is None:
+            raise ValueError('An image file is needed to send encoded '
+                             'instances')
+        with open(image, 'rb') as image_file:
+            data = image_file.read()
+        while True:
+            instances = []
+            for _ in range(batch_size):
+                nonce = str(next(counter)).encode() if distinct else b''
+                instances.append(
+                    {'b64': base64.b64encode(data + nonce).decode()})
+            yield json.dumps({'instances': instances}).encode()
+
+    if image is None:
+        shape = (image_size[1], image_size[0], 3)
+        instance = np.random.default_rng(0).random(shape, dtype=np.float32)
+    else:
+        from src.models.predict_model import preprocess_image
+
+        instance = preprocess_image(image, image_size)
+    instance = instance.round(4).tolist()
+    first_value = json.dumps(instance[0][0][0]).encode()
+    # Serialized once, only the first pixel changes between requests
+    instance[0][0][0] = NONCE_VALUE
+    parts = json.dumps({'instances': [instance] * batch_size}).encode().split(
+        json.dumps(NONCE_VALUE).encode())
+    while True:
+        values = [f'{next(counter) % 10 ** 9 / 10 ** 9:.9f}'.encode()
+                  if distinct else first_value for _ in range(batch_size)]
+        yield parts[0] + b''.join(value + part
+                                  for value, part in zip(values, parts[1:]))
+
+
+@click.command()
+@click.option('--url', default=DEFAULT_URL, show_default=True)
+@click.option('--concurrency', '-c', multiple=True, type=int,
+              default=(1, 4, 16), show_default=True,
+              help='Concurrency level, repeat the option to test several '
+                   'levels.')
+@click.option('--duration', default=10., show_default=True,
+              help='Measured seconds per level.')
+@click.option('--image', type=click.Path(exists=True),
+              help='Image sent in every request.')
+@click.option('--batch-size', default=1, show_default=True,
+              help='Instances per request.')
+@click.option('--encoded', is_flag=True,
+              help='Send the compressed image instead of a float tensor.')
+@click.option('--repeat-body', is_flag=True,
+              help='Send the same instances in every request, e.g. to '
+                   'measure the prediction cache.')
+@click.option('--output', type=click.Path(),
+              help='Write the results to a JSON file.')
+def main(url, concurrency, duration, image, batch_size, encoded, repeat_body,
+         output):
+    """ Load tests a TF Serving compatible predict endpoint and reports the
+        latency percentiles and throughput at each concurrency level.
+    """
+    logger = logging.getLogger(__name__)
+    bodies = make_bodies(image, batch_size, encoded=encoded,
+                         distinct=not repeat_body)
+    body = next(bodies)
+    logger.info('request body: %d bytes', len(body))
+    bodies = itertools.chain([body], bodies)
+    results = []
+    for level in concurrency:
+        result = asyncio.run(run_load(url, bodies, level, duration))
+        results.append(result)
+        logger.info('concurrency %(concurrency)d: '
+                    '%(requests_per_second).1f req/s, p50 %(p50_ms).1f ms, '
+                    'p95 %(p95_ms).1f ms, p99 %(p99_ms).1f ms, '
+                    '%(errors)d errors', result)
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
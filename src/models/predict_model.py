@@ -0,0 +1,411 @@
+import os
+import time
+import queue
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import click
+import numpy as np
+from src.utils.lazy_import import lazy_import
+from src.utils.data_processing import (IMAGE_SIZE, INTERPOLATION,
+                                       crop_brain_contour)
+from src.utils.time_utils import count_items, stage
+
+# Preprocessing workers of the server import this module without needing TF
+tf = lazy_import('tensorflow')
+cv2 = lazy_import('cv2')
+
+MODEL_DIR = str(Path(__file__).resolve().parents[2] / 'models'
+                / 'MRI_validator' / '0001')
+# Class order of flow_from_directory during training
+CLASS_NAMES = ['no', 'yes']
+# Same as src.features.build_features, which imports TF eagerly
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff')
+
+
+def preprocess_image(image, image_size=IMAGE_SIZE):
+    """Prepare an image like the training pipeline does.
+
+    Parameters
+    ----------
+    image : str, bytes or numpy.ndarray
+        Path to an image, encoded image bytes, or BGR image as read by cv2.
+    image_size : tuple, optional
+        (width, height) of the model input.
+
+    Returns
+    -------
+    numpy.ndarray
+        (H, W, 3) RGB float32 image rescaled to [0, 1].
+
+    Raises
+    ------
+    ValueError
+        If the image can not be decoded or holds no brain contour.
+    """
+    if isinstance(image, str):
+        image = cv2.imread(image)
+    elif isinstance(image, bytes):
+        image = cv2.imdecode(np.frombuffer(image, dtype=np.uint8),
+                             cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('The image could not be decoded')
+    try:
+        image = crop_brain_contour(image)
+        image = cv2.resize(image, dsize=image_size,
+                           interpolation=INTERPOLATION)
+    except (ValueError, cv2.error):
+        # No contour at all, or an empty crop of a blank scan
+        raise ValueError('No brain contour found in the image') from None
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return image.astype(np.float32) / 255.
+
+
+def expand_inputs(inputs):
+    """Flatten paths, directories and arrays into a list of single images.
+
+    Parameters
+    ----------
+    inputs : str, numpy.ndarray or list
+        Image path, directory of images, BGR image, (N, H, W, 3) stack of BGR
+        images, or a list of any of them. Only the files with an
+        IMAGE_EXTENSIONS extension of a directory are kept.
+
+    Returns
+    -------
+    list
+        Image paths, encoded bytes and BGR arrays.
+    """
+    if isinstance(inputs, (str, bytes)):
+        inputs = [inputs]
+    elif isinstance(inputs, np.ndarray):
+        inputs = [inputs] if inputs.ndim == 3 else list(inputs)
+
+    images = []
+    for item in inputs:
+        if isinstance(item, str) and os.path.isdir(item):
+            images.extend(os.path.join(item, file_name)
+                          for file_name in sorted(os.listdir(item))
+                          if file_name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            images.append(item)
+    return images
+
+
+def load_model(model_dir=MODEL_DIR):
+    """Load the SavedModel of the classifier.
+
+    Parameters
+    ----------
+    model_dir : str, optional
+        Path to a SavedModel version directory.
+
+    Returns
+    -------
+    tf.keras.Model
+        Loaded model.
+    """
+    return tf.keras.models.load_model(model_dir, compile=False)
+
+
+def completed_future(value):
+    """Future already holding a result."""
+    future = Future()
+    future.set_result(value)
+    return future
+
+
+class Predictor:
+    """Batch predictor with adaptive micro-batching.
+
+    Requests are preprocessed on a thread pool as soon as they are submitted,
+    while a single model thread groups them into micro-batches. A batch is
+    run when it reaches max_batch_size or when its oldest request has waited
+    max_latency seconds, so decoding and cropping overlap the forward passes.
+
+    Parameters
+    ----------
+    model_dir : str, optional
+        Path to a SavedModel version directory.
+    max_batch_size : int, optional
+        Largest number of images per forward pass.
+    max_latency : float, optional
+        Longest time in seconds a request waits for its batch to fill.
+    n_workers : int, optional
+        Number of preprocessing threads.
+    model : tf.keras.Model, optional
+        Already loaded model, model_dir is ignored when it is given.
+    cache : src.models.prediction_cache.PredictionCache, optional
+        Cache of the predictions, bound to the model version by the caller.
+        Cached images skip the preprocessing and the model.
+    """
+
+    def __init__(self, model_dir=MODEL_DIR, max_batch_size=32,
+                 max_latency=0.01, n_workers=4, model=None, cache=None):
+        self.model = model if model is not None else load_model(model_dir)
+        self.cache = cache
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self._requests = queue.Queue()
+        self._preprocess_pool = ThreadPoolExecutor(max_workers=n_workers)
+        self._model_thread = threading.Thread(target=self._run, daemon=True)
+        self._model_thread.start()
+
+    def submit(self, image):
+        """Queue a single image for prediction.
+
+        Parameters
+        ----------
+        image : str, bytes or numpy.ndarray
+            Path to an image, encoded image bytes, or BGR image.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future of the (2,) class probabilities.
+        """
+        key, probabilities = self.lookup(image)
+        if probabilities is not None:
+            return completed_future(probabilities)
+        return self.submit_preprocessed(
+            self._preprocess_pool.submit(preprocess_image, image), key)
+
+    def lookup(self, image):
+        """Look up the cached prediction of an image.
+
+        Parameters
+        ----------
+        image : str, bytes or numpy.ndarray
+            Path to an image, encoded image bytes, or image array.
+
+        Returns
+        -------
+        tuple
+            Cache key of the image and its cached probabilities, None for
+            both without a cache and for the probabilities on a miss.
+        """
+        if self.cache is None:
+            return None, None
+        key = self.cache.key(image)
+        return key, self.cache.get(key)
+
+    def submit_preprocessed(self, image, key=None):
+        """Queue an already preprocessed image for prediction.
+
+        Parameters
+        ----------
+        image : numpy.ndarray or concurrent.futures.Future
+            (H, W, 3) model input, or a future of it.
+        key : str, optional
+            Cache key from lookup, the prediction is cached under it.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future of the (2,) class probabilities.
+        """
+        if not isinstance(image, Future):
+            image = completed_future(image)
+        result = Future()
+        if key is not None and self.cache is not None:
+            def cache_result(future):
+                if future.exception() is None:
+                    self.cache.put(key, future.result())
+
+            # Runs on the model thread, put only touches the memory tier there
+            result.add_done_callback(cache_result)
+        self._requests.put((time.perf_counter(), image, result))
+        return result
+
+    def reload(self, model_dir):
+        """Switch to another model version, clearing the cache.
+
+        Parameters
+        ----------
+        model_dir : str
+            Path to the new SavedModel version directory.
+        """
+        # Batches already running finish with the previous model
+        self.model = load_model(model_dir)
+        if self.cache is not None:
+            self.cache.set_model(model_dir)
+
+    def _next_batch(self):
+        request = self._requests.get()
+        if request is None:
+            return None
+        batch = [request]
+        deadline = request[0] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    request = self._requests.get(timeout=timeout)
+                else:
+                    request = self._requests.get_nowait()
+            except queue.Empty:
+                break
+            if request is None:
+                self._requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        images, results = [], []
+        for _, image, result in batch:
+            try:
+                images.append(image.result())
+                results.append(result)
+            except Exception as error:
+                result.set_exception(error)
+        if not images:
+            return
+        try:
+            # Runs for every batch, only the cheap clocks are read
+            with stage('inference', resources=False):
+                probabilities = self.model(np.stack(images),
+                                           training=False).numpy()
+                count_items(len(images))
+        except Exception as error:
+            for result in results:
+                result.set_exception(error)
+            return
+        for result, probability in zip(results, probabilities):
+            result.set_result(probability)
+
+    def predict(self, inputs):
+        """Predict the class of one or many images.
+
+        Parameters
+        ----------
+        inputs : str, numpy.ndarray or list
+            Image path, directory of images, BGR image, (N, H, W, 3) stack of
+            BGR images, or a list of any of them.
+
+        Returns
+        -------
+        tuple
+            List of predicted class names and (N, 2) array of probabilities.
+            An image that can not be predicted, e.g. an unreadable file, is
+            logged and gets a None label and NaN probabilities.
+        """
+        images = expand_inputs(inputs)
+        futures = [self.submit(image) for image in images]
+        probabilities = np.full((len(futures), len(CLASS_NAMES)), np.nan,
+                                dtype=np.float32)
+        labels = [None] * len(futures)
+        for index, (image, future) in enumerate(zip(images, futures)):
+            try:
+                probabilities[index] = future.result()
+            except Exception as error:
+                logging.getLogger(__name__).error(
+                    'can not predict %s: %s',
+                    image if isinstance(image, str) else f'image {index}',
+                    error)
+                continue
+            labels[index] = CLASS_NAMES[probabilities[index].argmax()]
+        return labels, probabilities
+
+    def close(self):
+        """Stop the model thread and the preprocessing pool."""
+        self._requests.put(None)
+        self._model_thread.join()
+        self._preprocess_pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def benchmark_batch_sizes(model=None, batch_sizes=(1, 2, 4, 8, 16, 32),
+                          n_images=64, image_size=IMAGE_SIZE):
+    """Measure the model throughput for several batch sizes on random inputs.
+
+    Parameters
+    ----------
+    model : tf.keras.Model, optional
+        Model to time, the production model by default.
+    batch_sizes : tuple, optional
+        Batch sizes to time.
+    n_images : int, optional
+        Number of images run per batch size.
+    image_size : tuple, optional
+        (width, height) of the model input.
+
+    Returns
+    -------
+    dict
+        Images per second by batch size.
+    """
+    if model is None:
+        model = load_model()
+    rng = np.random.default_rng(0)
+    results = {}
+    for batch_size in batch_sizes:
+        batch = rng.random((batch_size, image_size[1], image_size[0], 3),
+                           dtype=np.float32)
+        model(batch, training=False)  # warm up
+        n_batches = max(1, n_images // batch_size)
+        start_time = time.perf_counter()
+        for _ in range(n_batches):
+            model(batch, training=False).numpy()
+        elapsed = time.perf_counter() - start_time
+        results[batch_size] = n_batches * batch_size / elapsed
+    return results
+
+
+@click.command()
+@click.argument('inputs', nargs=-1, type=click.Path(exists=True))
+@click.option('--model-dir', default=MODEL_DIR, show_default=True,
+              type=click.Path(exists=True))
+@click.option('--max-batch-size', default=32, show_default=True)
+@click.option('--benchmark', is_flag=True,
+              help='Time the model throughput against batch size.')
+@click.option('--cache-dir', type=click.Path(),
+              help='On-disk prediction cache reused across runs.')
+def main(inputs, model_dir, max_batch_size, benchmark, cache_dir):
+    """ Predicts whether the images or directories of images given in INPUTS
+        show a brain tumor.
+    """
+    logger = logging.getLogger(__name__)
+    if benchmark:
+        results = benchmark_batch_sizes(load_model(model_dir))
+        for batch_size, images_per_second in results.items():
+            logger.info('batch size %d: %.1f images/s', batch_size,
+                        images_per_second)
+        return
+
+    images = expand_inputs(list(inputs))
+    cache = None
+    if cache_dir is not None:
+        from src.models.prediction_cache import PredictionCache
+
+        cache = PredictionCache(model_dir, cache_dir=cache_dir)
+    with Predictor(model_dir, max_batch_size=max_batch_size,
+                   cache=cache) as predictor:
+        labels, probabilities = predictor.predict(images)
+    if cache is not None:
+        cache.close()
+        logger.info('prediction cache: %s', cache.stats())
+    for image, label, probability in zip(images, labels, probabilities):
+        if label is not None:
+            click.echo(f'{image}\t{label}\t{probability.max():.4f}')
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
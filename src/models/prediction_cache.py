@@ -0,0 +1,321 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from src.utils.data_processing import CROP_THRESHOLD, IMAGE_SIZE, INTERPOLATION
+
+# Everything preprocess_image depends on besides the image itself
+PREPROCESSING_CONFIG = {'image_size': list(IMAGE_SIZE),
+                        'interpolation': INTERPOLATION,
+                        'crop_threshold': CROP_THRESHOLD,
+                        'color': 'RGB',
+                        'scale': 1. / 255.}
+ENTRY_EXTENSION = '.f32'
+
+
+def model_fingerprint(model_dir):
+    """Identify a deployed model version.
+
+    Parameters
+    ----------
+    model_dir : str
+        Path to a SavedModel version directory, e.g. '.../MRI_validator/0001'.
+
+    Returns
+    -------
+    str
+        Version directory name, with the size and mtime of its saved_model.pb
+        so that a version overwritten in place is also told apart.
+    """
+    version = os.path.basename(os.path.normpath(model_dir))
+    try:
+        stat = os.stat(os.path.join(model_dir, 'saved_model.pb'))
+    except OSError:
+        return version
+    return f'{version}-{stat.st_size}-{stat.st_mtime_ns}'
+
+
+def _is_namespace(name):
+    return len(name) == 16 and all(character in '0123456789abcdef'
+                                   for character in name)
+
+
+def _disk_entries(cache_dir):
+    """Entry files of every namespace of cache_dir, with their mtime."""
+    entries = []
+    for name in os.listdir(cache_dir):
+        namespace_dir = os.path.join(cache_dir, name)
+        if not _is_namespace(name) or not os.path.isdir(namespace_dir):
+            continue
+        for root, _, file_names in os.walk(namespace_dir):
+            for file_name in file_names:
+                if file_name.endswith(ENTRY_EXTENSION):
+                    path = os.path.join(root, file_name)
+                    try:
+                        entries.append((os.stat(path).st_mtime, path))
+                    except OSError:
+                        # Removed by another process meanwhile
+                        pass
+    return entries
+
+
+class PredictionCache:
+    """Content addressed cache of class probabilities.
+
+    Entries are keyed by the hash of the image content, the model version and
+    the preprocessing config. Recent entries live in an in-memory LRU, and
+    optionally in an on-disk tier shared across restarts and processes.
+    Switching to another model version with set_model clears the memory
+    tier. The entries of other versions are left on disk, where processes
+    still serving them can use them, and the least recently used entries of
+    every version are evicted once the disk tier holds max_disk_entries.
+
+    Parameters
+    ----------
+    model_dir : str
+        Path to the SavedModel version directory whose predictions are cached.
+    max_entries : int, optional
+        Capacity of the in-memory tier.
+    cache_dir : str, optional
+        Directory of the on-disk tier, no disk tier if None.
+    max_disk_entries : int, optional
+        Capacity of the on-disk tier, across all model versions.
+    preprocessing : dict, optional
+        Preprocessing config, part of every key.
+    """
+
+    def __init__(self, model_dir, max_entries=10000, cache_dir=None,
+                 max_disk_entries=100000, preprocessing=PREPROCESSING_CONFIG):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.preprocessing = preprocessing
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self.clears = 0
+        self.model_fingerprint = None
+        self._namespace = None
+        # Keys in least to most recently used order
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_count = 0
+        # Disk writes are kept off the threads that call put
+        self._writer = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._disk_count = len(_disk_entries(cache_dir))
+            self._writer = ThreadPoolExecutor(max_workers=1)
+        self.set_model(model_dir)
+
+    def set_model(self, model_dir):
+        """Bind the cache to a model version, cleared if the version changed.
+
+        Parameters
+        ----------
+        model_dir : str
+            Path to the SavedModel version directory now serving.
+
+        Returns
+        -------
+        bool
+            True if the cache was cleared.
+        """
+        fingerprint = model_fingerprint(model_dir)
+        with self._lock:
+            if fingerprint == self.model_fingerprint:
+                return False
+            cleared = self.model_fingerprint is not None
+            self.clears += cleared
+            self._entries.clear()
+            self.model_fingerprint = fingerprint
+            self._namespace = hashlib.sha256(json.dumps(
+                {'model': fingerprint, 'preprocessing': self.preprocessing},
+                sort_keys=True).encode()).hexdigest()
+        return cleared
+
+    def _disk_path(self, key):
+        # Keys start with their namespace so that an entry put while the
+        # model changes still lands in the namespace it was computed for
+        namespace, key = key.split(':')
+        return os.path.join(self.cache_dir, namespace, key[:2],
+                            key + ENTRY_EXTENSION)
+
+    def key(self, image):
+        """Build the cache key of an image.
+
+        Parameters
+        ----------
+        image : str, bytes or numpy.ndarray
+            Path to an image, encoded image bytes, or decoded image array.
+
+        Returns
+        -------
+        str
+            Namespace and content hash of the image.
+        """
+        namespace = self._namespace
+        digest = hashlib.sha256(namespace.encode())
+        if isinstance(image, str):
+            with open(image, 'rb') as image_file:
+                for block in iter(lambda: image_file.read(1 << 20), b''):
+                    digest.update(block)
+        elif isinstance(image, bytes):
+            digest.update(image)
+        else:
+            image = np.ascontiguousarray(image)
+            # Arrays never share a key with encoded files
+            digest.update(f'array:{image.dtype.str}:{image.shape}'.encode())
+            digest.update(image.data)
+        return f'{namespace[:16]}:{digest.hexdigest()}'
+
+    def get(self, key):
+        """Look up the probabilities of an image.
+
+        Parameters
+        ----------
+        key : str
+            Cache key of the image.
+
+        Returns
+        -------
+        numpy.ndarray or None
+            Read-only (2,) class probabilities, None on a miss.
+        """
+        with self._lock:
+            probabilities = self._entries.get(key)
+            if probabilities is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return probabilities
+        if self.cache_dir is not None:
+            path = self._disk_path(key)
+            try:
+                probabilities = np.fromfile(path, dtype=np.float32)
+            except (OSError, ValueError):
+                probabilities = None
+            if probabilities is not None and probabilities.size:
+                self._remember(key, probabilities)
+                with self._lock:
+                    self.disk_hits += 1
+                # Recently used entries are evicted last
+                self._writer.submit(_touch, path)
+                return probabilities
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key, probabilities):
+        probabilities.flags.writeable = False
+        with self._lock:
+            self._entries[key] = probabilities
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def put(self, key, probabilities):
+        """Store the probabilities of an image.
+
+        The disk tier is written in the background.
+
+        Parameters
+        ----------
+        key : str
+            Cache key of the image.
+        probabilities : numpy.ndarray
+            (2,) class probabilities.
+        """
+        probabilities = np.array(probabilities, dtype=np.float32)
+        self._remember(key, probabilities)
+        if self.cache_dir is not None:
+            self._writer.submit(self._write, key, probabilities)
+
+    def _write(self, key, probabilities):
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        probabilities.tofile(temporary_path)
+        os.replace(temporary_path, path)
+        self._disk_count += 1
+        if self._disk_count > self.max_disk_entries:
+            # Evict a tenth at once rather than rescanning on every write
+            self.prune(int(self.max_disk_entries * 0.9))
+
+    def prune(self, max_disk_entries=0):
+        """Evict the least recently used disk entries of every model version.
+
+        Parameters
+        ----------
+        max_disk_entries : int, optional
+            Number of entries to keep, 0 empties the disk tier.
+
+        Returns
+        -------
+        int
+            Number of removed entries.
+        """
+        if self.cache_dir is None:
+            return 0
+        entries = sorted(_disk_entries(self.cache_dir))
+        removed = 0
+        for _, path in entries[:max(0, len(entries) - max_disk_entries)]:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        with self._lock:
+            self.disk_evictions += removed
+        self._disk_count = len(entries) - removed
+        return removed
+
+    def close(self):
+        """Finish the pending disk writes."""
+        if self._writer is not None:
+            self._writer.shutdown()
+
+    def stats(self):
+        """Hit-rate metrics of the cache.
+
+        Returns
+        -------
+        dict
+            Memory and disk hits, misses, memory and disk evictions, clears,
+            entries in memory and hit rate.
+        """
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            hits = self.hits + self.disk_hits
+            hit_rate = hits / lookups if lookups else 0.
+            return {'hits': self.hits, 'disk_hits': self.disk_hits,
+                    'misses': self.misses, 'evictions': self.evictions,
+                    'disk_evictions': self.disk_evictions,
+                    'clears': self.clears, 'entries': len(self._entries),
+                    'hit_rate': hit_rate}
+
+    def prometheus_metrics(self, prefix='brain_tumor_prediction_cache'):
+        """Format the cache metrics in the Prometheus text format."""
+        stats = self.stats()
+        lines = []
+        for field in ['hits', 'disk_hits', 'misses', 'evictions',
+                      'disk_evictions', 'clears']:
+            lines += [f'# TYPE {prefix}_{field}_total counter',
+                      f'{prefix}_{field}_total {stats[field]}']
+        for field in ['entries', 'hit_rate']:
+            lines += [f'# TYPE {prefix}_{field} gauge',
+                      f'{prefix}_{field} {stats[field]}']
+        return '\n'.join(lines) + '\n'
+
+
+def _touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
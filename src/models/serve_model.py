@@ -0,0 +1,301 @@
+import os
+import re
+import json
+import base64
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import click
+import numpy as np
+from src.models.predict_model import (MODEL_DIR, Predictor, completed_future,
+                                      load_model, preprocess_image)
+from src.utils.data_processing import IMAGE_SIZE
+from src.models.prediction_cache import PredictionCache
+from src.utils.time_utils import prometheus_metrics
+
+# Name the Dockerfile serves the model under
+MODEL_NAME = 'brain_tumor_validator'
+_MODEL_PATH = r'^/v1/models/(?P<name>[^/:]+)(/versions/(?P<version>\d+))?'
+_PREDICT_PATH = re.compile(_MODEL_PATH + r':predict$')
+_STATUS_PATH = re.compile(_MODEL_PATH + r'$')
+# Path of the Prometheus endpoint of tensorflow_model_server
+METRICS_PATH = '/monitoring/prometheus/metrics'
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    """Request handler following the TF Serving REST API.
+
+    Serves 'GET /v1/models/<name>' and 'POST /v1/models/<name>:predict' with
+    a row ('instances') or columnar ('inputs') JSON body. Instances are either
+    preprocessed (H, W, 3) float tensors or {'b64': ...} encoded JPEG/PNG
+    files. A raw 'image/*' body is a single encoded instance. The stage
+    metrics of src.utils.time_utils and the prediction cache metrics are
+    exposed on METRICS_PATH.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, avoid the delayed ACK stall
+    disable_nagle_algorithm = True
+
+    def _send_json(self, status, payload):
+        self._send_body(status, json.dumps(payload).encode(),
+                        'application/json')
+
+    def _send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _check_model(self, match):
+        version = match and match.group('version')
+        served = int(self.server.model_version)
+        if (match is None or match.group('name') != self.server.model_name
+                or version is not None and int(version) != served):
+            self._send_json(404, {'error': 'Servable not found for request: '
+                                           + self.path})
+            return False
+        return True
+
+    def do_GET(self):
+        if self.path == METRICS_PATH:
+            metrics = prometheus_metrics()
+            if self.server.cache is not None:
+                metrics += self.server.cache.prometheus_metrics()
+            self._send_body(200, metrics.encode(),
+                            'text/plain; version=0.0.4')
+            return
+        if not self._check_model(_STATUS_PATH.match(self.path)):
+            return
+        self._send_json(200, {'model_version_status': [{
+            'version': self.server.model_version,
+            'state': 'AVAILABLE',
+            'status': {'error_code': 'OK', 'error_message': ''}}]})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self._check_model(_PREDICT_PATH.match(self.path)):
+            return
+        try:
+            if self.headers.get('Content-Type', '').startswith('image/'):
+                encoded = base64.b64encode(body).decode()
+                request = {'instances': [{'b64': encoded}]}
+            else:
+                request = json.loads(body)
+            if 'instances' in request:
+                instances = request['instances']
+            elif 'inputs' in request:
+                instances = request['inputs']
+            else:
+                raise ValueError("Missing 'instances' or 'inputs' key")
+            predictions = self.server.predict(instances)
+        except (ValueError, TypeError, KeyError,
+                base64.binascii.Error) as error:
+            self._send_json(400, {'error': str(error)})
+            return
+        key = 'predictions' if 'instances' in request else 'outputs'
+        self._send_json(200, {key: predictions})
+
+    def log_message(self, format, *args):
+        logging.getLogger(__name__).debug(format, *args)
+
+
+class PredictionServer(ThreadingHTTPServer):
+    """In-process stand-in for tensorflow_model_server running on CPU.
+
+    Encoded images are cropped and resized with the training preprocessing
+    on a process pool, and the instances of concurrent requests are merged
+    into micro-batches before they reach the model. Predictions can be
+    cached by image content, and a newer numeric version directory next to
+    model_dir is picked up while serving, which clears the cache.
+
+    Parameters
+    ----------
+    server_address : tuple
+        (host, port) to listen on, port 0 picks a free port.
+    model_dir : str, optional
+        Path to a SavedModel version directory.
+    model_name : str, optional
+        Name the model is served under.
+    max_batch_size : int, optional
+        Largest number of instances per forward pass.
+    max_latency : float, optional
+        Longest time in seconds an instance waits for its batch to fill.
+    n_workers : int, optional
+        Number of preprocessing processes, None uses every available core.
+    cache_entries : int, optional
+        Capacity of the in-memory prediction cache, no cache if 0 and
+        cache_dir is None.
+    cache_dir : str, optional
+        Directory of the on-disk prediction cache, memory only if None.
+    watch_interval : float, optional
+        Seconds between checks for a newer model version, never checked if
+        None.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, server_address, model_dir=MODEL_DIR,
+                 model_name=MODEL_NAME, max_batch_size=32, max_latency=0.005,
+                 n_workers=None,
+                 handler_class=PredictionHandler, cache_entries=0,
+                 cache_dir=None, watch_interval=None):
+        self.model = load_model(model_dir)
+        self.model_dir = model_dir
+        self.model_name = model_name
+        self.model_version = _version(model_dir)
+        self.cache = None
+        if cache_entries or cache_dir is not None:
+            self.cache = PredictionCache(model_dir,
+                                         max_entries=cache_entries,
+                                         cache_dir=cache_dir)
+        self.predictor = Predictor(model=self.model,
+                                   max_batch_size=max_batch_size,
+                                   max_latency=max_latency, n_workers=1,
+                                   cache=self.cache)
+        # TF is loaded and the batching thread runs, forking could deadlock
+        self.preprocess_pool = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context('spawn'))
+        self._stop_watching = threading.Event()
+        if watch_interval:
+            threading.Thread(target=self._watch, args=(watch_interval,),
+                             daemon=True).start()
+        super().__init__(server_address, handler_class)
+
+    def reload(self, model_dir):
+        """Serve another model version, clearing the prediction cache.
+
+        Parameters
+        ----------
+        model_dir : str
+            Path to the new SavedModel version directory.
+        """
+        self.predictor.reload(model_dir)
+        self.model = self.predictor.model
+        self.model_dir = model_dir
+        self.model_version = _version(model_dir)
+
+    def _watch(self, interval):
+        logger = logging.getLogger(__name__)
+        while not self._stop_watching.wait(interval):
+            try:
+                base_dir = os.path.dirname(os.path.normpath(self.model_dir))
+                model_dir = latest_version(base_dir)
+                if (model_dir is not None
+                        and _version(model_dir) != self.model_version):
+                    logger.info('new model version %s', model_dir)
+                    self.reload(model_dir)
+            except Exception:
+                # Keep the current version, e.g. while the new one is written
+                logger.exception('failed to reload the model')
+
+    def predict(self, instances):
+        """Run the model on a list of instances.
+
+        Parameters
+        ----------
+        instances : list
+            (H, W, 3) nested lists of floats, or {'b64': ...} encoded
+            images.
+
+        Returns
+        -------
+        list
+            (N, 2) nested lists of class probabilities.
+        """
+        futures = []
+        for instance in instances:
+            if isinstance(instance, dict):
+                image = base64.b64decode(instance['b64'], validate=True)
+            else:
+                image = np.asarray(instance, dtype=np.float32)
+                # A wrong shape would fail the whole micro-batch, with the
+                # requests of other clients
+                shape = (IMAGE_SIZE[1], IMAGE_SIZE[0], 3)
+                if image.shape != shape:
+                    raise ValueError(f'Expected {shape} instances, got shape '
+                                     f'{image.shape}')
+            key, probabilities = self.predictor.lookup(image)
+            if probabilities is not None:
+                futures.append(completed_future(probabilities))
+            elif isinstance(image, bytes):
+                futures.append(self.predictor.submit_preprocessed(
+                    self.preprocess_pool.submit(preprocess_image, image), key))
+            else:
+                futures.append(
+                    self.predictor.submit_preprocessed(image, key))
+        return [future.result().tolist() for future in futures]
+
+    def server_close(self):
+        self._stop_watching.set()
+        super().server_close()
+        self.predictor.close()
+        self.preprocess_pool.shutdown()
+        if self.cache is not None:
+            self.cache.close()
+
+
+def _version(model_dir):
+    """Version number of a SavedModel directory, as TF Serving reports it."""
+    return os.path.basename(os.path.normpath(model_dir)).lstrip('0') or '0'
+
+
+def latest_version(base_dir):
+    """Newest numeric SavedModel version directory of base_dir, or None."""
+    versions = [name for name in os.listdir(base_dir) if name.isdigit()
+                and os.path.isfile(os.path.join(base_dir, name,
+                                                'saved_model.pb'))]
+    if not versions:
+        return None
+    return os.path.join(base_dir, max(versions, key=int))
+
+
+@click.command()
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', type=int,
+              default=lambda: int(os.environ.get('PORT', 8501)),
+              help='Port of the REST API, $PORT or 8501 by default.')
+@click.option('--model-dir', default=MODEL_DIR, show_default=True,
+              type=click.Path(exists=True))
+@click.option('--model-name', default=MODEL_NAME, show_default=True)
+@click.option('--max-batch-size', default=32, show_default=True)
+@click.option('--max-latency', default=0.005, show_default=True,
+              help='Seconds a request waits for its batch.')
+@click.option('--workers', type=int,
+              help='Preprocessing processes, every core by default.')
+@click.option('--cache-entries', default=0, show_default=True,
+              help='Predictions cached in memory, no cache if 0.')
+@click.option('--cache-dir', type=click.Path(),
+              help='On-disk prediction cache, memory only by default.')
+@click.option('--watch-interval', type=float,
+              help='Seconds between checks for a newer model version.')
+def main(host, port, model_dir, model_name, max_batch_size, max_latency,
+         workers, cache_entries, cache_dir, watch_interval):
+    """ Serves the model through the TF Serving REST API on CPU.
+    """
+    logger = logging.getLogger(__name__)
+    server = PredictionServer((host, port), model_dir, model_name,
+                              max_batch_size, max_latency, workers,
+                              cache_entries=cache_entries,
+                              cache_dir=cache_dir,
+                              watch_interval=watch_interval)
+    logger.info('serving %s on http://%s:%d/v1/models/%s', model_dir, host,
+                server.server_port, model_name)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,629 @@
+import os
+import sys
+import json
+import math
+import time
+import socket
+import logging
+import tempfile
+import subprocess
+
+import click
+import numpy as np
+import tensorflow as tf
+from src.features.build_features import (CLASS_NAMES, IMAGE_SIZE,
+                                         TRAIN_AUGMENTATION, list_image_files,
+                                         make_dataset, make_datasets)
+from src.utils.augmentation import apply_transforms, sample_transforms
+
+FEATURES_FILE = 'features.f16'
+FEATURES_INDEX_FILE = 'index.json'
+STRATEGIES = ['default', 'mirrored', 'multi_worker']
+# Layers fine-tuned in the second stage, with every layer after them
+FINE_TUNED_LAYERS = ['block5_conv3', 'block5_conv4']
+
+
+def build_backbone(image_size=IMAGE_SIZE, weights='imagenet'):
+    """Build the VGG19 convolutional backbone.
+
+    Parameters
+    ----------
+    image_size : tuple, optional
+        (height, width) of the input images.
+    weights : str, optional
+        'imagenet' or None.
+
+    Returns
+    -------
+    tf.keras.Model
+        VGG19 without its classifier, its output is block5_pool.
+    """
+    return tf.keras.applications.VGG19(input_shape=tuple(image_size) + (3,),
+                                       include_top=False,
+                                       weights=weights)
+
+
+def build_head(feature_shape):
+    """Build the dense classifier put on top of the backbone.
+
+    Parameters
+    ----------
+    feature_shape : tuple
+        Shape of the backbone output, e.g. (7, 7, 512).
+
+    Returns
+    -------
+    tf.keras.Model
+        Flatten -> Dense(4608) -> Dropout(0.2) -> Dense(1152) -> Dense(2).
+    """
+    return tf.keras.Sequential([
+        tf.keras.layers.Flatten(input_shape=tuple(feature_shape)),
+        tf.keras.layers.Dense(4608, activation='relu'),
+        tf.keras.layers.Dropout(0.2),
+        tf.keras.layers.Dense(1152, activation='relu'),
+        # Keep the softmax in float32 under mixed precision
+        tf.keras.layers.Dense(len(CLASS_NAMES), activation='softmax',
+                              dtype='float32'),
+    ], name='head')
+
+
+def attach_head(backbone, head):
+    """Put a head on a backbone into a single end-to-end model.
+
+    Parameters
+    ----------
+    backbone : tf.keras.Model
+        Convolutional backbone.
+    head : tf.keras.Model
+        Dense classifier taking the backbone output.
+
+    Returns
+    -------
+    tf.keras.Model
+        Model from images to class probabilities.
+    """
+    return tf.keras.Model(backbone.inputs, head(backbone.output))
+
+
+def build_feature_store(backbone, split_dir, store_dir, n_augmentations=0,
+                        seed=0, batch_size=32, policy=TRAIN_AUGMENTATION):
+    """Run the frozen backbone once per (image, augmentation), store features.
+
+    Augmentation k > 0 of an image is drawn from (file name, k, seed) only,
+    see src.utils.augmentation.sample_transforms, so a store can be rebuilt
+    or extended identically. Augmentation 0 is the image itself.
+
+    Parameters
+    ----------
+    backbone : tf.keras.Model
+        Frozen convolutional backbone.
+    split_dir : str
+        Processed split directory containing the 'no' and 'yes' classes.
+    store_dir : str
+        Directory of the memory-mapped feature store.
+    n_augmentations : int, optional
+        Number of augmented copies of every image.
+    seed : int, optional
+        Seed of the augmentations.
+    batch_size : int, optional
+        Number of images per backbone call.
+    policy : dict, optional
+        Augmentation policy with ImageDataGenerator argument names.
+
+    Returns
+    -------
+    int
+        Number of stored feature maps.
+    """
+    paths, labels = list_image_files(split_dir)
+    keys = [os.path.basename(path) for path in paths]
+    feature_shape = tuple(backbone.output_shape[1:])
+    n_images = len(paths)
+    shape = (n_images * (n_augmentations + 1),) + feature_shape
+
+    os.makedirs(store_dir, exist_ok=True)
+    # The index is written last, a store is only complete once it exists
+    if os.path.isfile(os.path.join(store_dir, FEATURES_INDEX_FILE)):
+        os.remove(os.path.join(store_dir, FEATURES_INDEX_FILE))
+    features = np.memmap(os.path.join(store_dir, FEATURES_FILE),
+                         dtype=np.float16, mode='w+',
+                         shape=shape) if shape[0] else None
+    position = 0
+    for images, _ in make_dataset(split_dir,
+                                  image_size=backbone.input_shape[1:3],
+                                  batch_size=batch_size):
+        images = images.numpy()
+        batch_keys = keys[position:position + len(images)]
+        for augmentation in range(n_augmentations + 1):
+            batch = images
+            if augmentation:
+                draws = [sample_transforms(key, augmentation, seed, policy)
+                         for key in batch_keys]
+                batch = apply_transforms(images, {
+                    name: np.concatenate([draw[name] for draw in draws])
+                    for name in draws[0]})
+            start = augmentation * n_images + position
+            features[start:start + len(batch)] = backbone(
+                batch, training=False).numpy()
+        position += len(images)
+    if features is not None:
+        features.flush()
+        del features
+
+    with open(os.path.join(store_dir, FEATURES_INDEX_FILE), 'w') as index_file:
+        json.dump({'shape': list(shape),
+                   'labels': labels * (n_augmentations + 1),
+                   'keys': keys,
+                   'n_augmentations': n_augmentations,
+                   'seed': seed}, index_file)
+    return shape[0]
+
+
+def feature_store_matches(store_dir, split_dir, n_augmentations=0, seed=0):
+    """Check whether a feature store was built from a split with these options.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory written by build_feature_store.
+    split_dir : str
+        Processed split directory the store should hold.
+    n_augmentations : int, optional
+        Number of augmented copies of every image.
+    seed : int, optional
+        Seed of the augmentations.
+
+    Returns
+    -------
+    bool
+        False if the store is missing or incomplete, or was built with other
+        options or other source files.
+    """
+    try:
+        with open(os.path.join(store_dir, FEATURES_INDEX_FILE)) as index_file:
+            index = json.load(index_file)
+    except (OSError, ValueError):
+        return False
+    paths, labels = list_image_files(split_dir)
+    # The seed only matters to the augmented copies
+    return (index.get('n_augmentations') == n_augmentations
+            and (not n_augmentations or index.get('seed') == seed)
+            and index.get('keys') == [os.path.basename(path) for path in paths]
+            and index.get('labels', [])[:len(labels)] == labels)
+
+
+def load_feature_store(store_dir):
+    """Open a feature store without reading it into memory.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory written by build_feature_store.
+
+    Returns
+    -------
+    tuple
+        Memory-mapped (N, 7, 7, 512) float16 features and (N,) labels.
+    """
+    with open(os.path.join(store_dir, FEATURES_INDEX_FILE)) as index_file:
+        index = json.load(index_file)
+    features = np.memmap(os.path.join(store_dir, FEATURES_FILE),
+                         dtype=np.float16, mode='r',
+                         shape=tuple(index['shape']))
+    return features, np.array(index['labels'], dtype=int)
+
+
+class FeatureSequence(tf.keras.utils.Sequence):
+    """Batches of cached features read from a memory-mapped store.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory written by build_feature_store.
+    batch_size : int, optional
+        Number of feature maps per batch.
+    shuffle : bool, optional
+        Whether to visit the batches in a new random order every epoch.
+    seed : int, optional
+        Seed of the shuffle.
+    """
+
+    def __init__(self, store_dir, batch_size=32, shuffle=True, seed=None):
+        super().__init__()
+        self.features, labels = load_feature_store(store_dir)
+        self.labels = np.eye(len(CLASS_NAMES), dtype=np.float32)[labels]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self._rng = np.random.default_rng(seed)
+        self._order = np.arange(len(self.features))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return math.ceil(len(self.features) / self.batch_size)
+
+    def __getitem__(self, index):
+        # Sorted indices keep the memmap reads sequential within a batch
+        start = index * self.batch_size
+        indices = np.sort(self._order[start:start + self.batch_size])
+        return self.features[indices].astype(np.float32), self.labels[indices]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._rng.shuffle(self._order)
+
+
+def train_head(train_store, validation_store=None, epochs=20, batch_size=32,
+               learning_rate=1e-4, seed=42):
+    """Train the dense head on cached backbone features.
+
+    This replaces the frozen first stage of notebook 4: the backbone is not
+    run at all, so each epoch only costs the dense layers.
+
+    Parameters
+    ----------
+    train_store : str
+        Feature store of the training split.
+    validation_store : str, optional
+        Feature store of the validation split.
+    epochs : int, optional
+        Maximum number of epochs, training stops early on the validation loss.
+    batch_size : int, optional
+        Number of feature maps per batch.
+    learning_rate : float, optional
+        Learning rate of the SGD optimizer.
+    seed : int, optional
+        Seed of the shuffle.
+
+    Returns
+    -------
+    tuple
+        Trained head and its training history.
+    """
+    train_data = FeatureSequence(train_store, batch_size, shuffle=True,
+                                 seed=seed)
+    validation_data = None
+    callbacks = []
+    if validation_store is not None:
+        validation_data = FeatureSequence(validation_store, batch_size,
+                                          shuffle=False)
+        callbacks.append(tf.keras.callbacks.EarlyStopping(
+            monitor='val_loss', mode='min', patience=4,
+            restore_best_weights=True))
+
+    head = build_head(train_data.features.shape[1:])
+    head.compile(loss='categorical_crossentropy',
+                 optimizer=tf.keras.optimizers.SGD(learning_rate=learning_rate,
+                                                   momentum=0.9,
+                                                   nesterov=True),
+                 metrics=['accuracy'])
+    history = head.fit(train_data, epochs=epochs,
+                       validation_data=validation_data,
+                       callbacks=callbacks)
+    return head, history
+
+
+class EpochThroughput(tf.keras.callbacks.Callback):
+    """Record the duration and the images/sec of every training epoch.
+
+    The values are added to the epoch logs, so they end up in the History.
+
+    Parameters
+    ----------
+    batch_size : int
+        Global number of images per training step.
+    """
+
+    def __init__(self, batch_size):
+        super().__init__()
+        self.batch_size = batch_size
+        self._start_time = None
+        self._steps = 0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._start_time = time.perf_counter()
+        self._steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._steps += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_time = time.perf_counter() - self._start_time
+        if logs is not None:
+            logs['epoch_time'] = epoch_time
+            logs['images_per_second'] = (self._steps * self.batch_size
+                                         / epoch_time)
+
+
+def make_strategy(name='default', n_cpu_replicas=2):
+    """Build a tf.distribute strategy.
+
+    Parameters
+    ----------
+    name : str, optional
+        'default' for a single device, 'mirrored' for synchronous replicas in
+        this process, 'multi_worker' for one replica per worker process as
+        described by the TF_CONFIG environment variable.
+    n_cpu_replicas : int, optional
+        Number of logical CPU devices the mirrored strategy splits the CPU
+        into when no GPU is available.
+
+    Returns
+    -------
+    tf.distribute.Strategy
+        Distribution strategy.
+    """
+    if name == 'default':
+        return tf.distribute.get_strategy()
+    if name == 'mirrored':
+        if not tf.config.list_physical_devices('GPU'):
+            cpu = tf.config.list_physical_devices('CPU')[0]
+            tf.config.set_logical_device_configuration(
+                cpu, [tf.config.LogicalDeviceConfiguration()] * n_cpu_replicas)
+            return tf.distribute.MirroredStrategy(
+                [device.name
+                 for device in tf.config.list_logical_devices('CPU')])
+        return tf.distribute.MirroredStrategy()
+    if name == 'multi_worker':
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    raise ValueError(f'Unknown strategy {name!r}, expected one of '
+                     f'{STRATEGIES}')
+
+
+def enable_mixed_precision():
+    """Use mixed precision when the hardware supports it.
+
+    float16 is used on GPUs and bfloat16 on CPUs with native bfloat16
+    support. Nothing changes otherwise.
+
+    Returns
+    -------
+    str
+        Name of the global dtype policy.
+    """
+    if tf.config.list_physical_devices('GPU'):
+        tf.keras.mixed_precision.set_global_policy('mixed_float16')
+    elif _cpu_supports_bfloat16():
+        tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+    return tf.keras.mixed_precision.global_policy().name
+
+
+def _cpu_supports_bfloat16():
+    try:
+        with open('/proc/cpuinfo') as cpuinfo:
+            flags = cpuinfo.read()
+    except OSError:
+        return False
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+
+def _compile(model, learning_rate):
+    model.compile(loss='categorical_crossentropy',
+                  optimizer=tf.keras.optimizers.SGD(
+                      learning_rate=learning_rate, momentum=0.9,
+                      nesterov=True),
+                  metrics=['accuracy'])
+
+
+def _is_chief():
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    task = tf_config.get('task', {})
+    if 'chief' in tf_config.get('cluster', {}):
+        return task.get('type') == 'chief'
+    return task.get('index', 0) == 0
+
+
+def train(data_dir, output_filepath, strategy='default', mixed_precision=False,
+          batch_size=10, frozen_epochs=20, fine_tune_epochs=10,
+          steps_per_epoch=None, seed=42):
+    """Train the classifier with the two-stage flow of notebook 4.
+
+    Stage one trains the head over a frozen VGG19, stage two fine-tunes
+    block5_conv3 and block5_conv4 with a larger learning rate.
+
+    Parameters
+    ----------
+    data_dir : str
+        Processed dataset with 'train' and 'validation' splits.
+    output_filepath : str
+        Path where the trained SavedModel is written.
+    strategy : str, optional
+        'default', 'mirrored' or 'multi_worker', see make_strategy.
+    mixed_precision : bool, optional
+        Whether to train in mixed precision when the hardware supports it.
+    batch_size : int, optional
+        Number of images per step and per replica.
+    frozen_epochs : int, optional
+        Maximum number of epochs of the frozen stage.
+    fine_tune_epochs : int, optional
+        Maximum number of epochs of the fine-tuning stage.
+    steps_per_epoch : int, optional
+        Number of steps per epoch, a full pass over the training split by
+        default.
+    seed : int, optional
+        Seed of the shuffle and augmentation.
+
+    Returns
+    -------
+    dict
+        History of each stage, with the epoch times and images/sec.
+    """
+    logger = logging.getLogger(__name__)
+    distribution = make_strategy(strategy)
+    if mixed_precision:
+        logger.info('dtype policy: %s', enable_mixed_precision())
+    global_batch_size = batch_size * distribution.num_replicas_in_sync
+    datasets = make_datasets(data_dir, batch_size=global_batch_size, seed=seed)
+    train_data = datasets['train']
+    if steps_per_epoch is not None:
+        train_data = train_data.repeat()
+
+    with distribution.scope():
+        backbone = build_backbone()
+        model = attach_head(backbone, build_head(backbone.output_shape[1:]))
+
+    histories = {}
+    stages = [('frozen', frozen_epochs, 1e-4),
+              ('fine_tune', fine_tune_epochs, 1e-3)]
+    for stage, epochs, learning_rate in stages:
+        trainable = False
+        for layer in backbone.layers:
+            trainable = trainable or (stage == 'fine_tune'
+                                      and layer.name in FINE_TUNED_LAYERS)
+            layer.trainable = trainable
+        with distribution.scope():
+            _compile(model, learning_rate)
+        callbacks = [EpochThroughput(global_batch_size),
+                     tf.keras.callbacks.EarlyStopping(monitor='val_loss',
+                                                      mode='min', patience=4),
+                     tf.keras.callbacks.ReduceLROnPlateau(
+                         monitor='val_accuracy', patience=3, factor=0.5,
+                         min_lr=0.0001)]
+        history = model.fit(train_data, epochs=epochs,
+                            steps_per_epoch=steps_per_epoch,
+                            validation_data=datasets['validation'],
+                            callbacks=callbacks)
+        histories[stage] = {name: [float(value) for value in values]
+                            for name, values in history.history.items()}
+        for epoch, (epoch_time, images_per_second) in enumerate(zip(
+                histories[stage]['epoch_time'],
+                histories[stage]['images_per_second'])):
+            logger.info('%s epoch %d: %.1f s, %.1f images/s', stage,
+                        epoch + 1, epoch_time, images_per_second)
+
+    # Every worker has to save, only the chief writes to the real location
+    save_path = output_filepath if _is_chief() else tempfile.mkdtemp()
+    model.save(save_path)
+    history_path = os.path.join(save_path, 'training_history.json')
+    with open(history_path, 'w') as history_file:
+        json.dump(histories, history_file, indent=2)
+    return histories
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def launch_local_workers(n_workers, args):
+    """Run a multi-worker training as local processes.
+
+    Each process gets a TF_CONFIG describing a localhost cluster and runs
+    this module with the given command line arguments.
+
+    Parameters
+    ----------
+    n_workers : int
+        Number of worker processes.
+    args : list
+        Command line arguments of every worker.
+
+    Returns
+    -------
+    int
+        Highest exit code of the workers.
+    """
+    cluster = {'worker': [f'localhost:{_free_port()}'
+                          for _ in range(n_workers)]}
+    processes = []
+    for index in range(n_workers):
+        tf_config = {'cluster': cluster,
+                     'task': {'type': 'worker', 'index': index}}
+        env = dict(os.environ, TF_CONFIG=json.dumps(tf_config))
+        processes.append(subprocess.Popen([sys.executable, '-m',
+                                           'src.models.train_model'] + args,
+                                          env=env))
+    return max(process.wait() for process in processes)
+
+
+@click.group()
+def cli():
+    """ Trains the VGG19 brain tumor classifier.
+    """
+
+
+@cli.command('head')
+@click.argument('data_dir', type=click.Path(exists=True))
+@click.argument('output_filepath', type=click.Path())
+@click.option('--store-dir', default='data/interim/features',
+              show_default=True, type=click.Path(),
+              help='Feature stores, reused when they match the data and '
+                   'options.')
+@click.option('--n-augmentations', default=0, show_default=True,
+              help='Augmented copies of every training image.')
+@click.option('--epochs', default=20, show_default=True)
+@click.option('--batch-size', default=32, show_default=True)
+@click.option('--seed', default=42, show_default=True)
+def head_command(data_dir, output_filepath, store_dir, n_augmentations, epochs,
+                 batch_size, seed):
+    """ Trains the dense head of the model on cached backbone features of the
+        processed DATA_DIR and saves the full model to OUTPUT_FILEPATH.
+    """
+    logger = logging.getLogger(__name__)
+    backbone = build_backbone()
+    backbone.trainable = False
+    stores = {}
+    for split, augmentations in [('train', n_augmentations),
+                                 ('validation', 0)]:
+        stores[split] = os.path.join(store_dir, split)
+        split_dir = os.path.join(data_dir, split)
+        if feature_store_matches(stores[split], split_dir, augmentations,
+                                 seed):
+            logger.info('reusing the %s feature maps in %s', split,
+                        stores[split])
+            continue
+        count = build_feature_store(backbone, split_dir, stores[split],
+                                    augmentations, seed, batch_size)
+        logger.info('cached %d %s feature maps in %s', count, split,
+                    stores[split])
+
+    head, _ = train_head(stores['train'], stores['validation'], epochs,
+                         batch_size, seed=seed)
+    attach_head(backbone, head).save(output_filepath)
+    logger.info('model saved to %s', output_filepath)
+
+
+@cli.command('train')
+@click.argument('data_dir', type=click.Path(exists=True))
+@click.argument('output_filepath', type=click.Path())
+@click.option('--strategy', type=click.Choice(STRATEGIES), default='default',
+              show_default=True)
+@click.option('--workers', default=1, show_default=True,
+              help='Local worker processes, more than one implies the '
+                   'multi_worker strategy.')
+@click.option('--mixed-precision', is_flag=True,
+              help='Use mixed precision where available.')
+@click.option('--batch-size', default=10, show_default=True,
+              help='Images per step and per replica.')
+@click.option('--frozen-epochs', default=20, show_default=True)
+@click.option('--fine-tune-epochs', default=10, show_default=True)
+@click.option('--steps-per-epoch', type=int)
+@click.option('--seed', default=42, show_default=True)
+def train_command(data_dir, output_filepath, strategy, workers,
+                  mixed_precision, batch_size, frozen_epochs,
+                  fine_tune_epochs, steps_per_epoch, seed):
+    """ Trains the model on the processed DATA_DIR with the frozen then
+        fine-tuned VGG19 stages and saves it to OUTPUT_FILEPATH.
+    """
+    if workers > 1:
+        args = ['train', data_dir, output_filepath,
+                '--strategy', 'multi_worker',
+                '--batch-size', str(batch_size),
+                '--frozen-epochs', str(frozen_epochs),
+                '--fine-tune-epochs', str(fine_tune_epochs),
+                '--seed', str(seed)]
+        if mixed_precision:
+            args.append('--mixed-precision')
+        if steps_per_epoch is not None:
+            args += ['--steps-per-epoch', str(steps_per_epoch)]
+        sys.exit(launch_local_workers(workers, args))
+
+    train(data_dir, output_filepath, strategy, mixed_precision, batch_size,
+          frozen_epochs, fine_tune_epochs, steps_per_epoch, seed)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    cli()
@@ -1,2 +1,2 @@
-from .data_processing import *
-from .time_utils import *
+from .data_processing import *  # noqa: F401,F403
+from .time_utils import *  # noqa: F401,F403
@@ -0,0 +1,389 @@
+import os
+import zlib
+import numpy as np
+from .packed_dataset import (IMAGES_FILE, load_packed_dataset,
+                             write_packed_index)
+
+# Policy of make_data_augmented_dataset, in ImageDataGenerator argument names
+AUGMENTATION_POLICY = dict(rotation_range=10,
+                           width_shift_range=0.1,
+                           height_shift_range=0.1,
+                           shear_range=0.15,
+                           zoom_range=0.1,
+                           brightness_range=[0.2, 1.0],
+                           horizontal_flip=True,
+                           vertical_flip=False)
+
+
+def random_transforms(n, rng, policy=AUGMENTATION_POLICY):
+    """Draw the random transform parameters of n images.
+
+    Parameters
+    ----------
+    n : int
+        Number of images.
+    rng : numpy.random.Generator
+        Source of randomness.
+    policy : dict, optional
+        Augmentation policy with ImageDataGenerator argument names.
+
+    Returns
+    -------
+    dict
+        Arrays of n rotation and shear angles (radians), zoom factors,
+        shifts (fractions of the image size), brightness factors and flips.
+    """
+    rotation = policy.get('rotation_range', 0.)
+    shear = policy.get('shear_range', 0.)
+    zoom = policy.get('zoom_range', 0.)
+    width_shift = policy.get('width_shift_range', 0.)
+    height_shift = policy.get('height_shift_range', 0.)
+    brightness = policy.get('brightness_range')
+    return {'theta': np.deg2rad(rng.uniform(-rotation, rotation, n)),
+            'shear': np.deg2rad(rng.uniform(-shear, shear, n)),
+            'zoom_x': rng.uniform(1. - zoom, 1. + zoom, n),
+            'zoom_y': rng.uniform(1. - zoom, 1. + zoom, n),
+            'shift_x': rng.uniform(-width_shift, width_shift, n),
+            'shift_y': rng.uniform(-height_shift, height_shift, n),
+            'brightness': (rng.uniform(brightness[0], brightness[1], n)
+                           if brightness else np.ones(n)),
+            'horizontal_flip': ((rng.random(n) < 0.5)
+                                & bool(policy.get('horizontal_flip'))),
+            'vertical_flip': ((rng.random(n) < 0.5)
+                              & bool(policy.get('vertical_flip')))}
+
+
+def apply_transforms(images, params):
+    """Apply per-image affine transforms to a stack of images at once.
+
+    Every output pixel is sampled bilinearly from its source position with
+    a single gather over the whole stack. Positions outside the image repeat
+    the nearest edge, like fill_mode='nearest'.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        (N, H, W, C) stack of images.
+    params : dict
+        Transform parameters from random_transforms.
+
+    Returns
+    -------
+    numpy.ndarray
+        Augmented images with the dtype of the input.
+    """
+    n, height, width = images.shape[:3]
+    centre_x = (width - 1) / 2.
+    centre_y = (height - 1) / 2.
+    dy, dx = np.mgrid[0:height, 0:width].astype(np.float32)
+    dx -= centre_x
+    dy -= centre_y
+
+    # Output to input mapping: rotation @ shear @ zoom around the image
+    # centre, then shift
+    theta = params['theta'][:, None, None]
+    shear = params['shear'][:, None, None]
+    zoom_x = params['zoom_x'][:, None, None]
+    zoom_y = params['zoom_y'][:, None, None]
+    source_x = (np.cos(theta) * zoom_x * dx
+                - np.sin(theta + shear) * zoom_y * dy
+                + centre_x + params['shift_x'][:, None, None] * width)
+    source_y = (np.sin(theta) * zoom_x * dx
+                + np.cos(theta + shear) * zoom_y * dy
+                + centre_y + params['shift_y'][:, None, None] * height)
+    source_x = np.clip(source_x, 0, width - 1).astype(np.float32)
+    source_y = np.clip(source_y, 0, height - 1).astype(np.float32)
+
+    x0 = np.floor(source_x).astype(np.intp)
+    y0 = np.floor(source_y).astype(np.intp)
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    fx = (source_x - x0)[..., None]
+    fy = (source_y - y0)[..., None]
+    batch = np.arange(n)[:, None, None]
+    top = images[batch, y0, x0] * (1 - fx) + images[batch, y0, x1] * fx
+    bottom = images[batch, y1, x0] * (1 - fx) + images[batch, y1, x1] * fx
+    out = top * (1 - fy) + bottom * fy
+    out *= params['brightness'][:, None, None, None]
+
+    out[params['horizontal_flip']] = out[params['horizontal_flip'], :, ::-1]
+    out[params['vertical_flip']] = out[params['vertical_flip'], ::-1]
+
+    if np.issubdtype(images.dtype, np.integer):
+        info = np.iinfo(images.dtype)
+        out = np.clip(np.rint(out), info.min, info.max)
+    return out.astype(images.dtype)
+
+
+def augment_images(images, rng=None, policy=AUGMENTATION_POLICY):
+    """Randomly augment a batch of images.
+
+    Parameters
+    ----------
+    images : numpy.ndarray or list
+        (N, H, W, C) array or list of images, which may differ in size.
+    rng : numpy.random.Generator, optional
+        Source of randomness.
+    policy : dict, optional
+        Augmentation policy with ImageDataGenerator argument names.
+
+    Returns
+    -------
+    numpy.ndarray or list
+        Augmented images, in the same container type as the input.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    params = random_transforms(len(images), rng, policy)
+    if isinstance(images, np.ndarray):
+        return apply_transforms(images, params)
+
+    # Group the images by shape so that each group can be stacked
+    groups = {}
+    for index, image in enumerate(images):
+        groups.setdefault(image.shape, []).append(index)
+    augmented = [None] * len(images)
+    for indices in groups.values():
+        group_params = {name: values[indices]
+                        for name, values in params.items()}
+        stack = np.stack([images[index] for index in indices])
+        stack = apply_transforms(stack, group_params)
+        for index, image in zip(indices, stack):
+            augmented[index] = image
+    return augmented
+
+
+def iter_augmented_batches(images, labels, n_generated_samples, batch_size=32,
+                           seed=None, policy=AUGMENTATION_POLICY):
+    """Stream augmented batches of a fixed-shape dataset into training.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        (N, H, W, C) images, e.g. a memory-mapped packed dataset.
+    labels : numpy.ndarray
+        (N,) labels.
+    n_generated_samples : int
+        Number of samples to be generated for each image.
+    batch_size : int, optional
+        Number of source images augmented together.
+    seed : int, optional
+        Seed of the augmentation.
+    policy : dict, optional
+        Augmentation policy with ImageDataGenerator argument names.
+
+    Yields
+    ------
+    tuple
+        Batch of augmented images and their labels, the samples of a source
+        image being consecutive.
+    """
+    rng = np.random.default_rng(seed)
+    for start in range(0, len(images), batch_size):
+        stop = start + batch_size
+        batch = np.repeat(np.asarray(images[start:stop]), n_generated_samples,
+                          axis=0)
+        yield (augment_images(batch, rng, policy),
+               np.repeat(labels[start:stop], n_generated_samples))
+
+
+def write_augmented_packed(images, labels, filenames, n_generated_samples,
+                           output_dir, batch_size=32, seed=None,
+                           policy=AUGMENTATION_POLICY):
+    """Augment a fixed-shape dataset in bulk into the packed dataset format.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        (N, H, W, C) images, e.g. a memory-mapped packed dataset.
+    labels : numpy.ndarray
+        (N,) labels.
+    filenames : list
+        Source filename of each image.
+    n_generated_samples : int
+        Number of samples to be generated for each image.
+    output_dir : str
+        Path to the directory where the packed dataset will be saved.
+    batch_size : int, optional
+        Number of source images augmented together.
+    seed : int, optional
+        Seed of the augmentation.
+    policy : dict, optional
+        Augmentation policy with ImageDataGenerator argument names.
+
+    Returns
+    -------
+    int
+        Number of packed images.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    shape = (len(images) * n_generated_samples,) + tuple(images.shape[1:])
+    if shape[0]:
+        packed = np.memmap(os.path.join(output_dir, IMAGES_FILE),
+                           dtype=np.uint8, mode='w+', shape=shape)
+        position = 0
+        for batch, _ in iter_augmented_batches(images, labels,
+                                               n_generated_samples,
+                                               batch_size, seed, policy):
+            packed[position:position + len(batch)] = batch
+            position += len(batch)
+        packed.flush()
+        del packed
+    else:
+        open(os.path.join(output_dir, IMAGES_FILE), 'wb').close()
+
+    write_packed_index(output_dir, shape,
+                       np.repeat(labels, n_generated_samples).tolist(),
+                       [filename for filename in filenames
+                        for _ in range(n_generated_samples)])
+    return shape[0]
+
+
+def sample_transforms(source_key, sample_index, seed=0,
+                      policy=AUGMENTATION_POLICY):
+    """Draw the transform of one augmented sample deterministically.
+
+    The parameters only depend on (source_key, sample_index, seed), so any
+    worker regenerates the same sample without coordination.
+
+    Parameters
+    ----------
+    source_key : str
+        Stable identifier of the source image, e.g. its file name.
+    sample_index : int
+        Index of the sample among the samples of the source image.
+    seed : int, optional
+        Seed of the augmented dataset.
+    policy : dict, optional
+        Augmentation policy with ImageDataGenerator argument names.
+
+    Returns
+    -------
+    dict
+        Transform parameters of a single image, see random_transforms.
+    """
+    rng = np.random.default_rng([seed, zlib.crc32(source_key.encode()),
+                                 sample_index])
+    return random_transforms(1, rng, policy)
+
+
+class AugmentedView:
+    """Virtual augmented dataset computed lazily on access.
+
+    Sample i * n_generated_samples + k is the k-th augmentation of source
+    image i. Nothing is stored: every sample is a pure function of the
+    source image, its index k and the seed.
+
+    Parameters
+    ----------
+    images : numpy.ndarray
+        (N, H, W, C) source images, e.g. a memory-mapped packed dataset.
+    labels : numpy.ndarray
+        (N,) labels.
+    keys : list
+        Stable identifier of each source image, e.g. its file name.
+    n_generated_samples : int
+        Number of samples generated for each image.
+    seed : int, optional
+        Seed of the augmented dataset.
+    policy : dict, optional
+        Augmentation policy with ImageDataGenerator argument names.
+    """
+
+    def __init__(self, images, labels, keys, n_generated_samples, seed=0,
+                 policy=AUGMENTATION_POLICY):
+        self.images = images
+        self.labels = np.asarray(labels)
+        self.keys = list(keys)
+        self.n_generated_samples = n_generated_samples
+        self.seed = seed
+        self.policy = policy
+
+    @classmethod
+    def from_packed(cls, packed_dir, n_generated_samples, seed=0,
+                    policy=AUGMENTATION_POLICY):
+        """Build a view over a packed dataset keyed by the source file names.
+
+        Parameters
+        ----------
+        packed_dir : str
+            Path to a directory written by export_packed_dataset.
+        n_generated_samples : int
+            Number of samples generated for each image.
+        seed : int, optional
+            Seed of the augmented dataset.
+        policy : dict, optional
+            Augmentation policy with ImageDataGenerator argument names.
+
+        Returns
+        -------
+        AugmentedView
+            Augmented view of the packed dataset.
+        """
+        images, labels, filenames = load_packed_dataset(packed_dir)
+        keys = [os.path.basename(filename) for filename in filenames]
+        return cls(images, labels, keys, n_generated_samples, seed, policy)
+
+    def __len__(self):
+        return len(self.images) * self.n_generated_samples
+
+    def __getitem__(self, index):
+        images, labels = self.get_batch([index])
+        return images[0], labels[0]
+
+    def get_batch(self, indices):
+        """Compute a batch of augmented samples.
+
+        Parameters
+        ----------
+        indices : list
+            Indices of the samples in the view.
+
+        Returns
+        -------
+        tuple
+            (len(indices), H, W, C) augmented images and their labels.
+
+        Raises
+        ------
+        IndexError
+            If an index is outside [-len(self), len(self)).
+        """
+        indices = np.asarray(indices, dtype=int).reshape(-1)
+        if np.any((indices < -len(self)) | (indices >= len(self))):
+            raise IndexError(f'Sample index out of range for a view of '
+                             f'{len(self)} samples')
+        if not len(indices):
+            return np.asarray(self.images[:0]), self.labels[:0]
+        indices = np.where(indices < 0, indices + len(self), indices)
+        sources, samples = np.divmod(indices, self.n_generated_samples)
+        draws = [sample_transforms(self.keys[source], sample, self.seed,
+                                   self.policy)
+                 for source, sample in zip(sources, samples)]
+        params = {name: np.concatenate([draw[name] for draw in draws])
+                  for name in draws[0]}
+        images = np.stack([self.images[source] for source in sources])
+        return apply_transforms(images, params), self.labels[sources]
+
+    def iter_batches(self, batch_size=32, shuffle=False, epoch=0):
+        """Iterate over the view in batches.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            Number of samples per batch.
+        shuffle : bool, optional
+            Whether to visit the samples in a random order.
+        epoch : int, optional
+            Epoch number, combined with the seed to order a shuffled epoch.
+
+        Yields
+        ------
+        tuple
+            Batch of augmented images and their labels.
+        """
+        order = np.arange(len(self))
+        if shuffle:
+            np.random.default_rng([self.seed, epoch]).shuffle(order)
+        for start in range(0, len(order), batch_size):
+            yield self.get_batch(order[start:start + batch_size])
@@ -1,9 +1,33 @@
 import os
 import shutil
-import imutils
-from matplotlib import pyplot as plt
-import cv2
-from tensorflow import keras
+import time
+import logging
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from .lazy_import import lazy_import
+from .time_utils import count_items, stage, time_execution
+from .preprocessing_cache import PreprocessingCache
+from .augmentation import AUGMENTATION_POLICY, augment_images
+from .image_io import read_image, reduced_decode_enabled
+from .manifest import list_instance_paths
+
+# OpenCV and imutils are only loaded by the functions that use them
+cv2 = lazy_import('cv2')
+imutils = lazy_import('imutils')
+
+SPLITS = ['train', 'validation', 'test']
+TUMOR_CASES = ['yes', 'no']
+IMAGE_SIZE = (240, 240)
+# cv2.INTER_CUBIC, spelled out so that importing does not load OpenCV
+INTERPOLATION = 2
+CROP_THRESHOLD = 45
+LINK_MODES = ('copy', 'hardlink', 'symlink', 'reflink')
+# FICLONE ioctl request of linux/fs.h
+_FICLONE = 0x40049409
+# OpenCV filters accept at most CV_CN_MAX channels per array
+_MAX_STACK_CHANNELS = 512
+
 
 def count_instances(directory):
     """Count the number of instances in a directory.
@@ -22,7 +46,58 @@ def count_instances(directory):
     return len(os.listdir(directory))
 
 
-def copy_instances(source_directory, target_directory):
+def _reflink(source_path, target_path):
+    """Clone a file with a copy-on-write reflink (Linux FICLONE)."""
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError('Reflinks are not supported on this platform')
+    with open(source_path, 'rb') as source_file, \
+            open(target_path, 'wb') as target_file:
+        fcntl.ioctl(target_file.fileno(), _FICLONE, source_file.fileno())
+
+
+def materialize_instance(source_path, target_path, mode='copy'):
+    """Materialize an instance at a target path.
+
+    Parameters
+    ----------
+    source_path : str
+        Path to the source instance.
+    target_path : str
+        Path to the target instance.
+    mode : str, optional
+        'copy', 'hardlink', 'symlink' or 'reflink'. Links fall back to a copy
+        when the filesystem does not support them.
+
+    Returns
+    -------
+    str
+        Mode actually used.
+
+    """
+    if mode not in LINK_MODES:
+        raise ValueError(f'Unknown mode {mode!r}, expected one of '
+                         f'{LINK_MODES}')
+    try:
+        if mode == 'hardlink':
+            os.link(source_path, target_path)
+            return mode
+        if mode == 'symlink':
+            os.symlink(os.path.abspath(source_path), target_path)
+            return mode
+        if mode == 'reflink':
+            _reflink(source_path, target_path)
+            return mode
+    except OSError:
+        if os.path.lexists(target_path):
+            os.remove(target_path)
+    shutil.copy(source_path, target_path)
+    return 'copy'
+
+
+@stage('copy_instances')
+def copy_instances(source_directory, target_directory, mode='copy', prefix=''):
     """Copy the instances from a source directory to a target directory.
 
     Parameters
@@ -31,11 +106,17 @@ def copy_instances(source_directory, target_directory):
         Path to the source directory.
     target_directory : str
         Path to the target directory.
+    mode : str, optional
+        'copy', 'hardlink', 'symlink' or 'reflink', see materialize_instance.
+    prefix : str, optional
+        String to prepend to the instance names in the target directory.
 
     """
     for instance in os.listdir(source_directory):
-        shutil.copy(os.path.join(source_directory, instance),
-                    os.path.join(target_directory, instance))
+        materialize_instance(os.path.join(source_directory, instance),
+                             os.path.join(target_directory, prefix + instance),
+                             mode)
+        count_items()
 
 
 def rename_instances(directory, appended_string):
@@ -71,8 +152,34 @@ def validate_directory(directory):
     """
     return os.path.isdir(directory)
 
+
+def _augment_in_batches(file_dir, n_generated_samples, save_to_dir,
+                        batch_size, seed, decode_size):
+    """Augment batch_size images at a time with the vectorized engine."""
+    rng = np.random.default_rng(seed)
+    paths = list_instance_paths(file_dir)
+    for start in range(0, len(paths), batch_size):
+        names, images = [], []
+        for path in paths[start:start + batch_size]:
+            img = read_image(path, decode_size)
+            if img is not None:
+                names.append(os.path.basename(path))
+                images.append(img)
+        repeated = [img for img in images for _ in range(n_generated_samples)]
+        augmented = augment_images(repeated, rng)
+        for index, img in enumerate(augmented):
+            stem = os.path.splitext(names[index // n_generated_samples])[0]
+            file_name = 'aug_{}_{}.jpeg'.format(stem,
+                                                index % n_generated_samples)
+            cv2.imwrite(os.path.join(save_to_dir, file_name), img)
+        count_items(len(augmented))
+
+
 # Method for data augmented dataset
-def make_data_augmented_dataset(file_dir, n_generated_samples, save_to_dir, save_prefix):
+@stage('make_data_augmented_dataset')
+def make_data_augmented_dataset(file_dir, n_generated_samples, save_to_dir,
+                                save_prefix, batch_size=None, seed=None,
+                                decode_size=None):
     """Make a data augmented dataset.
 
     Parameters
@@ -85,6 +192,20 @@ def make_data_augmented_dataset(file_dir, n_generated_samples, save_to_dir, save
         Path to the directory where the augmented dataset will be saved.
     save_prefix : str
         Prefix of the directory to save samples generated.
+    batch_size : int, optional
+        When given, images are augmented batch_size at a time with the
+        vectorized engine of src.utils.augmentation instead of one
+        ImageDataGenerator flow per file.
+    seed : int, optional
+        Seed of the vectorized engine.
+    decode_size : tuple, optional
+        (width, height) the sources must keep. JPEG sources larger than
+        that are decoded at a reduced scale, see image_io.read_image, and
+        the augmented images are then saved at that reduced size, still at
+        least decode_size. corp_dataset later resizes them to IMAGE_SIZE
+        anyway. Without it, IMAGE_SIZE is used when the
+        BRAIN_TUMOR_REDUCED_DECODE environment variable is set, and the
+        sources are fully decoded otherwise.
 
     Returns
     -------
@@ -93,27 +214,33 @@ def make_data_augmented_dataset(file_dir, n_generated_samples, save_to_dir, save
 
     """
 
+    if decode_size is None and reduced_decode_enabled():
+        decode_size = IMAGE_SIZE
     if not validate_directory(save_to_dir):
         os.mkdir(save_to_dir)
 
-    if not validate_directory(os.path.join(save_to_dir, save_prefix)):
-        os.mkdir(os.path.join(save_to_dir, save_prefix))
-    else:
-        shutil.rmtree(os.path.join(save_to_dir, save_prefix))
-    save_to_dir += save_prefix
+    save_to_dir = os.path.join(save_to_dir, save_prefix)
+    if validate_directory(save_to_dir):
+        shutil.rmtree(save_to_dir)
+    os.mkdir(save_to_dir)
+
+    if batch_size is not None:
+        _augment_in_batches(file_dir, n_generated_samples, save_to_dir,
+                            batch_size, seed, decode_size)
+        return 'Success in making the data augmented dataset.'
+
+    from tensorflow import keras
+
     data_gen = keras.preprocessing.image.ImageDataGenerator(
-        rotation_range=10,
-        width_shift_range=0.1,
-        height_shift_range=0.1,
-        shear_range=0.15,
-        zoom_range=0.1,
-        brightness_range=[0.2, 1.0],
-        horizontal_flip=True,
-        vertical_flip=False,
-        fill_mode='nearest')
-
-    for file_name in os.listdir(file_dir):
-        img = cv2.imread(os.path.join(file_dir, file_name))
+        fill_mode='nearest', **AUGMENTATION_POLICY)
+
+    for path in list_instance_paths(file_dir):
+        file_name = os.path.basename(path)
+        img = read_image(path, decode_size)
+        if img is None:
+            logging.getLogger(__name__).warning('Skipping unreadable image %s',
+                                                path)
+            continue
         img = img.reshape((1,) + img.shape)
         save_prefix = 'aug_' + file_name[:-4]
         amount = 0
@@ -121,25 +248,39 @@ def make_data_augmented_dataset(file_dir, n_generated_samples, save_to_dir, save
                                save_to_dir=save_to_dir,
                                save_prefix=save_prefix,
                                save_format='jpeg'):
+            # The flow saves every batch it yields, stop after the n-th one
             amount += 1
-            if amount > n_generated_samples:
+            if amount >= n_generated_samples:
                 break
+        count_items(amount)
 
     return 'Success in making the data augmented dataset.'
 
-def data_summary(data_path):
+
+def data_summary(data_path, detailed=False, n_jobs=8, cache_path=None):
     """Summarize the data in a directory.
 
     Parameters
     ----------
     data_path : str
         Path to the directory containing the data.
+    detailed : bool, optional
+        Whether to scan the images for per split counts, dimensions, file
+        sizes, unreadable files and duplicates, see dataset_scan.scan_dataset.
+    n_jobs : int, optional
+        Number of scanning threads of the detailed summary.
+    cache_path : str, optional
+        Incremental cache of the detailed summary.
 
     Returns
     -------
     str
         Summary of the data in the directory.
     """
+    if detailed:
+        from .dataset_scan import format_scan_report, scan_dataset
+
+        return format_scan_report(scan_dataset(data_path, n_jobs, cache_path))
     yes_path = os.path.join(data_path, 'yes')
     no_path = os.path.join(data_path, 'no')
     len_yes = count_instances(yes_path)
@@ -147,65 +288,299 @@ def data_summary(data_path):
     total_len = len_yes + len_no
     percentage_yes = round(len_yes / total_len * 100, 2)
     percentage_no = round(len_no / total_len * 100, 2)
-    return 'Total instances: {}\nPercentage of yes: {}%\nPercentage of no: {}%'.format(total_len, percentage_yes, percentage_no)
+    return ('Total instances: {}\nPercentage of yes: {}%\n'
+            'Percentage of no: {}%'.format(total_len, percentage_yes,
+                                           percentage_no))
 
-def crop_brain_contour(image, plot=False):
-    """Crop the brain contour of an image.
+
+def _brain_mask(gray):
+    """Threshold a grayscale image, or a stack of them along the last axis.
 
     Parameters
     ----------
-    image : numpy.ndarray
-        Image to be cropped.
-    plot : bool, optional
-        Whether to plot the image or not.
+    gray : numpy.ndarray
+        (H, W) grayscale image or (H, W, N) stack of grayscale images.
 
     Returns
     -------
     numpy.ndarray
-        Cropped image.
+        Binary mask with the same shape as the input.
 
     """
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     gray = cv2.GaussianBlur(gray, (5, 5), 0)
 
-    # Threshold the image, then perform a series of erosions dilations to remove any small regions of noise
-    thresh = cv2.threshold(gray, 45, 255, cv2.THRESH_BINARY)[1]
+    # Threshold the image, then perform a series of erosions dilations to
+    # remove any small regions of noise
+    thresh = cv2.threshold(gray, CROP_THRESHOLD, 255, cv2.THRESH_BINARY)[1]
     thresh = cv2.erode(thresh, None, iterations=2)
     thresh = cv2.dilate(thresh, None, iterations=2)
+    return thresh
+
+
+def _contour_box(thresh):
+    """Find the bounding box of the largest contour of a binary mask.
+
+    Parameters
+    ----------
+    thresh : numpy.ndarray
+        (H, W) binary mask.
+
+    Returns
+    -------
+    tuple
+        (x_min, y_min, x_max, y_max) extreme points of the largest contour.
 
+    """
     # Find contours in thresholded image, then grab the largest one
-    cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    cnts = cv2.findContours(thresh.copy(), cv2.RETR_EXTERNAL,
+                            cv2.CHAIN_APPROX_SIMPLE)
     cnts = imutils.grab_contours(cnts)
     c = max(cnts, key=cv2.contourArea)
 
     # Find the extreme points
-    extLeft = tuple(c[c[:, :, 0].argmin()][0])
-    extRight = tuple(c[c[:, :, 0].argmax()][0])
-    extTop = tuple(c[c[:, :, 1].argmin()][0])
-    extBot = tuple(c[c[:, :, 1].argmax()][0])
+    return (int(c[:, :, 0].min()), int(c[:, :, 1].min()),
+            int(c[:, :, 0].max()), int(c[:, :, 1].max()))
+
+
+def crop_brain_contour(image, plot=False):
+    """Crop the brain contour of an image.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        Image to be cropped.
+    plot : bool, optional
+        Whether to plot the image or not.
 
-    new_image = image[extTop[1]:extBot[1], extLeft[0]:extRight[0]]
+    Returns
+    -------
+    numpy.ndarray
+        Cropped image.
+
+    """
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    x_min, y_min, x_max, y_max = _contour_box(_brain_mask(gray))
+    new_image = image[y_min:y_max, x_min:x_max]
 
     if plot:
+        from matplotlib import pyplot as plt
+
         plt.figure()
         plt.subplot(1, 2, 1)
         plt.imshow(image)
         plt.tick_params(axis='both', which='both', bottom=False, top=False,
-                        labelbottom=False, right=False, left=False, labelleft=False, labelright=False, labeltop=False)
+                        labelbottom=False, right=False, left=False,
+                        labelleft=False, labelright=False, labeltop=False)
         plt.title('Original Image')
 
         plt.subplot(1, 2, 2)
         plt.imshow(new_image)
 
         plt.tick_params(axis='both', which='both', bottom=False, top=False,
-                        labelbottom=False, right=False, left=False, labelleft=False, labelright=False, labeltop=False)
+                        labelbottom=False, right=False, left=False,
+                        labelleft=False, labelright=False, labeltop=False)
         plt.title('Cropped Image')
 
         plt.show()
 
     return new_image
 
-def corp_dataset(processed_folder, *source_folders):
+
+def crop_brain_contour_batch(images, return_crops=False):
+    """Crop the brain contour of a batch of images.
+
+    The colour conversion, blur, threshold and morphology run on the whole
+    stack at once (images are packed as channels of a single array), only
+    the contour search is done per image. Boxes match crop_brain_contour.
+
+    Parameters
+    ----------
+    images : numpy.ndarray or list
+        (N, H, W, 3) array or list of BGR images, which may differ in size.
+    return_crops : bool, optional
+        Whether to also return the cropped images.
+
+    Returns
+    -------
+    numpy.ndarray or tuple
+        (N, 4) int array of (x_min, y_min, x_max, y_max) crop boxes, and the
+        list of cropped images if return_crops is True. Images without any
+        contour keep their full frame.
+
+    """
+    # Group the images by shape so that each group can be stacked
+    if isinstance(images, np.ndarray):
+        groups = {images.shape[1:]: list(range(len(images)))}
+    else:
+        groups = {}
+        for index, image in enumerate(images):
+            groups.setdefault(image.shape, []).append(index)
+
+    boxes = np.zeros((len(images), 4), dtype=int)
+    for (height, width, _), indices in groups.items():
+        if isinstance(images, np.ndarray):
+            stack = images
+        else:
+            stack = np.stack([images[index] for index in indices])
+        # BGR -> gray is a per-pixel operation, the stack converts as one
+        # tall image
+        gray = cv2.cvtColor(stack.reshape(-1, width, 3), cv2.COLOR_BGR2GRAY)
+        gray = np.ascontiguousarray(gray.reshape(len(indices), height,
+                                                 width).transpose(1, 2, 0))
+        for start in range(0, len(indices), _MAX_STACK_CHANNELS):
+            stop = start + _MAX_STACK_CHANNELS
+            thresh = _brain_mask(gray[:, :, start:stop])
+            thresh = thresh.reshape(height, width, -1)
+            for channel, index in enumerate(indices[start:stop]):
+                try:
+                    boxes[index] = _contour_box(
+                        np.ascontiguousarray(thresh[:, :, channel]))
+                except ValueError:
+                    boxes[index] = (0, 0, width, height)
+
+    if not return_crops:
+        return boxes
+    crops = [image[y_min:y_max, x_min:x_max]
+             for image, (x_min, y_min, x_max, y_max) in zip(images, boxes)]
+    return boxes, crops
+
+
+def _split_name(source_folder):
+    """Find the split a source folder belongs to.
+
+    Parameters
+    ----------
+    source_folder : str
+        Path to a directory containing the original images.
+
+    Returns
+    -------
+    str or None
+        'train', 'validation' or 'test', None if the folder is not a split.
+
+    """
+    for split in SPLITS:
+        if split in source_folder:
+            return split
+    return None
+
+
+def _init_crop_worker():
+    """Keep OpenCV single threaded inside each worker process."""
+    cv2.setNumThreads(1)
+
+
+def crop_instance(source_path, target_path, image_size=IMAGE_SIZE,
+                  reduced_decode=None):
+    """Read, crop, resize and save a single image.
+
+    Parameters
+    ----------
+    source_path : str
+        Path to the original image.
+    target_path : str
+        Path where the processed image will be saved.
+    image_size : tuple, optional
+        (width, height) of the saved image.
+    reduced_decode : bool, optional
+        Whether to decode JPEG files at the smallest scale covering
+        image_size. The brain crop is smaller than the frame, so it may then
+        be slightly upscaled. None follows the BRAIN_TUMOR_REDUCED_DECODE
+        environment variable, off by default.
+
+    Returns
+    -------
+    bool
+        True if the image was processed, False if it could not be read.
+
+    """
+    decode_size = None
+    if reduced_decode_enabled(reduced_decode):
+        decode_size = image_size
+    img = read_image(source_path, decode_size)
+    if img is None:
+        return False
+    img = crop_brain_contour(img)
+    img = cv2.resize(img, dsize=image_size, interpolation=INTERPOLATION)
+    cv2.imwrite(target_path, img)
+    return True
+
+
+def _list_split(source_folder, processed_folder):
+    """Split, source and target paths of the images of a source folder, None
+    if it is not a split or has no image directory."""
+    split = _split_name(source_folder)
+    if split is None:
+        return None
+    sources, targets = [], []
+    try:
+        for tumor_case in TUMOR_CASES:
+            case_folder = os.path.join(source_folder, tumor_case)
+            for source in list_instance_paths(case_folder):
+                sources.append(source)
+                targets.append(os.path.join(processed_folder, split,
+                                            tumor_case,
+                                            os.path.basename(source)))
+    except FileNotFoundError:
+        return None
+    return split, sources, targets
+
+
+def _crop_params(reduced_decode):
+    """Parameters of crop_instance that are part of the cache keys."""
+    crop_params = {'threshold': CROP_THRESHOLD,
+                   'image_size': list(IMAGE_SIZE),
+                   'interpolation': INTERPOLATION}
+    # Only added when set, so that the keys of existing caches stay valid
+    if reduced_decode:
+        crop_params['reduced_decode'] = True
+    return crop_params
+
+
+def _crop_split(sources, targets, executor, n_jobs, reduced_decode,
+                cache=None):
+    """Crop the images of a split, except those found in the cache.
+
+    Returns
+    -------
+    tuple
+        Number of cropped images, including those from the cache, and of
+        images from the cache.
+
+    """
+    n_cached = 0
+    if cache is not None:
+        crop_params = _crop_params(reduced_decode)
+        keys = []
+        for source, target in zip(sources, targets):
+            # The output format follows the extension, it is part of the key
+            ext = os.path.splitext(target)[1].lower()
+            keys.append(cache.key(source, dict(crop_params, ext=ext)))
+        missing = [i for i, (key, target) in enumerate(zip(keys, targets))
+                   if not cache.get(key, target)]
+        n_cached = len(sources) - len(missing)
+        keys = [keys[i] for i in missing]
+        sources = [sources[i] for i in missing]
+        targets = [targets[i] for i in missing]
+
+    options = (repeat(IMAGE_SIZE), repeat(reduced_decode))
+    if executor is None:
+        results = map(crop_instance, sources, targets, *options)
+    else:
+        chunksize = max(1, len(sources) // (n_jobs * 4))
+        results = executor.map(crop_instance, sources, targets, *options,
+                               chunksize=chunksize)
+    results = list(results)
+    if cache is not None:
+        for key, target, cropped in zip(keys, targets, results):
+            if cropped:
+                cache.put(key, target)
+    return sum(results) + n_cached, n_cached
+
+
+@stage('corp_dataset')
+def corp_dataset(processed_folder, *source_folders, n_jobs=1, cache_dir=None,
+                 cache_max_bytes=2 * 1024 ** 3, reduced_decode=None):
     """Crop the images in the dataset.
 
     Parameters
@@ -214,6 +589,17 @@ def corp_dataset(processed_folder, *source_folders):
         Path to the directory where the cropped images will be saved.
     *source_folders : *str
         Paths to the directories containing the original images.
+    n_jobs : int, optional
+        Number of worker processes, 1 runs serially and None uses every
+        available core. The output is the same for any number of workers.
+    cache_dir : str, optional
+        Path to a persistent preprocessing cache. Only images whose content
+        or crop parameters changed since a previous run are recomputed.
+    cache_max_bytes : int, optional
+        Size cap of the preprocessing cache.
+    reduced_decode : bool, optional
+        Whether to decode JPEG sources at a reduced scale, see crop_instance.
+        None follows the BRAIN_TUMOR_REDUCED_DECODE environment variable.
 
     Returns
     -------
@@ -221,58 +607,50 @@ def corp_dataset(processed_folder, *source_folders):
         Message indicating if the dataset was successfully cropped or not.
 
     """
+    logger = logging.getLogger(__name__)
+    reduced_decode = reduced_decode_enabled(reduced_decode)
 
-    # Create the directory train/validation/test where the cropped images will be saved
-    if not validate_directory(processed_folder):
-        os.mkdir(processed_folder)
-    else:
+    # Create the directory train/validation/test where the cropped images
+    # will be saved
+    if validate_directory(processed_folder):
         shutil.rmtree(processed_folder)
-        os.mkdir(processed_folder)
-
-    # Create the subdirectories inside train/validation/test
-    os.mkdir(os.path.join(processed_folder, 'train'))
-    os.mkdir(os.path.join(processed_folder, 'validation'))
-    os.mkdir(os.path.join(processed_folder, 'test'))
-    os.mkdir(os.path.join(processed_folder, 'train',  'yes'))
-    os.mkdir(os.path.join(processed_folder, 'train', 'no'))
-    os.mkdir(os.path.join(processed_folder, 'validation', 'yes'))
-    os.mkdir(os.path.join(processed_folder, 'validation', 'no'))
-    os.mkdir(os.path.join(processed_folder, 'test', 'yes'))
-    os.mkdir(os.path.join(processed_folder, 'test', 'no'))
-    image_width, image_height= 240, 240
+    for split in SPLITS:
+        for tumor_case in TUMOR_CASES:
+            os.makedirs(os.path.join(processed_folder, split, tumor_case))
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    executor = None
+    if n_jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=n_jobs,
+                                       initializer=_init_crop_worker)
+
+    cache = None
+    if cache_dir is not None:
+        cache = PreprocessingCache(cache_dir, cache_max_bytes)
+
     # crop the images and save them in the respective directory
-    tumor_cases = ['yes', 'no']
-    for source_folder in source_folders:
-        if os.path.isdir(source_folder):
-            if "train" in source_folder:
-                for tumor_case in tumor_cases:
-                    for file_name in os.listdir(os.path.join(source_folder, tumor_case)):
-                        img = cv2.imread(os.path.join(source_folder, tumor_case, file_name))
-                        if img is not None:
-                            img = crop_brain_contour(img)
-                            image = cv2.resize(img, dsize=(image_width, image_height),
-                                               interpolation=cv2.INTER_CUBIC)
-                            image = image / 255.
-                            cv2.imwrite(os.path.join(processed_folder, 'train', tumor_case, file_name), img)
-            elif "validation" in source_folder:
-                for tumor_case in tumor_cases:
-                    for file_name in os.listdir(os.path.join(source_folder, tumor_case)):
-                        img = cv2.imread(os.path.join(source_folder, tumor_case, file_name))
-                        if img is not None:
-                            img = crop_brain_contour(img)
-                            image = cv2.resize(image, dsize=(image_width, image_height),
-                                               interpolation=cv2.INTER_CUBIC)
-                            image = image / 255.
-                            cv2.imwrite(os.path.join(processed_folder, 'validation', tumor_case, file_name), img)
-            elif "test" in source_folder:
-                for tumor_case in tumor_cases:
-                    for file_name in os.listdir(os.path.join(source_folder, tumor_case)):
-                        img = cv2.imread(os.path.join(source_folder, tumor_case, file_name))
-                        if img is not None:
-                            img = crop_brain_contour(img)
-                            image = cv2.resize(image, dsize=(image_width, image_height),
-                                               interpolation=cv2.INTER_CUBIC)
-                            image = image / 255.
-                            cv2.imwrite(os.path.join(processed_folder, 'test', tumor_case, file_name), img)
-
-    return 'Dataset cropped successfully'
\ No newline at end of file
+    try:
+        for source_folder in source_folders:
+            listed = _list_split(source_folder, processed_folder)
+            if listed is None:
+                continue
+            split, sources, targets = listed
+
+            start_time = time.time()
+            n_cropped, n_cached = _crop_split(sources, targets, executor,
+                                              n_jobs, reduced_decode, cache)
+            count_items(n_cropped)
+            elapsed = time.time() - start_time
+            logger.info('%s: %d images cropped (%d from cache) in %s '
+                        '(%.1f images/s)', split, n_cropped, n_cached,
+                        time_execution(elapsed),
+                        n_cropped / elapsed if elapsed > 0 else 0.)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        if cache is not None:
+            cache.save()
+            logger.info('preprocessing cache: %s', cache.stats())
+
+    return 'Dataset cropped successfully'
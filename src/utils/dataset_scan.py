@@ -0,0 +1,308 @@
+import os
+import json
+import hashlib
+import logging
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import numpy as np
+from src.utils.image_io import read_image_header
+from src.utils.lazy_import import lazy_import
+
+cv2 = lazy_import('cv2')
+
+SPLITS = ['train', 'validation', 'test']
+CLASS_NAMES = ['yes', 'no']
+SCAN_CACHE_VERSION = 1
+
+
+def file_sha256(path):
+    """Hash the content of a file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the file.
+
+    Returns
+    -------
+    str
+        Hexadecimal sha256 of the content.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as image_file:
+        for block in iter(lambda: image_file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def scan_file(path, verify=False):
+    """Describe a single image from its header and content hash.
+
+    The image is only decoded when its header can not be parsed, or when
+    verify is set.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image.
+    verify : bool, optional
+        Whether to decode every image, which also catches truncated data.
+
+    Returns
+    -------
+    dict
+        Size in bytes, mtime, width, height, channels, sha256 and whether the
+        image is readable. The dimensions are None for unreadable images,
+        and so are the size and mtime of missing files, e.g. dangling
+        symlinks.
+    """
+    entry = {'size': None, 'mtime_ns': None,
+             'width': None, 'height': None, 'channels': None, 'sha256': None,
+             'readable': False}
+    try:
+        stat = os.stat(path)
+        entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+        entry['sha256'] = file_sha256(path)
+        header = read_image_header(path)
+    except OSError:
+        return entry
+    if header is not None and not verify:
+        entry['width'], entry['height'], entry['channels'] = header
+        entry['readable'] = True
+        return entry
+
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is not None:
+        entry['height'], entry['width'] = image.shape[:2]
+        entry['channels'] = image.shape[2] if image.ndim == 3 else 1
+        entry['readable'] = True
+    return entry
+
+
+def list_dataset_files(data_path, class_names=CLASS_NAMES):
+    """List the images of a raw or split dataset.
+
+    Parameters
+    ----------
+    data_path : str
+        Dataset with one directory per class, or with split directories
+        that contain the class directories.
+    class_names : list, optional
+        Classes to list.
+
+    Returns
+    -------
+    list
+        (split, class_name, path) tuples, the split is '' for a raw dataset.
+    """
+    splits = [split for split in SPLITS
+              if os.path.isdir(os.path.join(data_path, split))] or ['']
+    files = []
+    for split in splits:
+        for class_name in class_names:
+            class_dir = os.path.join(data_path, split, class_name)
+            if not os.path.isdir(class_dir):
+                continue
+            for file_name in sorted(os.listdir(class_dir)):
+                files.append((split, class_name,
+                              os.path.join(class_dir, file_name)))
+    return files
+
+
+def _load_cache(cache_path, verify):
+    if cache_path is None or not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {}
+    # A verified scan is also valid for a header scan, not the other way around
+    if (cache.get('version') != SCAN_CACHE_VERSION
+            or verify and not cache.get('verify')):
+        return {}
+    return cache['entries']
+
+
+def _save_cache(cache_path, entries, verify):
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    with open(cache_path + '.tmp', 'w') as cache_file:
+        json.dump({'version': SCAN_CACHE_VERSION, 'verify': verify,
+                   'entries': entries}, cache_file)
+    os.replace(cache_path + '.tmp', cache_path)
+
+
+def _size_distribution(sizes):
+    if not sizes:
+        return {}
+    sizes = np.array(sizes)
+    # Power of two buckets in KiB, e.g. '8-16' holds files of 8 to 16 KiB
+    buckets = Counter(int(np.log2(max(size / 1024., 1.))) for size in sizes)
+    histogram = {}
+    for bucket in sorted(buckets):
+        low = 2 ** bucket if bucket else 0
+        histogram[f'{low}-{2 ** (bucket + 1)}'] = buckets[bucket]
+    return {'total_bytes': int(sizes.sum()),
+            'min': int(sizes.min()),
+            'mean': float(sizes.mean()),
+            'p50': float(np.percentile(sizes, 50)),
+            'p95': float(np.percentile(sizes, 95)),
+            'max': int(sizes.max()),
+            'histogram_kib': histogram}
+
+
+def scan_dataset(data_path, n_jobs=8, cache_path=None, verify=False,
+                 class_names=CLASS_NAMES):
+    """Collect statistics and integrity problems of a dataset.
+
+    Files are scanned on a thread pool. With a cache, a file whose path,
+    size and mtime did not change is not read again.
+
+    Parameters
+    ----------
+    data_path : str
+        Dataset with one directory per class, or with split directories.
+    n_jobs : int, optional
+        Number of scanning threads.
+    cache_path : str, optional
+        JSON file keeping the results of previous scans.
+    verify : bool, optional
+        Whether to decode every image, see scan_file.
+    class_names : list, optional
+        Classes to scan.
+
+    Returns
+    -------
+    dict
+        Counts per split and class, dimension and channel histograms, file
+        size distribution, unreadable files and groups of duplicate files.
+    """
+    files = list_dataset_files(data_path, class_names)
+    cache = _load_cache(cache_path, verify)
+
+    def scan(path):
+        key = os.path.abspath(path)
+        entry = cache.get(key)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # e.g. a dangling symlink, reported as unreadable by scan_file
+            stat = None
+        if (entry is not None and stat is not None
+                and entry['size'] == stat.st_size
+                and entry['mtime_ns'] == stat.st_mtime_ns):
+            return key, entry, True
+        return key, scan_file(path, verify), False
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        results = list(executor.map(scan, [path for _, _, path in files]))
+
+    counts = {}
+    dimensions = Counter()
+    channels = Counter()
+    unreadable = []
+    by_hash = {}
+    for (split, class_name, path), (_, entry, _) in zip(files, results):
+        split_counts = counts.setdefault(split or 'all',
+                                         {name: 0 for name in class_names})
+        split_counts[class_name] += 1
+        if not entry['readable']:
+            unreadable.append(path)
+        else:
+            dimensions[f"{entry['width']}x{entry['height']}"] += 1
+            channels[entry['channels']] += 1
+        if entry['sha256'] is not None:
+            by_hash.setdefault(entry['sha256'], []).append(path)
+
+    if cache_path is not None:
+        # Keep the entries of other trees sharing the cache, drop the
+        # removed files of this one
+        root = os.path.join(os.path.abspath(data_path), '')
+        entries = {key: entry for key, entry in cache.items()
+                   if not key.startswith(root)}
+        entries.update((key, entry) for key, entry, _ in results)
+        _save_cache(cache_path, entries, verify)
+
+    return {'total': len(files),
+            'counts': counts,
+            'dimensions': dict(dimensions.most_common()),
+            'channels': {str(key): value
+                         for key, value in sorted(channels.items())},
+            'file_size': _size_distribution([entry['size']
+                                             for _, entry, _ in results
+                                             if entry['size'] is not None]),
+            'unreadable': unreadable,
+            'duplicates': [paths for paths in by_hash.values()
+                           if len(paths) > 1],
+            'cached': sum(hit for _, _, hit in results)}
+
+
+def format_scan_report(report, max_items=10):
+    """Format a scan report for the terminal.
+
+    Parameters
+    ----------
+    report : dict
+        Output of scan_dataset.
+    max_items : int, optional
+        Number of dimensions, unreadable files and duplicates listed.
+
+    Returns
+    -------
+    str
+        Multi-line summary.
+    """
+    lines = [f"Total instances: {report['total']} "
+             f"({report['cached']} from cache)"]
+    for split, split_counts in report['counts'].items():
+        total = sum(split_counts.values())
+        shares = ', '.join(
+            f'{name}: {count} ({count / total * 100 if total else 0:.2f}%)'
+            for name, count in split_counts.items())
+        lines.append(f'{split}: {total} instances, {shares}')
+    dimensions = list(report['dimensions'].items())[:max_items]
+    lines.append('Dimensions: ' + ', '.join(f'{size} ({count})'
+                                            for size, count in dimensions))
+    lines.append('Channels: ' + ', '.join(
+        f'{channels} ({count})'
+        for channels, count in report['channels'].items()))
+    if report['file_size']:
+        lines.append('File size: min {min} B, median {p50:.0f} B, '
+                     'p95 {p95:.0f} B, max {max} B, '
+                     'total {total_bytes} B'.format(**report['file_size']))
+    lines.append(f"Unreadable files: {len(report['unreadable'])}")
+    lines.extend(f'  {path}' for path in report['unreadable'][:max_items])
+    lines.append(f"Duplicate groups: {len(report['duplicates'])}")
+    lines.extend('  ' + ', '.join(paths)
+                 for paths in report['duplicates'][:max_items])
+    return '\n'.join(lines)
+
+
+@click.command()
+@click.argument('data_path', type=click.Path(exists=True))
+@click.option('--n-jobs', default=8, show_default=True)
+@click.option('--cache-path', default='data/interim/scan_cache.json',
+              show_default=True, type=click.Path(),
+              help="Incremental scan cache, '' to disable it.")
+@click.option('--verify', is_flag=True,
+              help='Decode every image instead of reading its header.')
+@click.option('--output', type=click.Path(),
+              help='Write the full report to a JSON file.')
+def main(data_path, n_jobs, cache_path, verify, output):
+    """ Scans the raw or split dataset in DATA_PATH and reports its statistics,
+        unreadable files and duplicates.
+    """
+    report = scan_dataset(data_path, n_jobs, cache_path or None, verify)
+    click.echo(format_scan_report(report))
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -1,11 +1,22 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import os
-import cv2
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .lazy_import import lazy_import
+from .image_io import read_image, reduced_decode_enabled
+from .manifest import list_instance_paths
+from .time_utils import count_items, stage
+
+cv2 = lazy_import('cv2')
+
 
 def plot_sample_images(X, y, n=50):
     """Plot sample images from a dataset.
 
+    For many images or without a display, use
+    src.visualization.visualize.write_contact_sheets instead.
+
     Parameters
     ----------
     X : numpy.ndarray
@@ -18,32 +29,89 @@ def plot_sample_images(X, y, n=50):
 
     :return: Plot of sample images.
     """
-    for label in [0,1]:
-        images = X[np.argwhere(y == label)]
-        n_images = images[:n]
+    from matplotlib import pyplot as plt
+
+    for label in [0, 1]:
+        indices = np.flatnonzero(y == label)[:n]
 
         columns_n = 10
-        rows_n = int(n/ columns_n)
+        rows_n = max(1, int(np.ceil(len(indices) / columns_n)))
 
-        plt.figure(figsize=(20, 10))
+        plt.figure(figsize=(20, 2 * rows_n))
 
-        i = 1
-        for image in n_images:
+        for i, index in enumerate(indices, start=1):
             plt.subplot(rows_n, columns_n, i)
-            plt.imshow(image[0])
+            plt.imshow(X[index])
 
             plt.tick_params(axis='both', which='both',
                             top=False, bottom=False, left=False, right=False,
                             labelbottom=False, labeltop=False, labelleft=False,
                             labelright=False)
 
-            i += 1
-
-        label_to_str = lambda label: "Yes" if label == 1 else "No"
-        plt.suptitle(f"Brain Tumor: {label_to_str(label)}")
+        plt.suptitle(f"Brain Tumor: {'Yes' if label == 1 else 'No'}")
         plt.show()
 
-def load_data(load_dir_list, image_size):
+
+def directory_label(load_dir):
+    """Get the label of a class directory from its name.
+
+    Parameters
+    ----------
+    load_dir : str
+        Path to a class directory, e.g. '.../train/yes'.
+
+    Returns
+    -------
+    int
+        1 for the 'yes' directory, 0 otherwise.
+    """
+    return 1 if os.path.basename(os.path.normpath(load_dir)) == 'yes' else 0
+
+
+def _load_image(path, image_size, reduced_decode=False):
+    image = read_image(path, image_size if reduced_decode else None)
+    return cv2.resize(image, image_size)
+
+
+def _shuffle_buffer(items, buffer_size, rng):
+    """Shuffle an iterable keeping at most buffer_size items in memory."""
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        index = rng.randrange(buffer_size)
+        yield buffer[index]
+        buffer[index] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def _load_packed(load_dir_list, image_size, packed_dir, reduced_decode):
+    """Map the packed copy of the directories, packing them first when it is
+    missing or does not match them."""
+    from .packed_dataset import (export_packed_dataset, load_packed_dataset,
+                                 read_packed_index)
+
+    paths = {path for load_dir in load_dir_list
+             for path in list_instance_paths(load_dir)}
+    try:
+        index = read_packed_index(packed_dir)
+        stale = (index['shape'][1:3] != [image_size[1], image_size[0]]
+                 or set(index['filenames'] + index['skipped']) != paths)
+    except FileNotFoundError:
+        stale = True
+    if stale:
+        export_packed_dataset(load_dir_list, image_size, packed_dir,
+                              reduced_decode)
+    X, y, _ = load_packed_dataset(packed_dir)
+    count_items(len(X))
+    return X, y
+
+
+@stage('load_data')
+def load_data(load_dir_list, image_size, reduced_decode=None,
+              packed_dir=None):
     """Load data from a directory.
 
     Parameters
@@ -52,24 +120,108 @@ def load_data(load_dir_list, image_size):
         List of directories to load data from.
     image_size : tuple
         Size of the images.
+    reduced_decode : bool, optional
+        Whether to decode JPEG files at the smallest scale covering
+        image_size, see image_io.read_image. Pixels differ slightly from a
+        full decode. None follows the BRAIN_TUMOR_REDUCED_DECODE environment
+        variable, off by default.
+    packed_dir : str, optional
+        Directory of a packed copy of the directories, see
+        packed_dataset.export_packed_dataset. The images are then read-only
+        memory-mapped from it instead of decoded, and the copy is written
+        first when it is missing or out of date. Unreadable images are
+        skipped.
 
     Returns
     -------
     tuple
         Tuple containing the loaded data.
     """
+    if packed_dir is not None:
+        return _load_packed(load_dir_list, image_size, packed_dir,
+                            reduced_decode)
+    reduced_decode = reduced_decode_enabled(reduced_decode)
     X = []
     y = []
 
     for load_dir in load_dir_list:
-        for filename in os.listdir(load_dir):
-            image = cv2.imread(os.path.join(load_dir, filename))
-            image = cv2.resize(image, image_size)
+        for path in list_instance_paths(load_dir):
+            image = _load_image(path, image_size, reduced_decode)
 
             X.append(image)
-            y.append(1 if load_dir.split('\\')[-1] == 'yes' else 0)
+            y.append(directory_label(load_dir))
 
     X = np.array(X)
     y = np.array(y)
+    count_items(len(X))
+
+    return X, y
 
-    return X, y
\ No newline at end of file
+
+def stream_data(load_dir_list, image_size, batch_size=32, shuffle_buffer=0,
+                seed=None, n_threads=4, reduced_decode=None):
+    """Load data from a directory in fixed-size batches.
+
+    Streaming counterpart of load_data: images are decoded in background
+    threads and only a bounded number of them is held in memory. Without
+    shuffling, the concatenated batches are equal to the output of load_data.
+
+    Parameters
+    ----------
+    load_dir_list : list
+        List of directories to load data from.
+    image_size : tuple
+        Size of the images.
+    batch_size : int, optional
+        Number of images per batch, the last batch may be smaller.
+    shuffle_buffer : int, optional
+        Size of the shuffle buffer, 0 keeps the load_data order.
+    seed : int, optional
+        Seed of the shuffle.
+    n_threads : int, optional
+        Number of decoding threads.
+    reduced_decode : bool, optional
+        Whether to decode JPEG files at a reduced scale, see load_data.
+
+    Yields
+    ------
+    tuple
+        Tuple containing a batch of data and its labels.
+    """
+    reduced_decode = reduced_decode_enabled(reduced_decode)
+    files = ((path, directory_label(load_dir))
+             for load_dir in load_dir_list
+             for path in list_instance_paths(load_dir))
+    if shuffle_buffer > 1:
+        files = _shuffle_buffer(files, shuffle_buffer, random.Random(seed))
+
+    # Decode ahead of the consumer, never more than a batch plus the workers
+    max_pending = batch_size + n_threads
+    X = []
+    y = []
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        pending = deque()
+        for path, label in files:
+            pending.append((executor.submit(_load_image, path, image_size,
+                                            reduced_decode), label))
+            if len(pending) < max_pending:
+                continue
+            future, label = pending.popleft()
+            X.append(future.result())
+            y.append(label)
+            if len(X) == batch_size:
+                yield np.array(X), np.array(y)
+                X = []
+                y = []
+
+        while pending:
+            future, label = pending.popleft()
+            X.append(future.result())
+            y.append(label)
+            if len(X) == batch_size:
+                yield np.array(X), np.array(y)
+                X = []
+                y = []
+
+    if X:
+        yield np.array(X), np.array(y)
@@ -0,0 +1,227 @@
+import os
+import time
+import struct
+import statistics
+import tracemalloc
+
+from .lazy_import import lazy_import
+
+cv2 = lazy_import('cv2')
+
+# JPEG start of frame markers, which hold the image dimensions
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+                     0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# PNG colour type -> number of channels
+_PNG_CHANNELS = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+# DCT scaling factors libjpeg supports through cv2.IMREAD_REDUCED_*
+REDUCTION_FACTORS = (8, 4, 2)
+# '1' turns reduced decoding on wherever a caller leaves the choice open.
+# Off by default: 214 of the 253 raw scans are too small to be reduced for
+# 240x240, so decoding them is only 1.09x faster (1.47x on 1024px scans),
+# and the reduced pixels change the processed dataset.
+REDUCED_DECODE_ENV = 'BRAIN_TUMOR_REDUCED_DECODE'
+
+
+def _jpeg_header(image_file):
+    image_file.seek(2)
+    while True:
+        byte = image_file.read(1)
+        while byte and byte != b'\xff':
+            byte = image_file.read(1)
+        while byte == b'\xff':
+            byte = image_file.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        # Markers without a payload
+        if marker == 0x01 or 0xD0 <= marker <= 0xD9:
+            continue
+        length_bytes = image_file.read(2)
+        if len(length_bytes) < 2:
+            return None
+        length = struct.unpack('>H', length_bytes)[0]
+        if marker in _JPEG_SOF_MARKERS:
+            frame = image_file.read(6)
+            if len(frame) < 6:
+                return None
+            _, height, width, channels = struct.unpack('>BHHB', frame)
+            return width, height, channels
+        image_file.seek(length - 2, 1)
+
+
+def read_image_header(path):
+    """Read the dimensions of an image without decoding it.
+
+    Only the header is read for JPEG, PNG, BMP and GIF files.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image.
+
+    Returns
+    -------
+    tuple or None
+        (width, height, channels), None if the format is not recognized or
+        the header is truncated.
+    """
+    with open(path, 'rb') as image_file:
+        head = image_file.read(30)
+        if head[:2] == b'\xff\xd8':
+            return _jpeg_header(image_file)
+        if (head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR'
+                and len(head) >= 26):
+            width, height = struct.unpack('>II', head[16:24])
+            return width, height, _PNG_CHANNELS.get(head[25], 3)
+        if head[:2] == b'BM' and len(head) >= 30:
+            width, height = struct.unpack('<ii', head[18:26])
+            bits = struct.unpack('<H', head[28:30])[0]
+            return width, abs(height), 4 if bits == 32 else 3
+        if head[:4] == b'GIF8' and len(head) >= 10:
+            width, height = struct.unpack('<HH', head[6:10])
+            return width, height, 3
+    return None
+
+
+def reduction_factor(width, height, min_size):
+    """Pick the largest JPEG reduction that still covers a size.
+
+    Parameters
+    ----------
+    width : int
+        Width of the full image.
+    height : int
+        Height of the full image.
+    min_size : tuple
+        (width, height) the reduced image must at least have.
+
+    Returns
+    -------
+    int
+        8, 4, 2, or 1 for a full decode.
+    """
+    for factor in REDUCTION_FACTORS:
+        # libjpeg rounds the scaled dimensions up
+        if (-(-width // factor) >= min_size[0]
+                and -(-height // factor) >= min_size[1]):
+            return factor
+    return 1
+
+
+def _read_flags(path, min_size, grayscale):
+    full = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    if min_size is None:
+        return full, 1
+    try:
+        with open(path, 'rb') as image_file:
+            is_jpeg = image_file.read(2) == b'\xff\xd8'
+        header = read_image_header(path) if is_jpeg else None
+    except OSError:
+        header = None
+    # Only JPEG decodes at a reduced scale, other formats would be decoded
+    # then resized
+    factor = reduction_factor(header[0], header[1], min_size) if header else 1
+    if factor == 1:
+        return full, 1
+    mode = 'GRAYSCALE' if grayscale else 'COLOR'
+    return getattr(cv2, f'IMREAD_REDUCED_{mode}_{factor}'), factor
+
+
+def reduced_decode_enabled(reduced_decode=None):
+    """Resolve a reduced_decode option.
+
+    Parameters
+    ----------
+    reduced_decode : bool, optional
+        Explicit choice of the caller, None falls back to the
+        BRAIN_TUMOR_REDUCED_DECODE environment variable.
+
+    Returns
+    -------
+    bool
+        Whether to decode JPEG sources at a reduced scale.
+    """
+    if reduced_decode is None:
+        value = os.environ.get(REDUCED_DECODE_ENV, '')
+        return value.lower() in ('1', 'true', 'yes')
+    return reduced_decode
+
+
+def read_image(path, min_size=None, grayscale=False):
+    """Read an image, decoding JPEG files at the smallest scale that fits.
+
+    Drop-in for cv2.imread(path): without min_size the image is fully
+    decoded. With it, a JPEG image is decoded at 1/2, 1/4 or 1/8 scale in
+    the DCT domain when the reduced image still covers min_size, which
+    skips most of the decode work before a downscaling resize.
+
+    Parameters
+    ----------
+    path : str
+        Path to the image.
+    min_size : tuple, optional
+        (width, height) the decoded image must at least have.
+    grayscale : bool, optional
+        Whether to decode a single channel image.
+
+    Returns
+    -------
+    numpy.ndarray or None
+        BGR or grayscale uint8 image, None if it can not be read.
+    """
+    flags, _ = _read_flags(path, min_size, grayscale)
+    return cv2.imread(path, flags)
+
+
+def measure_reduced_decoding(paths, min_size, repeats=3):
+    """Compare the full and reduced decoding of a set of images.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to the images, e.g. the raw JPEG scans.
+    min_size : tuple
+        (width, height) passed to read_image.
+    repeats : int, optional
+        Number of timed passes over the images, the best one is kept.
+
+    Returns
+    -------
+    dict
+        For 'full' and 'reduced' decoding: best and median seconds of a
+        pass, best seconds per image, decoded megapixels and peak traced
+        memory in MB of a pass, plus the count of images by reduction factor
+        and the speedup of the best passes.
+    """
+    factors = {}
+    for path in paths:
+        factor = _read_flags(path, min_size, False)[1]
+        factors[factor] = factors.get(factor, 0) + 1
+
+    report = {'n_images': len(paths), 'factors': factors}
+    for name, size in [('full', None), ('reduced', min_size)]:
+        times = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            for path in paths:
+                read_image(path, size)
+            times.append(time.perf_counter() - start_time)
+        best = min(times)
+        tracemalloc.start()
+        pixels = 0
+        for path in paths:
+            image = read_image(path, size)
+            if image is not None:
+                pixels += image.shape[0] * image.shape[1]
+            del image
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        report[name] = {'min_seconds': best,
+                        'median_seconds': statistics.median(times),
+                        'seconds_per_image': best / max(len(paths), 1),
+                        'megapixels': pixels / 1e6,
+                        'peak_memory_mb': peak / 2 ** 20}
+    reduced = report['reduced']['seconds_per_image']
+    report['speedup'] = (report['full']['seconds_per_image'] / reduced
+                         if reduced > 0 else float('nan'))
+    return report
@@ -0,0 +1,118 @@
+import sys
+import json
+import logging
+import subprocess
+
+import click
+
+# Public entry points, as (module, attribute) pairs
+ENTRY_POINTS = [
+    ('src.utils', None),
+    ('src.utils.data_processing', 'data_summary'),
+    ('src.utils.data_processing', 'corp_dataset'),
+    ('src.utils.exploratory_data_analysis', 'load_data'),
+    ('src.utils.packed_dataset', 'load_packed_dataset'),
+    ('src.utils.augmentation', 'AugmentedView'),
+    ('src.utils.manifest', 'read_manifest'),
+    ('src.data', None),
+    ('src.data.make_dataset', 'main'),
+    ('src.data.dataset_index', 'build_dataset_index'),
+    ('src.features.build_features', 'make_dataset'),
+    ('src.models.predict_model', 'Predictor'),
+]
+HEAVY_MODULES = ['tensorflow', 'cv2', 'matplotlib', 'imutils']
+
+_PROBE = '''
+import sys, json, time, resource
+start_time = time.perf_counter()
+module = __import__({module!r}, fromlist=['_'])
+attribute = {attribute!r}
+if attribute is not None:
+    getattr(module, attribute)
+elapsed = time.perf_counter() - start_time
+max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{'seconds': elapsed,
+                  'max_rss_mb': max_rss / 1024.,
+                  'heavy_modules': [name for name in {heavy!r}
+                                    if name in sys.modules]}}))
+'''
+
+
+def measure_import(module, attribute=None, python=sys.executable):
+    """Measure the cost of importing an entry point in a fresh interpreter.
+
+    Parameters
+    ----------
+    module : str
+        Absolute name of the module.
+    attribute : str, optional
+        Attribute looked up after the import, e.g. a function name.
+    python : str, optional
+        Interpreter to run the import with.
+
+    Returns
+    -------
+    dict
+        Import time in seconds, peak RSS in MB and the heavy modules loaded.
+    """
+    code = _PROBE.format(module=module, attribute=attribute,
+                         heavy=HEAVY_MODULES)
+    output = subprocess.run([python, '-c', code], capture_output=True,
+                            text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def benchmark_imports(entry_points=ENTRY_POINTS, repeats=3):
+    """Measure the import time and memory of every public entry point.
+
+    The time is the best of the repeats, the peak RSS includes the
+    interpreter itself, see the 'python' row for its baseline.
+
+    Parameters
+    ----------
+    entry_points : list, optional
+        (module, attribute) pairs to measure.
+    repeats : int, optional
+        Number of fresh interpreters per entry point.
+
+    Returns
+    -------
+    list
+        One dict per entry point.
+    """
+    results = []
+    for module, attribute in [('sys', None)] + list(entry_points):
+        runs = [measure_import(module, attribute) for _ in range(repeats)]
+        results.append({'entry_point': 'python' if module == 'sys' else
+                        module + (f':{attribute}' if attribute else ''),
+                        'seconds': min(run['seconds'] for run in runs),
+                        'max_rss_mb': max(run['max_rss_mb'] for run in runs),
+                        'heavy_modules': runs[0]['heavy_modules']})
+    return results
+
+
+@click.command()
+@click.option('--repeats', default=3, show_default=True)
+@click.option('--output', type=click.Path(),
+              help='Write the results to a JSON file.')
+def main(repeats, output):
+    """ Measures the import time and peak memory of the public entry points
+        of the package, each in a fresh interpreter.
+    """
+    logger = logging.getLogger(__name__)
+    results = benchmark_imports(repeats=repeats)
+    for result in results:
+        logger.info('%s: %.3f s, %.0f MB, heavy modules: %s',
+                    result['entry_point'], result['seconds'],
+                    result['max_rss_mb'],
+                    ', '.join(result['heavy_modules']) or '-')
+    if output:
+        with open(output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()
@@ -0,0 +1,50 @@
+import importlib
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Module imported on the first access to one of its attributes.
+
+    Parameters
+    ----------
+    name : str
+        Absolute name of the module, e.g. 'cv2'.
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__['_module'] = importlib.import_module(self.__name__)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<lazy module {self.__name__!r} ({state})>'
+
+    def __reduce__(self):
+        return lazy_import, (self.__name__,)
+
+
+def lazy_import(name):
+    """Defer the import of a heavy module until it is used.
+
+    Parameters
+    ----------
+    name : str
+        Absolute name of the module, e.g. 'cv2'.
+
+    Returns
+    -------
+    LazyModule
+        Stand-in forwarding every attribute access to the real module.
+    """
+    return LazyModule(name)
@@ -0,0 +1,111 @@
+import os
+import csv
+import logging
+from functools import lru_cache
+
+MANIFEST_FILE = 'manifest.csv'
+MANIFEST_FIELDS = ['split', 'class_name', 'path']
+
+
+def write_manifest(manifest_path, rows, fields=MANIFEST_FIELDS):
+    """Write a dataset manifest.
+
+    Paths are stored relative to the manifest directory, so the manifest
+    stays valid when the dataset tree is moved as a whole.
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path to the manifest file.
+    rows : list
+        List of dicts with at least the manifest fields.
+    fields : list, optional
+        Columns of the manifest.
+    """
+    root = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path + '.tmp', 'w', newline='') as manifest_file:
+        writer = csv.DictWriter(manifest_file, fieldnames=fields,
+                                extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            path = os.path.relpath(os.path.abspath(row['path']), root)
+            writer.writerow(dict(row, path=path))
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def read_manifest(manifest_path):
+    """Read a dataset manifest.
+
+    Parameters
+    ----------
+    manifest_path : str
+        Path to the manifest file.
+
+    Returns
+    -------
+    list
+        List of dicts, one per image, with the paths resolved.
+    """
+    root = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, newline='') as manifest_file:
+        rows = list(csv.DictReader(manifest_file))
+    for row in rows:
+        row['path'] = os.path.join(root, row['path'])
+    return rows
+
+
+@lru_cache(maxsize=8)
+def _split_paths(manifest_path, mtime_ns):
+    """Group the paths of a manifest by (split, class), cached per version."""
+    paths = {}
+    for row in read_manifest(manifest_path):
+        key = (row['split'], row['class_name'])
+        paths.setdefault(key, []).append(row['path'])
+    return paths
+
+
+def list_instance_paths(directory):
+    """List the images of a class directory, using its manifest if any.
+
+    When '<root>/manifest.csv' exists, the images of '<root>/<split>/<class>'
+    are read from it, so the directory does not even need to exist for a
+    split materialized as a manifest. An existing directory wins over the
+    manifest: it is listed when the manifest has no entry for it, and a
+    warning is logged when the manifest disagrees with it, e.g. when the
+    manifest is stale.
+
+    Parameters
+    ----------
+    directory : str
+        Path to a class directory, e.g. '.../split/train/yes'.
+
+    Returns
+    -------
+    list
+        Paths to the images of the directory.
+    """
+    split_dir, class_name = os.path.split(os.path.normpath(directory))
+    root, split = os.path.split(split_dir)
+    manifest_path = os.path.join(root, MANIFEST_FILE)
+    paths = None
+    if os.path.isfile(manifest_path):
+        paths = _split_paths(os.path.abspath(manifest_path),
+                             os.stat(manifest_path).st_mtime_ns).get(
+                                 (split, class_name))
+    if not os.path.isdir(directory):
+        if paths is None:
+            raise FileNotFoundError(f'No such directory or manifest entry: '
+                                    f'{directory}')
+        return list(paths)
+
+    listed = [os.path.join(directory, instance)
+              for instance in os.listdir(directory)]
+    if paths is None:
+        return listed
+    if ({os.path.abspath(path) for path in listed}
+            != {os.path.abspath(path) for path in paths}):
+        logging.getLogger(__name__).warning(
+            '%s disagrees with %s, listing the directory', manifest_path,
+            directory)
+        return listed
+    return list(paths)
@@ -0,0 +1,144 @@
+import os
+import json
+import numpy as np
+from .lazy_import import lazy_import
+from .exploratory_data_analysis import directory_label
+from .image_io import read_image, reduced_decode_enabled
+from .manifest import list_instance_paths
+
+cv2 = lazy_import('cv2')
+
+IMAGES_FILE = 'images.u8'
+INDEX_FILE = 'index.json'
+
+
+def export_packed_dataset(load_dir_list, image_size, output_dir,
+                          reduced_decode=None):
+    """Decode a split once and pack it into a fixed-shape uint8 array file.
+
+    The images are written one at a time straight into a memory-mapped file,
+    so the split is never held in memory. Unreadable images are skipped.
+
+    Parameters
+    ----------
+    load_dir_list : list
+        List of directories to load data from, e.g. ['.../train/yes',
+        '.../train/no'].
+    image_size : tuple
+        (width, height) of the packed images.
+    output_dir : str
+        Path to the directory where the packed dataset will be saved.
+    reduced_decode : bool, optional
+        Whether to decode JPEG files at the smallest scale covering
+        image_size, see image_io.read_image. None follows the
+        BRAIN_TUMOR_REDUCED_DECODE environment variable, off by default.
+
+    Returns
+    -------
+    int
+        Number of packed images.
+    """
+    reduced_decode = reduced_decode_enabled(reduced_decode)
+    decode_size = image_size if reduced_decode else None
+    files = []
+    for load_dir in load_dir_list:
+        label = directory_label(load_dir)
+        for path in sorted(list_instance_paths(load_dir)):
+            files.append((path, label))
+
+    os.makedirs(output_dir, exist_ok=True)
+    images_path = os.path.join(output_dir, IMAGES_FILE)
+    shape = (len(files), image_size[1], image_size[0], 3)
+    filenames, labels, skipped = [], [], []
+    if files:
+        images = np.memmap(images_path, dtype=np.uint8, mode='w+', shape=shape)
+        for path, label in files:
+            image = read_image(path, decode_size)
+            if image is None:
+                skipped.append(path)
+                continue
+            images[len(filenames)] = cv2.resize(image, image_size)
+            filenames.append(path)
+            labels.append(label)
+        images.flush()
+        del images
+    else:
+        open(images_path, 'wb').close()
+
+    # Drop the rows reserved for unreadable images
+    with open(images_path, 'r+b') as images_file:
+        images_file.truncate(len(filenames) * int(np.prod(shape[1:])))
+
+    write_packed_index(output_dir, (len(filenames),) + shape[1:], labels,
+                       filenames, skipped)
+    return len(filenames)
+
+
+def write_packed_index(output_dir, shape, labels, filenames, skipped=()):
+    """Write the label and filename index of a packed dataset.
+
+    Parameters
+    ----------
+    output_dir : str
+        Path to the packed dataset directory.
+    shape : tuple
+        (N, H, W, C) shape of the packed uint8 images.
+    labels : list
+        Label of each image.
+    filenames : list
+        Source filename of each image.
+    skipped : list, optional
+        Source filenames of the unreadable images.
+    """
+    with open(os.path.join(output_dir, INDEX_FILE), 'w') as index_file:
+        json.dump({'shape': list(shape),
+                   'dtype': 'uint8',
+                   'labels': labels,
+                   'filenames': filenames,
+                   'skipped': list(skipped)}, index_file)
+
+
+def read_packed_index(packed_dir):
+    """Read the index of a packed dataset, see write_packed_index.
+
+    Parameters
+    ----------
+    packed_dir : str
+        Path to a directory written by export_packed_dataset.
+
+    Returns
+    -------
+    dict
+        Shape, dtype, labels, filenames and skipped filenames.
+    """
+    with open(os.path.join(packed_dir, INDEX_FILE)) as index_file:
+        index = json.load(index_file)
+    index.setdefault('skipped', [])
+    return index
+
+
+def load_packed_dataset(packed_dir, mode='r'):
+    """Open a packed dataset without decoding or copying the images.
+
+    Parameters
+    ----------
+    packed_dir : str
+        Path to a directory written by export_packed_dataset.
+    mode : str, optional
+        numpy.memmap mode, 'r' for read-only access.
+
+    Returns
+    -------
+    tuple
+        Memory-mapped (N, H, W, 3) images, (N,) labels and the list of
+        source filenames.
+    """
+    index = read_packed_index(packed_dir)
+    shape = tuple(index['shape'])
+    if shape[0] == 0:
+        X = np.empty(shape, dtype=index['dtype'])
+    else:
+        X = np.memmap(os.path.join(packed_dir, IMAGES_FILE),
+                      dtype=index['dtype'], mode=mode, shape=shape)
+    y = np.array(index['labels'], dtype=int)
+    return X, y, index['filenames']
@@ -0,0 +1,153 @@
+import os
+import json
+import shutil
+import hashlib
+from collections import OrderedDict
+
+
+class PreprocessingCache:
+    """Content addressed on-disk cache of preprocessed images.
+
+    Entries are keyed by the hash of the source file bytes together with the
+    preprocessing parameters, so an entry is reused only when neither the
+    image nor the way it is processed has changed. The total size is capped
+    and the least recently used entries are evicted first.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path to the directory holding the cached images.
+    max_bytes : int, optional
+        Maximum total size of the cached images.
+
+    """
+
+    INDEX_FILE = 'index.json'
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.total_bytes = 0
+
+        # Keys in least to most recently used order, mapped to their size
+        self._entries = OrderedDict()
+        os.makedirs(cache_dir, exist_ok=True)
+        index_path = os.path.join(cache_dir, self.INDEX_FILE)
+        if os.path.isfile(index_path):
+            with open(index_path) as index_file:
+                for key, size in json.load(index_file):
+                    if os.path.isfile(self._entry_path(key)):
+                        self._entries[key] = size
+                        self.total_bytes += size
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    @staticmethod
+    def key(source_path, params):
+        """Build the cache key of a source image.
+
+        Parameters
+        ----------
+        source_path : str
+            Path to the source image.
+        params : dict
+            JSON serializable preprocessing parameters.
+
+        Returns
+        -------
+        str
+            Hexadecimal key.
+
+        """
+        digest = hashlib.sha256()
+        with open(source_path, 'rb') as source_file:
+            for block in iter(lambda: source_file.read(1 << 20), b''):
+                digest.update(block)
+        digest.update(json.dumps(params, sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key, target_path):
+        """Copy a cached image to a target path.
+
+        Parameters
+        ----------
+        key : str
+            Cache key of the image.
+        target_path : str
+            Path where the cached image will be copied.
+
+        Returns
+        -------
+        bool
+            True on a cache hit, False otherwise.
+
+        """
+        if key in self._entries:
+            try:
+                shutil.copyfile(self._entry_path(key), target_path)
+            except FileNotFoundError:
+                self.total_bytes -= self._entries.pop(key)
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+        self.misses += 1
+        return False
+
+    def put(self, key, source_path):
+        """Store a processed image in the cache.
+
+        Parameters
+        ----------
+        key : str
+            Cache key of the image.
+        source_path : str
+            Path to the processed image.
+
+        """
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        shutil.copyfile(source_path, entry_path)
+        if key in self._entries:
+            self.total_bytes -= self._entries.pop(key)
+        self._entries[key] = os.path.getsize(entry_path)
+        self.total_bytes += self._entries[key]
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._entry_path(key))
+            except FileNotFoundError:
+                pass
+
+    def save(self):
+        """Write the cache index to disk."""
+        index_path = os.path.join(self.cache_dir, self.INDEX_FILE)
+        with open(index_path + '.tmp', 'w') as index_file:
+            json.dump(list(self._entries.items()), index_file)
+        os.replace(index_path + '.tmp', index_path)
+
+    def stats(self):
+        """Summarize the cache usage.
+
+        Returns
+        -------
+        dict
+            Hits, misses, hit rate, evictions, entries and size in bytes.
+
+        """
+        lookups = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self.total_bytes}
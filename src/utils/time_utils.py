@@ -1,3 +1,22 @@
+import os
+import sys
+import json
+import time
+import threading
+from functools import wraps
+from collections import Counter
+
+try:
+    import resource
+except ImportError:
+    # Unix only, CPU time of the children and peak RSS are then not available
+    resource = None
+
+__all__ = ['PROFILE_ENV', 'PROFILE_DIR_ENV', 'time_execution', 'stage',
+           'count_items', 'get_metrics', 'reset_metrics', 'write_metrics_json',
+           'prometheus_metrics']
+
+
 def time_execution(seconds):
     """Time the execution of a function.
 
@@ -10,3 +29,272 @@ def time_execution(seconds):
     m = int((seconds - h * 3600) / 60)
     s = seconds % 60
     return f"{h}:{m}:{round(s,1)}"
+
+
+# 'cprofile' or 'sample' to profile every instrumented stage
+PROFILE_ENV = 'BRAIN_TUMOR_PROFILE'
+PROFILE_DIR_ENV = 'BRAIN_TUMOR_PROFILE_DIR'
+_SAMPLE_INTERVAL = 0.005
+
+_registry = {}
+_registry_lock = threading.Lock()
+_local = threading.local()
+_active_stages = 0
+
+
+def _proc_io():
+    """Bytes read and written by the process, including the page cache hits."""
+    try:
+        with open('/proc/self/io') as io_file:
+            fields = dict(line.split(': ')
+                          for line in io_file.read().splitlines())
+        return int(fields['rchar']), int(fields['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM (Linux >= 4.0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def _peak_rss():
+    """Peak resident memory in bytes since the last reset, or ever."""
+    try:
+        with open('/proc/self/status') as status_file:
+            for line in status_file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _cpu_time():
+    if resource is None:
+        return time.process_time()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class _Sampler(threading.Thread):
+    """Record the stack of a thread at a fixed interval, in folded format."""
+
+    def __init__(self, thread_id, interval=_SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                file_name = os.path.basename(code.co_filename)
+                stack.append(f'{code.co_name} ({file_name}:{frame.f_lineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class _Profile:
+    """Profiler of a stage, chosen by the BRAIN_TUMOR_PROFILE variable."""
+
+    def __init__(self, name):
+        self.name = name
+        self.mode = os.environ.get(PROFILE_ENV, '').lower()
+        self._profiler = None
+
+    def start(self):
+        if self.mode == 'cprofile':
+            import cProfile
+
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self.mode == 'sample':
+            self._profiler = _Sampler(threading.get_ident())
+            self._profiler.start()
+
+    def stop(self):
+        if self._profiler is None:
+            return
+        profile_dir = os.environ.get(PROFILE_DIR_ENV,
+                                     os.path.join('reports', 'profiles'))
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir,
+                            f'{self.name}_{os.getpid()}_{time.time_ns()}')
+        if self.mode == 'cprofile':
+            self._profiler.disable()
+            self._profiler.dump_stats(path + '.prof')
+        else:
+            self._profiler.stop()
+            with open(path + '.folded', 'w') as folded_file:
+                folded_file.writelines(
+                    f'{stack} {count}\n'
+                    for stack, count in self._profiler.stacks.items())
+
+
+class stage:
+    """Record the cost of a pipeline stage in the metrics registry.
+
+    Use it as a context manager, ``with stage('crop'):``, or as a decorator,
+    ``@stage('crop')``. Wall time, CPU time of the process and of its reaped
+    children, bytes read and written, and peak RSS are recorded on exit,
+    plus the items reported with count_items. I/O of worker processes is
+    not included. With BRAIN_TUMOR_PROFILE set to 'cprofile' or 'sample',
+    the stage is also profiled into BRAIN_TUMOR_PROFILE_DIR.
+
+    CPU time, I/O and peak RSS are measured for the whole process: stages
+    running at the same time in several threads each count everything the
+    process did meanwhile, so their totals overlap. Stages with
+    resources=False only record the wall time, the CPU time of their own
+    thread and the items, without any system call beyond the clocks, for
+    hot paths such as every forward pass of the model.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage.
+    resources : bool, optional
+        Whether to measure the process wide CPU time, I/O and peak RSS.
+    """
+
+    def __init__(self, name, resources=True):
+        self.name = name
+        self.resources = resources
+
+    def __call__(self, function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(self.name, self.resources):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        self.items = 0
+        self._profile = _Profile(self.name)
+        self._profile.start()
+        if self.resources:
+            self._enter_resources()
+        else:
+            self._cpu = time.thread_time()
+        self._start = time.perf_counter()
+        _stack().append(self)
+        return self
+
+    def _enter_resources(self):
+        global _active_stages
+        with _registry_lock:
+            # The peak is process wide, nested stages keep the peak of the
+            # outermost one
+            if _active_stages == 0:
+                _reset_peak_rss()
+            _active_stages += 1
+        self._io = _proc_io()
+        self._cpu = _cpu_time()
+
+    def __exit__(self, *exc_info):
+        global _active_stages
+        wall = time.perf_counter() - self._start
+        read = written = peak_rss = 0
+        if self.resources:
+            cpu = _cpu_time() - self._cpu
+            read, written = _proc_io()
+            read, written = read - self._io[0], written - self._io[1]
+            peak_rss = _peak_rss()
+        else:
+            cpu = time.thread_time() - self._cpu
+        _stack().pop()
+        self._profile.stop()
+        with _registry_lock:
+            if self.resources:
+                _active_stages -= 1
+            metrics = _registry.setdefault(self.name, {
+                'calls': 0, 'wall_seconds': 0., 'cpu_seconds': 0.,
+                'items': 0, 'bytes_read': 0, 'bytes_written': 0,
+                'peak_rss_bytes': 0})
+            metrics['calls'] += 1
+            metrics['wall_seconds'] += wall
+            metrics['cpu_seconds'] += cpu
+            metrics['items'] += self.items
+            metrics['bytes_read'] += read
+            metrics['bytes_written'] += written
+            metrics['peak_rss_bytes'] = max(metrics['peak_rss_bytes'],
+                                            peak_rss)
+        return False
+
+
+def _stack():
+    if not hasattr(_local, 'stages'):
+        _local.stages = []
+    return _local.stages
+
+
+def count_items(n=1):
+    """Add processed items to the innermost stage running in this thread."""
+    stages = _stack()
+    if stages:
+        stages[-1].items += n
+
+
+def get_metrics():
+    """Copy of the metrics registry.
+
+    Returns
+    -------
+    dict
+        Metrics by stage name, with the items per second.
+    """
+    with _registry_lock:
+        metrics = {name: dict(values) for name, values in _registry.items()}
+    for values in metrics.values():
+        values['items_per_second'] = (values['items'] / values['wall_seconds']
+                                      if values['wall_seconds'] > 0 else 0.)
+    return metrics
+
+
+def reset_metrics():
+    """Empty the metrics registry."""
+    with _registry_lock:
+        _registry.clear()
+
+
+def write_metrics_json(path):
+    """Write the metrics registry to a JSON file."""
+    with open(path, 'w') as metrics_file:
+        json.dump(get_metrics(), metrics_file, indent=2)
+
+
+def prometheus_metrics(prefix='brain_tumor_stage'):
+    """Format the metrics registry in the Prometheus text exposition format.
+
+    Returns
+    -------
+    str
+        One counter per metric, labelled by stage.
+    """
+    metrics = get_metrics()
+    lines = []
+    for field, kind in [('calls', 'counter'), ('wall_seconds', 'counter'),
+                        ('cpu_seconds', 'counter'), ('items', 'counter'),
+                        ('bytes_read', 'counter'),
+                        ('bytes_written', 'counter'),
+                        ('peak_rss_bytes', 'gauge')]:
+        name = f'{prefix}_{field}' + ('_total' if kind == 'counter' else '')
+        lines.append(f'# TYPE {name} {kind}')
+        lines.extend(f'{name}{{stage="{stage_name}"}} {values[field]}'
+                     for stage_name, values in sorted(metrics.items()))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,252 @@
+import os
+import math
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import numpy as np
+from src.utils.lazy_import import lazy_import
+from src.utils.manifest import list_instance_paths
+
+cv2 = lazy_import('cv2')
+
+# Class order of flow_from_directory and of the 0/1 labels of load_data
+CLASS_NAMES = ['no', 'yes']
+# BGR colours of the prediction overlays
+CORRECT_COLOR = (0, 200, 0)
+WRONG_COLOR = (0, 0, 220)
+TEXT_COLOR = (255, 255, 255)
+
+
+def _thumbnail(image, thumbnail_size):
+    """Downsample an image into a square BGR uint8 thumbnail, keeping its
+    aspect ratio."""
+    image = np.asarray(image)
+    if image.dtype != np.uint8:
+        # Float images are expected in [0, 1], as fed to the model
+        if image.max() <= 1.:
+            image = image * 255.
+        image = np.clip(image, 0, 255).astype(np.uint8)
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    height, width = image.shape[:2]
+    if (height, width) == (thumbnail_size, thumbnail_size):
+        return image[..., :3]
+    scale = thumbnail_size / max(height, width)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    resized = cv2.resize(image[..., :3], size, interpolation=cv2.INTER_AREA)
+    thumbnail = np.zeros((thumbnail_size, thumbnail_size, 3), dtype=np.uint8)
+    top = (thumbnail_size - size[1]) // 2
+    left = (thumbnail_size - size[0]) // 2
+    thumbnail[top:top + size[1], left:left + size[0]] = resized
+    return thumbnail
+
+
+def make_contact_sheet(images, thumbnail_size=64, columns=20, padding=2,
+                       captions=None, colors=None):
+    """Tile images into a single canvas.
+
+    Parameters
+    ----------
+    images : numpy.ndarray or list
+        (N, H, W, 3) or (N, H, W) stack, or a list of images of any size.
+        uint8 images are BGR as read by cv2, float images are in [0, 1].
+    thumbnail_size : int, optional
+        Side in pixels of every tile.
+    columns : int, optional
+        Number of tiles per row.
+    padding : int, optional
+        Gap in pixels between the tiles.
+    captions : list, optional
+        Text written at the bottom of each tile.
+    colors : list, optional
+        BGR colour of the frame of each tile, no frame for None.
+
+    Returns
+    -------
+    numpy.ndarray
+        (H, W, 3) BGR uint8 canvas.
+    """
+    n_images = len(images)
+    columns = max(1, min(columns, n_images))
+    rows = max(1, math.ceil(n_images / columns))
+    cell = thumbnail_size + padding
+    canvas = np.zeros((rows * cell + padding, columns * cell + padding, 3),
+                      dtype=np.uint8)
+
+    for index in range(n_images):
+        top = padding + (index // columns) * cell
+        left = padding + (index % columns) * cell
+        bottom = top + thumbnail_size
+        right = left + thumbnail_size
+        canvas[top:bottom, left:right] = _thumbnail(images[index],
+                                                    thumbnail_size)
+        color = colors[index] if colors is not None else None
+        if color is not None:
+            cv2.rectangle(canvas, (left, top), (right - 1, bottom - 1),
+                          color, 2)
+        if captions is not None and captions[index]:
+            cv2.putText(canvas, captions[index], (left + 3, bottom - 4),
+                        cv2.FONT_HERSHEY_PLAIN, 0.8, TEXT_COLOR, 1,
+                        cv2.LINE_AA)
+    return canvas
+
+
+def read_thumbnails(paths, thumbnail_size=64, n_threads=8):
+    """Read image files straight into thumbnails.
+
+    Parameters
+    ----------
+    paths : list
+        Paths to the images.
+    thumbnail_size : int, optional
+        Side in pixels of the thumbnails.
+    n_threads : int, optional
+        Number of decoding threads.
+
+    Returns
+    -------
+    numpy.ndarray
+        (N, thumbnail_size, thumbnail_size, 3) BGR uint8 thumbnails, black
+        for unreadable images.
+    """
+    def read(path):
+        image = cv2.imread(path)
+        if image is None:
+            return np.zeros((thumbnail_size, thumbnail_size, 3),
+                            dtype=np.uint8)
+        return _thumbnail(image, thumbnail_size)
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        thumbnails = list(executor.map(read, paths))
+    return np.array(thumbnails).reshape(-1, thumbnail_size, thumbnail_size, 3)
+
+
+def _overlays(label, predictions, probabilities):
+    """Captions and frame colours of the tiles of one class."""
+    if predictions is None:
+        return None, None
+    colors = [CORRECT_COLOR if prediction == label else WRONG_COLOR
+              for prediction in predictions]
+    if probabilities is None:
+        captions = [CLASS_NAMES[prediction] for prediction in predictions]
+    else:
+        captions = [f'{CLASS_NAMES[prediction]} {probability:.2f}'
+                    for prediction, probability in zip(predictions,
+                                                       probabilities)]
+    return captions, colors
+
+
+class _Selection:
+    """Sequence view of some items of an array or list."""
+
+    def __init__(self, items, indices):
+        self.items = items
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return self.items[self.indices[index]]
+
+
+def write_contact_sheets(X, y, output_dir, n=None, predictions=None,
+                         probabilities=None, prefix='samples',
+                         **sheet_options):
+    """Write one contact sheet PNG per class.
+
+    Headless replacement of plot_sample_images.
+
+    Parameters
+    ----------
+    X : numpy.ndarray or list
+        Images, see make_contact_sheet.
+    y : numpy.ndarray
+        0/1 labels of the images.
+    output_dir : str
+        Directory of the PNG files.
+    n : int, optional
+        Number of images per class, all of them by default.
+    predictions : numpy.ndarray, optional
+        0/1 predicted labels. Tiles get a green frame when the prediction is
+        right and a red one otherwise.
+    probabilities : numpy.ndarray, optional
+        Probability of each predicted label, written on the tiles.
+    prefix : str, optional
+        Prefix of the file names.
+    **sheet_options
+        Passed to make_contact_sheet.
+
+    Returns
+    -------
+    list
+        Paths of the written files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    y = np.asarray(y)
+    paths = []
+    for label, class_name in enumerate(CLASS_NAMES):
+        indices = np.flatnonzero(y == label)[:n]
+        if not len(indices):
+            continue
+        selected_predictions = selected_probabilities = None
+        if predictions is not None:
+            selected_predictions = np.asarray(predictions)[indices]
+        if probabilities is not None:
+            selected_probabilities = np.asarray(probabilities)[indices]
+        captions, colors = _overlays(label, selected_predictions,
+                                     selected_probabilities)
+        # Tiles are copied from X one at a time, the selection is never
+        # stacked
+        canvas = make_contact_sheet(_Selection(X, indices), captions=captions,
+                                    colors=colors, **sheet_options)
+        path = os.path.join(output_dir, f'{prefix}_{class_name}.png')
+        cv2.imwrite(path, canvas)
+        paths.append(path)
+    return paths
+
+
+@click.command()
+@click.argument('data_dir', type=click.Path(exists=True))
+@click.argument('output_dir', type=click.Path())
+@click.option('--n', type=int, help='Images per class, all by default.')
+@click.option('--thumbnail-size', default=64, show_default=True)
+@click.option('--columns', default=20, show_default=True)
+@click.option('--model-dir', type=click.Path(exists=True),
+              help='Overlay the predictions of this model.')
+def main(data_dir, output_dir, n, thumbnail_size, columns, model_dir):
+    """ Writes one contact sheet PNG per class of DATA_DIR, a directory with
+        'no' and 'yes' subdirectories, into OUTPUT_DIR.
+    """
+    logger = logging.getLogger(__name__)
+    paths, y = [], []
+    for label, class_name in enumerate(CLASS_NAMES):
+        class_dir = os.path.join(data_dir, class_name)
+        class_paths = list_instance_paths(class_dir)[:n]
+        paths.extend(class_paths)
+        y.extend([label] * len(class_paths))
+
+    predictions = probabilities = None
+    if model_dir is not None:
+        from src.models.predict_model import Predictor
+
+        with Predictor(model_dir) as predictor:
+            _, class_probabilities = predictor.predict(paths)
+        predictions = class_probabilities.argmax(axis=1)
+        probabilities = class_probabilities.max(axis=1)
+
+    thumbnails = read_thumbnails(paths, thumbnail_size)
+    for path in write_contact_sheets(thumbnails, y, output_dir,
+                                     predictions=predictions,
+                                     probabilities=probabilities,
+                                     thumbnail_size=thumbnail_size,
+                                     columns=columns):
+        logger.info('wrote %s', path)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+
+    main()